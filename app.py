@@ -15,25 +15,62 @@ CORREÇÃO APLICADA:
 
 
 # ============================================================
-# IMPORTS - BIBLIOTECAS PYTHON PADRÃO
+# MODO ASSÍNCRONO (ANTES DE QUALQUER OUTRO IMPORT)
 # ============================================================
+# ASYNC_MODE=threading → padrão, desenvolvimento com debug=True
+# ASYNC_MODE=eventlet  → produção com gunicorn --worker-class eventlet -w 1
+# ASYNC_MODE=gevent    → produção com gunicorn --worker-class gevent -w 1
+#
+# Nos modos cooperativos o mysqlclient (extensão C) travaria o worker inteiro
+# a cada consulta; por isso o MySQL passa a usar o PyMySQL (Python puro, cujos
+# sockets são cooperativos após o monkey patch). SMTP (smtplib) já é Python
+# puro e também passa a ceder a vez durante o envio.
+# Testado em tests/test_agenda_concorrente.py (cargas simultâneas não serializam).
 import os
+
+ASYNC_MODE = os.getenv('ASYNC_MODE', 'threading')
+
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+if ASYNC_MODE != 'threading' and os.getenv('MYSQL_DRIVER', 'pymysql') == 'pymysql':
+    import sys
+    import pymysql
+    pymysql.install_as_MySQLdb()  # o pool MySQL passa a usar o PyMySQL
+    sys.modules['MySQLdb.cursors'] = pymysql.cursors
+
+
+# ============================================================
+# IMPORTS - BIBLIOTECAS PYTHON PADRÃO
+# ============================================================
 import json
 import uuid
 import base64
+import hashlib
+import shutil
+import tempfile
 import re
 import unicodedata
 import time  # ✅ Módulo time para time.time()
+import threading
+import smtplib
+from email.utils import formataddr, parseaddr
 from io import BytesIO
 from datetime import datetime, timedelta  # ✅ SEM 'time' aqui!
 from math import radians, cos, sin, asin, sqrt
-from functools import wraps
+from functools import wraps, lru_cache
+from html.parser import HTMLParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # ============================================================
 # IMPORTS - BIBLIOTECAS EXTERNAS
 # ============================================================
-# Threading é mais estável para desenvolvimento com debug=True
-# NÃO precisa de monkey.patch_all()
+# monkey patch (se houver) já aplicado em MODO ASSÍNCRONO
 
 from flask import (
     Flask, 
@@ -45,19 +82,23 @@ from flask import (
     flash, 
     jsonify, 
     send_file, 
-    session
+    session,
+    g
 )
+import click
 from flask_caching import Cache
-from flask_mysqldb import MySQL
+import MySQLdb
 import MySQLdb.cursors
 
 from flask_mail import Mail, Message
+from jinja2 import Environment, FileSystemLoader, TemplateNotFound, select_autoescape
 
 from flask_socketio import (
     SocketIO, 
     emit, 
     join_room, 
-    leave_room
+    leave_room,
+    rooms
 )
 
 from werkzeug.utils import secure_filename
@@ -66,6 +107,7 @@ from xhtml2pdf import pisa
 # Alternativa: usar xhtml2pdf ou ReportLab
 from pytz import timezone
 import PyPDF2
+from PIL import Image, ImageOps, UnidentifiedImageError, features
 import airportsdata
 
 # ============================================================
@@ -76,7 +118,16 @@ app = Flask(__name__)
 # ============================================================
 # INICIALIZAR CACHE (DEPOIS DO APP)
 # ============================================================
-cache = Cache(app, config={'CACHE_TYPE': 'simple'})
+# 'simple' = memória do processo. Com vários workers, usar um backend
+# compartilhado (ex: CACHE_TYPE=RedisCache + CACHE_REDIS_URL)
+CACHE_TYPE = os.getenv('CACHE_TYPE', 'simple')
+CACHE_COMPARTILHADO = CACHE_TYPE.lower() not in ('simple', 'simplecache', 'null', 'nullcache')
+
+cache = Cache(app, config={
+    'CACHE_TYPE': CACHE_TYPE,
+    'CACHE_REDIS_URL': os.getenv('CACHE_REDIS_URL'),
+    'CACHE_KEY_PREFIX': 'sot_'
+})
 
 # ============================================================
 # CONFIGURAÇÕES DO SISTEMA
@@ -97,9 +148,373 @@ app.config['MYSQL_HOST'] = os.getenv('MYSQL_HOST')
 app.config['MYSQL_USER'] = os.getenv('MYSQL_USER')
 app.config['MYSQL_PASSWORD'] = os.getenv('MYSQL_PASSWORD')
 app.config['MYSQL_DB'] = os.getenv('MYSQL_DB')
+app.config['MYSQL_PORT'] = int(os.getenv('MYSQL_PORT', 3306))
 app.config['MYSQL_CHARSET'] = 'utf8mb4'
 
-mysql = MySQL(app)
+# Pool de conexões (por processo)
+app.config['MYSQL_POOL_MIN'] = int(os.getenv('MYSQL_POOL_MIN', 2))          # mantidas abertas mesmo ociosas
+app.config['MYSQL_POOL_MAX'] = int(os.getenv('MYSQL_POOL_MAX', 10))         # limite de conexões abertas
+app.config['MYSQL_POOL_TIMEOUT'] = float(os.getenv('MYSQL_POOL_TIMEOUT', 10))  # espera máxima por conexão (s)
+app.config['MYSQL_POOL_PING_APOS'] = int(os.getenv('MYSQL_POOL_PING_APOS', 30))  # ping se ociosa há mais de N s
+app.config['MYSQL_POOL_OCIOSA_MAX'] = int(os.getenv('MYSQL_POOL_OCIOSA_MAX', 300))  # fecha excedentes ociosas
+
+
+class MySQLPool:
+    """
+    Pool de conexões MySQL - substitui o Flask-MySQLdb
+    
+    Mesmo uso de antes (mysql.connection.cursor(), mysql.connection.commit()):
+    a primeira chamada a mysql.connection no contexto da aplicação retira uma
+    conexão do pool, que é devolvida (com rollback do que não foi commitado)
+    no teardown do contexto.
+    """
+    
+    def __init__(self, app=None):
+        self.app = app
+        self._livres = []  # [(conexao, devolvida_em)] - a mais recente no fim
+        self._cond = threading.Condition()
+        self._abertas = 0
+        self._stats = {
+            'criadas': 0,
+            'descartadas': 0,
+            'checkouts': 0,
+            'timeouts': 0,
+            'espera_total_ms': 0.0,
+            'espera_max_ms': 0.0
+        }
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        self.app = app
+        app.teardown_appcontext(self._teardown)
+    
+    @property
+    def connection(self):
+        """Conexão do contexto atual (retirada do pool no primeiro uso)"""
+        if '_mysql_conexao' not in g:
+            g._mysql_conexao = self._retirar()
+        return g._mysql_conexao
+    
+    def _conectar(self):
+        config = self.app.config
+        return MySQLdb.connect(
+            host=config['MYSQL_HOST'],
+            user=config['MYSQL_USER'],
+            passwd=config['MYSQL_PASSWORD'],
+            db=config['MYSQL_DB'],
+            port=config['MYSQL_PORT'],
+            charset=config['MYSQL_CHARSET'],
+            connect_timeout=10
+        )
+    
+    def _fechar(self, conexao):
+        """Fecha uma conexão descartada (chamar com self._cond adquirido)"""
+        try:
+            conexao.close()
+        except Exception:
+            pass
+        self._abertas -= 1
+        self._stats['descartadas'] += 1
+    
+    def _retirar(self):
+        config = self.app.config
+        inicio = time.time()
+        limite = inicio + config['MYSQL_POOL_TIMEOUT']
+        
+        with self._cond:
+            while True:
+                agora = time.time()
+                
+                # Fechar excedentes ociosas há muito tempo (as mais antigas ficam no início)
+                while (self._livres and self._abertas > config['MYSQL_POOL_MIN']
+                       and agora - self._livres[0][1] > config['MYSQL_POOL_OCIOSA_MAX']):
+                    self._fechar(self._livres.pop(0)[0])
+                
+                if self._livres:
+                    conexao, devolvida_em = self._livres.pop()
+                    if agora - devolvida_em > config['MYSQL_POOL_PING_APOS']:
+                        try:
+                            conexao.ping()
+                        except Exception:
+                            print("⚠️ Pool MySQL: conexão ociosa sem resposta descartada")
+                            self._fechar(conexao)
+                            continue
+                    break
+                
+                if self._abertas < config['MYSQL_POOL_MAX']:
+                    # Reservar a vaga e conectar fora do lock
+                    self._abertas += 1
+                    self._cond.release()
+                    try:
+                        conexao = self._conectar()
+                    except Exception:
+                        self._cond.acquire()
+                        self._abertas -= 1
+                        self._cond.notify()
+                        raise
+                    self._cond.acquire()
+                    self._stats['criadas'] += 1
+                    break
+                
+                restante = limite - agora
+                if restante <= 0:
+                    self._stats['timeouts'] += 1
+                    raise RuntimeError(
+                        f"Pool MySQL esgotado: {self._abertas} conexões em uso "
+                        f"por mais de {config['MYSQL_POOL_TIMEOUT']}s"
+                    )
+                self._cond.wait(restante)
+            
+            espera = (time.time() - inicio) * 1000
+            self._stats['checkouts'] += 1
+            self._stats['espera_total_ms'] += espera
+            self._stats['espera_max_ms'] = max(self._stats['espera_max_ms'], espera)
+        
+        return conexao
+    
+    def _devolver(self, conexao):
+        try:
+            conexao.rollback()  # Descarta transação não commitada (como o close do Flask-MySQLdb)
+            saudavel = True
+        except Exception:
+            saudavel = False
+        
+        with self._cond:
+            if saudavel:
+                self._livres.append((conexao, time.time()))
+            else:
+                self._fechar(conexao)
+            self._cond.notify()
+    
+    def _teardown(self, exception):
+        conexao = g.pop('_mysql_conexao', None)
+        if conexao is not None:
+            self._devolver(conexao)
+    
+    def estatisticas(self):
+        """Retrato do pool: conexões criadas, em uso, livres e tempo de espera"""
+        with self._cond:
+            livres = len(self._livres)
+            checkouts = self._stats['checkouts']
+            return {
+                **self._stats,
+                'abertas': self._abertas,
+                'em_uso': self._abertas - livres,
+                'livres': livres,
+                'espera_media_ms': self._stats['espera_total_ms'] / checkouts if checkouts else 0.0,
+                'min': self.app.config['MYSQL_POOL_MIN'],
+                'max': self.app.config['MYSQL_POOL_MAX']
+            }
+
+
+mysql = MySQLPool(app)
+
+
+# ============================================================
+# MIGRAÇÕES DE ESQUEMA
+# ============================================================
+# Cada migração é idempotente e registrada com @migracao. Passo de deploy:
+# `flask --app app migrar-esquema` (release do Procfile) antes de subir os
+# workers; os comandos `flask migrar-*` também rodam as migrações antes de
+# copiar os dados antigos.
+# Com ESQUEMA_AUTOMATICO=true elas rodam também na primeira requisição de cada
+# processo (conveniente em desenvolvimento). Desligado por padrão: sem DDL
+# instantâneo, o ALTER TABLE reconstrói tabelas grandes (VISTORIA_ITENS com
+# as fotos) enquanto todas as requisições esperam.
+ESQUEMA_AUTOMATICO = os.getenv('ESQUEMA_AUTOMATICO', 'false').lower() == 'true'
+ESQUEMA_RETENTAR_APOS = 5  # segundos sem nova tentativa após uma falha (banco fora)
+
+MIGRACOES = []
+_esquema_pronto = False
+_esquema_falha_em = None
+_esquema_lock = threading.Lock()
+
+
+def migracao(f):
+    """Registra f(cursor) para rodar em garantir_esquema (na ordem de definição)"""
+    MIGRACOES.append(f)
+    return f
+
+
+def adicionar_colunas(cursor, tabela, colunas):
+    """
+    Cria as colunas ausentes de `tabela`
+    
+    Args:
+        colunas: lista de (COLUNA, ALTER TABLE ... ADD COLUMN)
+    
+    Returns:
+        list: Colunas criadas agora
+    """
+    cursor.execute("""
+        SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    """, (tabela,))
+    existentes = {row[0].upper() for row in cursor.fetchall()}
+    
+    criadas = []
+    for coluna, ddl in colunas:
+        if coluna in existentes:
+            continue
+        try:
+            cursor.execute(ddl)
+        except MySQLdb.MySQLError as e:
+            if e.args[0] != 1060:  # Duplicate column: outro processo criou antes
+                raise
+            continue
+        criadas.append(coluna)
+        print(f"🔧 Coluna {tabela}.{coluna} criada")
+    return criadas
+
+
+def garantir_esquema():
+    """
+    Roda as migrações registradas, uma vez por processo
+    
+    Usa mysql.connection sem transação pendente (início da requisição ou
+    comando CLI) e faz commit ao final. Se falhar, as requisições dos próximos
+    ESQUEMA_RETENTAR_APOS segundos falham direto em vez de enfileirar novas
+    tentativas no lock.
+    """
+    global _esquema_pronto, _esquema_falha_em
+    if _esquema_pronto:
+        return
+    
+    with _esquema_lock:
+        if _esquema_pronto:
+            return
+        if _esquema_falha_em and time.time() - _esquema_falha_em < ESQUEMA_RETENTAR_APOS:
+            raise RuntimeError("Migrações de esquema falharam há pouco; nova tentativa em instantes")
+        
+        try:
+            cursor = mysql.connection.cursor()
+            try:
+                for f in MIGRACOES:
+                    f(cursor)
+                mysql.connection.commit()
+            finally:
+                cursor.close()
+        except Exception as e:
+            _esquema_falha_em = time.time()
+            print(f"❌ Migrações de esquema: {e}")
+            raise
+        
+        _esquema_pronto = True
+        _esquema_falha_em = None
+        print(f"✅ Esquema verificado ({len(MIGRACOES)} migração(ões))")
+
+
+@app.before_request
+def _garantir_esquema():
+    # Arquivos estáticos não dependem do banco
+    if ESQUEMA_AUTOMATICO and request.endpoint != 'static':
+        garantir_esquema()
+
+
+# ============================================================
+# SEQUÊNCIAS DE IDS
+# ============================================================
+# Tabelas com ID calculado pela aplicação (sem AUTO_INCREMENT) tiram o próximo
+# valor de SEQUENCIAS em vez de SELECT MAX()+1, que repete IDs sob concorrência.
+#   SEQUENCIA_BLOCO=1 (padrão) → SELECT ... FOR UPDATE na transação de quem
+#       insere: a linha da sequência fica travada até o commit, rollback
+#       devolve o ID (sem lacunas) e a ordem dos IDs segue a dos commits
+#   SEQUENCIA_BLOCO=N → cada processo reserva N IDs numa transação curta (com
+#       commit na hora) e os entrega da memória (uma ida ao banco a cada N; IDs
+#       de processos diferentes se intercalam e a sobra de um processo
+#       encerrado vira lacuna)
+# Em ambos os modos só a conexão da requisição é usada. As sequências de
+# SEQUENCIAS são criadas/semeadas na subida (migração); outro nome começa em 1.
+SEQUENCIA_BLOCO = max(1, int(os.getenv('SEQUENCIA_BLOCO', 1)))
+
+# nome → (tabela, coluna) cujo MAX semeia a sequência
+SEQUENCIAS = {
+    'CONTROLE_LOCACAO_ITENS': ('CONTROLE_LOCACAO_ITENS', 'ID_ITEM'),
+    'FLUXO_VEICULOS': ('FLUXO_VEICULOS', 'ID_FLUXO'),
+    'PASSAGENS_AEREAS_EMITIDAS': ('PASSAGENS_AEREAS_EMITIDAS', 'ID_OF'),
+    'CAD_MOTORISTA': ('CAD_MOTORISTA', 'ID_MOTORISTA'),
+    'DIARIAS_TERCEIRIZADOS': ('DIARIAS_TERCEIRIZADOS', 'IDITEM'),
+}
+
+SQL_SEQUENCIAS = """
+    CREATE TABLE IF NOT EXISTS SEQUENCIAS (
+        NOME VARCHAR(64) NOT NULL PRIMARY KEY,
+        PROXIMO BIGINT NOT NULL
+    )
+"""
+
+_sequencia_faixas = {}  # nome → deque([proximo, limite)) reservadas por este processo
+_sequencia_lock = threading.Lock()
+
+
+@migracao
+def _migracao_sequencias(cursor):
+    """Cria SEQUENCIAS e semeia cada sequência com o MAX da tabela (nunca baixa o valor)"""
+    cursor.execute(SQL_SEQUENCIAS)
+    for nome, (tabela, coluna) in SEQUENCIAS.items():
+        # Se algo inseriu IDs por fora, a sequência salta para depois do MAX
+        cursor.execute(f"""
+            INSERT INTO SEQUENCIAS (NOME, PROXIMO)
+            SELECT %s, COALESCE(MAX({coluna}), 0) + 1 FROM {tabela}
+            ON DUPLICATE KEY UPDATE PROXIMO = GREATEST(PROXIMO, VALUES(PROXIMO))
+        """, (nome,))
+
+
+def _reservar_ids(cursor, nome, quantidade):
+    """Avança a sequência em `quantidade` na transação do cursor; retorna o primeiro ID"""
+    if nome not in SEQUENCIAS:
+        # Não semeada na subida: cria já travada (o UPDATE do duplicado pega a
+        # trava exclusiva direto, sem o impasse de INSERT IGNORE + FOR UPDATE)
+        cursor.execute("""
+            INSERT INTO SEQUENCIAS (NOME, PROXIMO) VALUES (%s, 1)
+            ON DUPLICATE KEY UPDATE PROXIMO = PROXIMO
+        """, (nome,))
+    cursor.execute("SELECT PROXIMO FROM SEQUENCIAS WHERE NOME = %s FOR UPDATE", (nome,))
+    primeiro = cursor.fetchone()[0]
+    cursor.execute("UPDATE SEQUENCIAS SET PROXIMO = %s WHERE NOME = %s", (primeiro + quantidade, nome))
+    return primeiro
+
+
+def proximo_id(nome):
+    """
+    Próximo ID da sequência `nome`, único entre requisições e processos
+    
+    Usa a conexão da requisição (mysql.connection):
+      SEQUENCIA_BLOCO=1 → entra na transação atual e o chamador faz o commit
+          junto com o INSERT. A linha da sequência fica travada até lá: pedir
+          o ID logo antes do INSERT, depois de uploads e validações.
+      SEQUENCIA_BLOCO=N → ao esgotar a faixa do processo, reserva outra e faz
+          commit na hora (transação curta): pedir o ID antes das escritas da
+          transação, como fazem as rotas de cadastro.
+    """
+    if SEQUENCIA_BLOCO == 1:
+        cursor = mysql.connection.cursor()
+        try:
+            return _reservar_ids(cursor, nome, 1)
+        finally:
+            cursor.close()
+    
+    with _sequencia_lock:
+        faixas = _sequencia_faixas.setdefault(nome, deque())
+        while faixas:
+            faixa = faixas[0]
+            if faixa[0] < faixa[1]:
+                faixa[0] += 1
+                return faixa[0] - 1
+            faixas.popleft()
+    
+    # Faixa esgotada: reservar outra fora do lock (o banco serializa os processos)
+    cursor = mysql.connection.cursor()
+    try:
+        primeiro = _reservar_ids(cursor, nome, SEQUENCIA_BLOCO)
+        mysql.connection.commit()
+    finally:
+        cursor.close()
+    
+    with _sequencia_lock:
+        _sequencia_faixas[nome].append([primeiro + 1, primeiro + SEQUENCIA_BLOCO])
+    return primeiro
 
 
 # ============================================================
@@ -110,23 +525,532 @@ app.config['MAIL_PORT'] = os.getenv('MAIL_PORT')
 app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER')
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', 'true').lower() == 'true'  # false p/ SMTP local de teste
 app.config['MAIL_USE_SSL'] = False
-app.config['MAIL_MAX_EMAILS'] = None
+app.config['MAIL_MAX_EMAILS'] = int(os.getenv('MAIL_MAX_EMAILS', 100))  # mensagens por conexão SMTP
 app.config['MAIL_TIMEOUT'] = 10  # segundos
 
 mail = Mail(app)
 
 
 # ============================================================
-# CONFIGURAÇÃO DO WEBSOCKET (Flask-SocketIO com Threading)
+# TEMPLATES DE EMAIL
 # ============================================================
-# Threading é mais estável para desenvolvimento com debug=True
-# Em produção, pode trocar para 'gevent' se necessário
+# templates/emails/<nome>.html e <nome>.txt, num ambiente Jinja próprio.
+# O CSS fica legível num <style data-inline> com regras .classe; ao compilar
+# o template (uma vez por processo) as classes viram style="" — clientes de
+# email ignoram <style>. Sem .txt, o texto sai da conversão do HTML (cache).
+EMAIL_TEMPLATES_DIR = os.path.join(app.root_path, 'templates', 'emails')
+EMAIL_TEMPLATES = ('locacao',)  # compilados na subida
+HTML_TEXTO_CACHE = 256          # conversões HTML→texto guardadas
+
+
+def inline_css_email(fonte):
+    """Troca class="..." pelas declarações do bloco <style data-inline> (removido)"""
+    bloco = re.search(r'<style data-inline>(.*?)</style>\s*', fonte, re.S)
+    if not bloco:
+        return fonte
+    
+    regras = {}
+    for classe, corpo in re.findall(r'\.([\w-]+)\s*\{([^}]*)\}', bloco.group(1)):
+        regras[classe] = ' '.join(d.strip() + ';' for d in corpo.split(';') if d.strip())
+    fonte = fonte[:bloco.start()] + fonte[bloco.end():]
+    
+    def aplicar(m):
+        estilo = ' '.join(regras[c] for c in m.group(1).split() if c in regras)
+        return f'style="{estilo}"' if estilo else m.group(0)
+    return re.sub(r'class="([^"]*)"', aplicar, fonte)
+
+
+class EmailTemplateLoader(FileSystemLoader):
+    """Carrega templates de email já com o CSS aplicado inline"""
+    
+    def get_source(self, environment, template):
+        fonte, caminho, atualizado = super().get_source(environment, template)
+        if template.endswith('.html'):
+            fonte = inline_css_email(fonte)
+        return fonte, caminho, atualizado
+
+
+email_jinja = Environment(
+    loader=EmailTemplateLoader(EMAIL_TEMPLATES_DIR),
+    autoescape=select_autoescape(['html']),  # .txt sem escape
+    auto_reload=app.debug
+)
+
+
+def renderizar_email(nome, **contexto):
+    """
+    Renderiza o email `nome` a partir dos templates compilados
+    
+    Returns:
+        tuple: (html, texto)
+    """
+    html = email_jinja.get_template(f'{nome}.html').render(**contexto)
+    try:
+        texto = email_jinja.get_template(f'{nome}.txt').render(**contexto)
+    except TemplateNotFound:
+        texto = html_para_texto(html)
+    return html, texto
+
+
+class _HTMLParaTexto(HTMLParser):
+    BLOCOS = {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table'}
+    IGNORAR = {'style', 'script', 'head'}
+    
+    def __init__(self):
+        super().__init__()
+        self.partes = []
+        self._ignorando = 0
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in self.IGNORAR:
+            self._ignorando += 1
+        elif tag in self.BLOCOS:
+            self.partes.append('\n')
+    
+    def handle_endtag(self, tag):
+        if tag in self.IGNORAR:
+            self._ignorando = max(0, self._ignorando - 1)
+        elif tag in self.BLOCOS:
+            self.partes.append('\n')
+        elif tag in ('td', 'th'):
+            self.partes.append(' ')
+    
+    def handle_data(self, data):
+        if not self._ignorando:
+            self.partes.append(data)
+    
+    def texto(self):
+        linhas = [' '.join(linha.split()) for linha in ''.join(self.partes).splitlines()]
+        return re.sub(r'\n{3,}', '\n\n', '\n'.join(linhas)).strip()
+
+
+@lru_cache(maxsize=HTML_TEXTO_CACHE)
+def html_para_texto(html):
+    """Versão texto (fallback) de um corpo HTML; repetições vêm do cache"""
+    parser = _HTMLParaTexto()
+    parser.feed(html)
+    parser.close()
+    return parser.texto()
+
+
+def precompilar_templates_email():
+    """Compila os templates de email conhecidos (erros aparecem na subida, não no envio)"""
+    for nome in EMAIL_TEMPLATES:
+        for extensao in ('html', 'txt'):
+            try:
+                email_jinja.get_template(f'{nome}.{extensao}')
+            except TemplateNotFound:
+                if extensao == 'html':
+                    raise
+
+
+precompilar_templates_email()
+
+
+# ============================================================
+# FILA DE EMAILS (OUTBOX)
+# ============================================================
+# As rotas apenas gravam a mensagem pronta (MIME) em EMAIL_FILA e respondem.
+# Uma tarefa em segundo plano por processo reserva lotes da fila e envia pela
+# mesma sessão SMTP enquanto houver mensagens (renovada a cada MAIL_MAX_EMAILS,
+# evitando um handshake TLS por email); após a entrega chama o callback do tipo
+# (registro em CONTROLE_LOCACAO_EMAIL/EMAIL_DIARIAS, FL_EMAIL, WebSocket).
+# Falhas voltam para a fila com espera exponencial até EMAIL_TENTATIVAS_MAX.
+#
+# Teste local sem servidor real:
+#   python -m aiosmtpd -n -l localhost:1025
+#   MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_TLS=false
+#   flask --app app enviar-emails   (esvazia a fila sem subir o servidor)
+EMAIL_INTERVALO = int(os.getenv('EMAIL_INTERVALO', 5))      # s entre verificações da fila
+EMAIL_LOTE = int(os.getenv('EMAIL_LOTE', 20))               # mensagens reservadas por vez
+EMAIL_TENTATIVAS_MAX = int(os.getenv('EMAIL_TENTATIVAS_MAX', 8))
+EMAIL_ESPERA_INICIAL = 30       # s; dobra a cada falha
+EMAIL_ESPERA_MAXIMA = 3600
+EMAIL_RESERVA_EXPIRA = 600      # s; lote de um processo que morreu volta para a fila
+EMAIL_POR_CONEXAO = app.config['MAIL_MAX_EMAILS']  # depois disso a sessão SMTP é renovada
+
+SQL_EMAIL_FILA = """
+    CREATE TABLE IF NOT EXISTS EMAIL_FILA (
+        ID BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        TIPO VARCHAR(30) NOT NULL,
+        DADOS TEXT NULL,
+        REMETENTE VARCHAR(255) NOT NULL,
+        DESTINATARIOS TEXT NOT NULL,
+        MENSAGEM LONGBLOB NOT NULL,
+        STATUS VARCHAR(10) NOT NULL DEFAULT 'PENDENTE',
+        TENTATIVAS INT NOT NULL DEFAULT 0,
+        PROXIMA_TENTATIVA DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        RESERVA CHAR(32) NULL,
+        DT_RESERVA DATETIME NULL,
+        ULTIMO_ERRO TEXT NULL,
+        DT_CRIACAO DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        DT_ENVIO DATETIME NULL,
+        KEY IDX_EMAIL_FILA_PENDENTES (STATUS, PROXIMA_TENTATIVA),
+        KEY IDX_EMAIL_FILA_RESERVA (RESERVA)
+    )
+"""
+
+
+@migracao
+def _migracao_email_fila(cursor):
+    cursor.execute(SQL_EMAIL_FILA)
+
+# tipo → callback(cursor, dados, entregue); registrados com @callback_email
+EMAIL_CALLBACKS = {}
+
+_envio_emails_evento = threading.Event()
+_envio_emails_lock = threading.Lock()
+_envio_emails_iniciado = False
+
+# Métricas de envio deste processo (ver /api/diagnostico/fila-email)
+_metricas_email = {
+    'conexoes': 0,
+    'mensagens': 0,
+    'falhas': 0,
+    'segundos_conexao': 0.0,   # abertura + TLS + login
+    'segundos_envio': 0.0,
+    'desde': time.time()
+}
+_metricas_email_lock = threading.Lock()
+
+
+def callback_email(tipo):
+    """
+    Registra o callback de status de entrega de um tipo de email
+    
+    O callback recebe (cursor, dados, entregue) e roda na mesma transação que
+    marca a mensagem como ENVIADO (entregue=True) ou FALHA definitiva
+    (entregue=False). Pode retornar uma função chamada após o commit
+    (WebSocket, invalidação de cache).
+    """
+    def decorator(f):
+        EMAIL_CALLBACKS[tipo] = f
+        return f
+    return decorator
+
+
+def enfileirar_email(cursor, msg, tipo, dados=None):
+    """
+    Grava a mensagem na fila de envio
+    
+    Não faz commit: entra na transação de quem chama. Após o commit, chamar
+    acordar_envio_emails() para o envio não esperar o próximo ciclo.
+    
+    Returns:
+        int: ID da mensagem em EMAIL_FILA
+    """
+    remetente = msg.sender if isinstance(msg.sender, str) else formataddr(msg.sender)
+    destinatarios = [parseaddr(d)[1] or d for d in msg.send_to]
+    cursor.execute("""
+        INSERT INTO EMAIL_FILA (TIPO, DADOS, REMETENTE, DESTINATARIOS, MENSAGEM)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (tipo, json.dumps(dados or {}, default=str), parseaddr(remetente)[1],
+          ', '.join(destinatarios), msg.as_bytes()))
+    return cursor.lastrowid
+
+
+def acordar_envio_emails():
+    """Garante a tarefa de envio rodando e a acorda para processar a fila já"""
+    iniciar_envio_emails()
+    _envio_emails_evento.set()
+
+
+def iniciar_envio_emails():
+    """Inicia (uma vez por processo) a tarefa de envio em segundo plano"""
+    global _envio_emails_iniciado
+    with _envio_emails_lock:
+        if _envio_emails_iniciado:
+            return
+        _envio_emails_iniciado = True
+    socketio.start_background_task(_laco_envio_emails)
+
+
+def _laco_envio_emails():
+    """Processa a fila enquanto houver mensagens; sem elas, espera o intervalo ou um novo email"""
+    print(f"📬 Envio de emails em segundo plano iniciado (pid {os.getpid()})")
+    conexao = ConexaoSMTP()  # mesma sessão SMTP enquanto a fila tiver mensagens
+    while True:
+        try:
+            with app.app_context():
+                if ESQUEMA_AUTOMATICO:
+                    garantir_esquema()  # EMAIL_FILA (já feito pela requisição que subiu a tarefa)
+                processadas = processar_fila_emails(conexao=conexao)
+        except Exception as e:
+            print(f"❌ Erro no envio de emails: {e}")
+            processadas = 0
+        
+        if processadas < EMAIL_LOTE:  # fila vazia (ou erro): encerrar a sessão e aguardar
+            conexao.fechar()
+            _envio_emails_evento.wait(EMAIL_INTERVALO)
+            _envio_emails_evento.clear()
+
+
+def _concluir_email(cursor, id_fila, tipo, dados, entregue, status, atualizacao, parametros):
+    """Chama o callback do tipo e grava o novo status na mesma transação"""
+    pos_commit = None
+    callback = EMAIL_CALLBACKS.get(tipo)
+    try:
+        if callback:
+            pos_commit = callback(cursor, json.loads(dados or '{}'), entregue)
+        cursor.execute(f"UPDATE EMAIL_FILA SET STATUS = %s, RESERVA = NULL, {atualizacao} WHERE ID = %s",
+                       (status, *parametros, id_fila))
+        mysql.connection.commit()
+    except Exception as e:
+        # O email já saiu (ou falhou de vez): não volta para a fila por erro no registro
+        mysql.connection.rollback()
+        print(f"❌ Callback do email {id_fila} ({tipo}): {e}")
+        cursor.execute(f"UPDATE EMAIL_FILA SET STATUS = %s, RESERVA = NULL, {atualizacao}, ULTIMO_ERRO = %s WHERE ID = %s",
+                       (status, *parametros, f"callback: {e}", id_fila))
+        mysql.connection.commit()
+        return
+    
+    if pos_commit:
+        try:
+            pos_commit()
+        except Exception as e:
+            print(f"⚠️ Pós-envio do email {id_fila} ({tipo}): {e}")
+
+
+def registrar_entrega_email(cursor, id_fila, tipo, dados):
+    """Marca como ENVIADO (libera o conteúdo MIME) e chama o callback"""
+    _concluir_email(cursor, id_fila, tipo, dados, True, 'ENVIADO',
+                    "DT_ENVIO = NOW(), MENSAGEM = ''", ())
+    print(f"📧 Email {id_fila} ({tipo}) enviado")
+
+
+def registrar_falha_email(cursor, id_fila, tipo, dados, tentativas, erro):
+    """Devolve para a fila com espera exponencial; esgotadas as tentativas, FALHA"""
+    if tentativas >= EMAIL_TENTATIVAS_MAX:
+        _concluir_email(cursor, id_fila, tipo, dados, False, 'FALHA',
+                        "TENTATIVAS = %s, ULTIMO_ERRO = %s", (tentativas, str(erro)))
+        print(f"❌ Email {id_fila} ({tipo}) descartado após {tentativas} tentativa(s): {erro}")
+        return
+    
+    espera = min(EMAIL_ESPERA_INICIAL * 2 ** (tentativas - 1), EMAIL_ESPERA_MAXIMA)
+    cursor.execute("""
+        UPDATE EMAIL_FILA
+        SET STATUS = 'PENDENTE', RESERVA = NULL, TENTATIVAS = %s, ULTIMO_ERRO = %s,
+            PROXIMA_TENTATIVA = NOW() + INTERVAL %s SECOND
+        WHERE ID = %s
+    """, (tentativas, str(erro), espera, id_fila))
+    mysql.connection.commit()
+    print(f"⚠️ Email {id_fila} ({tipo}) falhou ({erro}); nova tentativa em {espera}s")
+
+
+def _somar_metricas_email(**valores):
+    with _metricas_email_lock:
+        for chave, valor in valores.items():
+            _metricas_email[chave] += valor
+
+
+def estatisticas_envio_emails():
+    """Vazão do envio de emails deste processo"""
+    with _metricas_email_lock:
+        m = dict(_metricas_email)
+    segundos = m['segundos_conexao'] + m['segundos_envio']
+    return {
+        'conexoes': m['conexoes'],
+        'mensagens': m['mensagens'],
+        'falhas': m['falhas'],
+        'mensagens_por_conexao': m['mensagens'] / m['conexoes'] if m['conexoes'] else 0.0,
+        'conexao_media_ms': m['segundos_conexao'] * 1000 / m['conexoes'] if m['conexoes'] else 0.0,
+        'envio_medio_ms': m['segundos_envio'] * 1000 / m['mensagens'] if m['mensagens'] else 0.0,
+        'mensagens_por_segundo': m['mensagens'] / segundos if segundos else 0.0,
+        'maximo_por_conexao': EMAIL_POR_CONEXAO,
+        'desde': datetime.fromtimestamp(m['desde']).isoformat()
+    }
+
+
+class ConexaoSMTP:
+    """
+    Sessão SMTP (Flask-Mail mail.connect()) reaproveitada entre lotes da fila
+    
+    Aberta no primeiro envio e renovada a cada `maximo` mensagens (servidores
+    costumam limitar mensagens por sessão). Quem cria chama fechar() quando a
+    fila esvazia. Se uma sessão reaproveitada tiver sido derrubada pelo
+    servidor (ociosa entre lotes), o envio é repetido uma vez numa sessão nova.
+    """
+    
+    def __init__(self, maximo=EMAIL_POR_CONEXAO):
+        self.maximo = maximo
+        self.enviadas = 0
+        self._conexao = None
+    
+    @staticmethod
+    def _sessao_caiu(erro):
+        """Erro de sessão encerrada pelo servidor (não é recusa da mensagem)"""
+        if isinstance(erro, (smtplib.SMTPServerDisconnected, ConnectionError)):
+            return True
+        # 421: servidor encerrando a sessão (ex: timeout de ociosidade)
+        return isinstance(erro, smtplib.SMTPResponseException) and erro.smtp_code == 421
+    
+    def enviar(self, remetente, destinatarios, conteudo):
+        reaproveitada = self._conexao is not None
+        try:
+            self._enviar(remetente, destinatarios, conteudo)
+        except (smtplib.SMTPException, ConnectionError) as e:
+            if not (reaproveitada and self._sessao_caiu(e)):
+                raise
+            print(f"🔌 Sessão SMTP reaproveitada caiu ({e}); reenviando em sessão nova")
+            self.fechar()
+            self._enviar(remetente, destinatarios, conteudo)
+    
+    def _enviar(self, remetente, destinatarios, conteudo):
+        if self._conexao is None:
+            inicio = time.perf_counter()
+            conexao = mail.connect()
+            conexao.__enter__()
+            self._conexao = conexao
+            _somar_metricas_email(conexoes=1, segundos_conexao=time.perf_counter() - inicio)
+        
+        inicio = time.perf_counter()
+        if self._conexao.host:  # None com MAIL_SUPPRESS_SEND (testes)
+            self._conexao.host.sendmail(remetente, destinatarios, conteudo)
+        self.enviadas += 1
+        _somar_metricas_email(mensagens=1, segundos_envio=time.perf_counter() - inicio)
+        
+        if self.maximo and self.enviadas >= self.maximo:
+            self.fechar()
+    
+    def fechar(self):
+        if self._conexao is None:
+            return
+        try:
+            self._conexao.__exit__(None, None, None)  # QUIT
+        except Exception:
+            pass  # conexão já caída
+        self._conexao = None
+        self.enviadas = 0
+
+
+def concluir_entregas_pendentes(cursor, reserva):
+    """Refaz o registro (callback + ENVIADO) de emails já enviados cujo registro falhou"""
+    cursor.execute("""
+        UPDATE EMAIL_FILA SET RESERVA = %s, DT_RESERVA = NOW()
+        WHERE STATUS = 'ENVIANDO' AND DT_ENVIO IS NOT NULL AND DT_RESERVA < NOW() - INTERVAL %s SECOND
+    """, (reserva, EMAIL_RESERVA_EXPIRA))
+    mysql.connection.commit()
+    if not cursor.rowcount:
+        return
+    
+    cursor.execute("SELECT ID, TIPO, DADOS FROM EMAIL_FILA WHERE RESERVA = %s AND DT_ENVIO IS NOT NULL", (reserva,))
+    for id_fila, tipo, dados in cursor.fetchall():
+        print(f"🔁 Email {id_fila} ({tipo}) já enviado: refazendo o registro da entrega")
+        registrar_entrega_email(cursor, id_fila, tipo, dados)
+
+
+def processar_fila_emails(lote=EMAIL_LOTE, conexao=None):
+    """
+    Reserva um lote de mensagens vencidas e envia pela conexão SMTP
+    
+    A reserva (UPDATE ... LIMIT com um token) permite vários processos
+    consumindo a mesma fila sem enviar a mesma mensagem duas vezes.
+    
+    Logo após o sendmail a mensagem recebe DT_ENVIO num commit próprio: se o
+    registro da entrega (callback + ENVIADO) falhar, a reserva vencida não
+    volta para PENDENTE (o que reenviaria o email); só o registro é refeito.
+    
+    Args:
+        conexao (ConexaoSMTP, optional): sessão reaproveitada entre chamadas;
+                                         sem ela, uma sessão só para este lote
+    
+    Returns:
+        int: quantidade de mensagens reservadas
+    """
+    if conexao is None:
+        conexao = ConexaoSMTP()
+        try:
+            return processar_fila_emails(lote, conexao)
+        finally:
+            conexao.fechar()
+    
+    reserva = uuid.uuid4().hex
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute("""
+            UPDATE EMAIL_FILA SET STATUS = 'PENDENTE', RESERVA = NULL
+            WHERE STATUS = 'ENVIANDO' AND DT_ENVIO IS NULL AND DT_RESERVA < NOW() - INTERVAL %s SECOND
+        """, (EMAIL_RESERVA_EXPIRA,))
+        concluir_entregas_pendentes(cursor, reserva)
+        
+        cursor.execute("""
+            UPDATE EMAIL_FILA SET STATUS = 'ENVIANDO', RESERVA = %s, DT_RESERVA = NOW()
+            WHERE STATUS = 'PENDENTE' AND PROXIMA_TENTATIVA <= NOW()
+            ORDER BY ID
+            LIMIT %s
+        """, (reserva, lote))
+        mysql.connection.commit()
+        
+        cursor.execute("""
+            SELECT ID, TIPO, DADOS, REMETENTE, DESTINATARIOS, MENSAGEM, TENTATIVAS
+            FROM EMAIL_FILA WHERE RESERVA = %s ORDER BY ID
+        """, (reserva,))
+        mensagens = list(cursor.fetchall())
+        if not mensagens:
+            return 0
+        
+        pendentes = list(mensagens)
+        try:
+            while pendentes:
+                id_fila, tipo, dados, remetente, destinatarios, conteudo, tentativas = pendentes[0]
+                try:
+                    conexao.enviar(remetente, [d.strip() for d in destinatarios.split(',')], bytes(conteudo))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    # Recusa desta mensagem; a sessão continua válida para as outras
+                    pendentes.pop(0)
+                    _somar_metricas_email(falhas=1)
+                    registrar_falha_email(cursor, id_fila, tipo, dados, tentativas + 1, e)
+                    continue
+                pendentes.pop(0)
+                # Marca de enviado antes do callback: daqui em diante nunca reenviar
+                cursor.execute("UPDATE EMAIL_FILA SET DT_ENVIO = NOW() WHERE ID = %s", (id_fila,))
+                mysql.connection.commit()
+                registrar_entrega_email(cursor, id_fila, tipo, dados)
+        except Exception as e:
+            # Conexão não abriu ou caiu: descartá-la; o restante do lote volta para a fila
+            conexao.fechar()
+            _somar_metricas_email(falhas=len(pendentes))
+            for id_fila, tipo, dados, _, _, _, tentativas in pendentes:
+                registrar_falha_email(cursor, id_fila, tipo, dados, tentativas + 1, e)
+        
+        return len(mensagens)
+    finally:
+        cursor.close()
+
+
+@app.before_request
+def _garantir_envio_emails():
+    """Sobe a tarefa de envio na primeira requisição do processo (após o fork do servidor)"""
+    if not _envio_emails_iniciado:
+        iniciar_envio_emails()
+
+
+# ============================================================
+# CONFIGURAÇÃO DO WEBSOCKET (Flask-SocketIO)
+# ============================================================
+# Modo definido por ASYNC_MODE (ver MODO ASSÍNCRONO no topo do arquivo)
+#
+# ESCALA HORIZONTAL (vários workers/instâncias):
+#   1. SOCKETIO_MESSAGE_QUEUE=redis://host:6379/0
+#      → emits de qualquer worker chegam aos clientes de todos os workers
+#        e a presença (usuários conectados) passa para o mesmo Redis
+#   2. CACHE_TYPE=RedisCache e CACHE_REDIS_URL=redis://host:6379/1
+#      → check-updates e invalidação de snapshots da agenda compartilhados
+#   3. Socket.IO exige sessão fixa (sticky): rodar N instâncias de
+#      `gunicorn --worker-class eventlet -w 1 app:app` em portas diferentes
+#      atrás de um nginx com `ip_hash` (o -w N do gunicorn não é sticky)
+#   Os tokens de /api/agenda/delta são por processo: trocar de instância
+#   apenas força uma recarga completa da semana.
+#   Testado em tests/test_redis_multiworker.py (dois processos + fakeredis).
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*", 
-    async_mode='threading',  # ✅ Threading = estável + debug funciona!
+    message_queue=SOCKETIO_MESSAGE_QUEUE,  # None = processo único
+    async_mode=ASYNC_MODE,  # threading (dev) | eventlet | gevent
     ping_timeout=60,
     ping_interval=25,
     logger=True,            # Ver logs para debug
@@ -135,17 +1059,870 @@ socketio = SocketIO(
 
 
 # ============================================================
-# DADOS EXTERNOS
+# DADOS EXTERNOS
+# ============================================================
+# Carregar dados dos aeroportos (código IATA)
+airports = airportsdata.load('IATA')
+
+
+# ============================================================
+# ARMAZENAMENTO DE ARQUIVOS (BLOB STORE)
+# ============================================================
+# Arquivos grandes (fotos de vistoria) ficam fora do MySQL, endereçados pelo
+# SHA-256 do conteúdo: o banco guarda apenas hash, tamanho e tipo.
+#   BLOB_STORE=local → diretório BLOB_STORE_DIR, fatiado em ab/cd/<hash>
+#   BLOB_STORE=s3    → bucket BLOB_STORE_BUCKET em qualquer serviço compatível
+#                      com S3 (AWS, MinIO local via BLOB_STORE_ENDPOINT)
+# Fora do modo debug a configuração é obrigatória: o padrão antigo (pasta
+# blobstore/ no código) é apagado a cada restart no Heroku e é somente leitura
+# na Vercel, e `flask migrar-fotos` remove a única cópia do banco.
+BLOB_STORE = os.getenv('BLOB_STORE', 'local')
+BLOB_CHUNK = 64 * 1024
+
+
+def _copiar_com_hash(origem, destino):
+    """Copia o stream calculando o SHA-256; retorna (hash, tamanho)"""
+    sha = hashlib.sha256()
+    tamanho = 0
+    while True:
+        bloco = origem.read(BLOB_CHUNK)
+        if not bloco:
+            break
+        sha.update(bloco)
+        destino.write(bloco)
+        tamanho += len(bloco)
+    return sha.hexdigest(), tamanho
+
+
+class BlobStoreLocal:
+    """Arquivos em disco: <raiz>/ab/cd/abcd...(hash completo)"""
+    
+    def __init__(self, raiz):
+        self.raiz = raiz
+        self.tmp = os.path.join(raiz, 'tmp')
+    
+    def _caminho(self, chave):
+        return os.path.join(self.raiz, chave[:2], chave[2:4], chave)
+    
+    def gravar(self, stream):
+        """Grava o conteúdo do stream; retorna (hash, tamanho). Conteúdo repetido não duplica"""
+        os.makedirs(self.tmp, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.tmp, delete=False) as temporario:
+            chave, tamanho = _copiar_com_hash(stream, temporario)
+        
+        caminho = self._caminho(chave)
+        if os.path.exists(caminho):
+            os.remove(temporario.name)
+        else:
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            os.replace(temporario.name, caminho)  # Atômico: nunca expõe arquivo pela metade
+        return chave, tamanho
+    
+    def gravar_como(self, chave, stream):
+        """Grava sob uma chave derivada (ex: miniatura '<hash>_thumb')"""
+        os.makedirs(self.tmp, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.tmp, delete=False) as temporario:
+            shutil.copyfileobj(stream, temporario, BLOB_CHUNK)
+        
+        caminho = self._caminho(chave)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        os.replace(temporario.name, caminho)
+    
+    def abrir(self, chave):
+        """Stream de leitura do arquivo (FileNotFoundError se não existir)"""
+        return open(self._caminho(chave), 'rb')
+    
+    def caminho(self, chave):
+        """Caminho no disco (permite send_file com Range); FileNotFoundError se não existir"""
+        caminho = self._caminho(chave)
+        if not os.path.exists(caminho):
+            raise FileNotFoundError(chave)
+        return caminho
+    
+    def existe(self, chave):
+        return os.path.exists(self._caminho(chave))
+    
+    def remover(self, chave):
+        try:
+            os.remove(self._caminho(chave))
+        except FileNotFoundError:
+            pass
+
+
+class BlobStoreS3:
+    """Bucket compatível com S3: objetos em <prefixo><hash>"""
+    
+    def __init__(self, bucket, prefixo='', endpoint_url=None):
+        import boto3  # Necessário apenas com BLOB_STORE=s3
+        from botocore.exceptions import ClientError
+        
+        self.s3 = boto3.client('s3', endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefixo = prefixo
+        self.ClientError = ClientError
+    
+    def gravar(self, stream):
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as temporario:
+            chave, tamanho = _copiar_com_hash(stream, temporario)
+            if not self.existe(chave):
+                temporario.seek(0)
+                self.s3.upload_fileobj(temporario, self.bucket, self.prefixo + chave)
+        return chave, tamanho
+    
+    def gravar_como(self, chave, stream):
+        self.s3.upload_fileobj(stream, self.bucket, self.prefixo + chave)
+    
+    def abrir(self, chave):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=self.prefixo + chave)['Body']
+        except self.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(chave)
+            raise
+    
+    def caminho(self, chave):
+        """Objetos remotos não têm caminho local: usar abrir()"""
+        return None
+    
+    def existe(self, chave):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self.prefixo + chave)
+            return True
+        except self.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+    
+    def remover(self, chave):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefixo + chave)
+
+
+def criar_blob_store():
+    """Blob store configurado no ambiente; sem configuração, falha na subida (exceto em debug)"""
+    if BLOB_STORE == 's3':
+        if not os.getenv('BLOB_STORE_BUCKET'):
+            raise RuntimeError("BLOB_STORE=s3 exige BLOB_STORE_BUCKET")
+        return BlobStoreS3(
+            os.getenv('BLOB_STORE_BUCKET'),
+            prefixo=os.getenv('BLOB_STORE_PREFIXO', ''),
+            endpoint_url=os.getenv('BLOB_STORE_ENDPOINT')
+        )
+    
+    if BLOB_STORE != 'local':
+        raise RuntimeError(f"BLOB_STORE={BLOB_STORE} desconhecido (use: local, s3)")
+    
+    raiz = os.getenv('BLOB_STORE_DIR')
+    if not raiz:
+        if not (app.debug or __name__ == '__main__'):
+            raise RuntimeError(
+                "Defina BLOB_STORE_DIR (volume persistente) ou BLOB_STORE=s3: "
+                "a pasta do código é apagada no restart (Heroku) ou somente leitura (Vercel)"
+            )
+        raiz = os.path.join(app.root_path, 'blobstore')
+        print(f"⚠️ BLOB_STORE_DIR não definido - usando {raiz} (apenas desenvolvimento)")
+    
+    os.makedirs(raiz, exist_ok=True)
+    if not os.access(raiz, os.W_OK):
+        raise RuntimeError(f"BLOB_STORE_DIR sem permissão de escrita: {raiz}")
+    return BlobStoreLocal(raiz)
+
+
+blob_store = criar_blob_store()
+
+
+def detectar_mime_imagem(cabecalho):
+    """Tipo da imagem pelos primeiros bytes (padrão: JPEG, como era servido antes)"""
+    if cabecalho.startswith(b'\x89PNG'):
+        return 'image/png'
+    if cabecalho[:4] == b'RIFF' and cabecalho[8:12] == b'WEBP':
+        return 'image/webp'
+    if cabecalho.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if cabecalho[4:12] == b'ftypavif':
+        return 'image/avif'
+    return 'image/jpeg'
+
+
+# Tamanhos servidos por /get_foto/<id>?size=... (maior lado em pixels)
+FOTO_TAMANHOS = {
+    'thumb': int(os.getenv('FOTO_THUMB_PX', 400)),    # grade de fotos
+    'medium': int(os.getenv('FOTO_MEDIUM_PX', 1280))  # visualização ampliada
+}
+FOTO_DERIVADO_QUALIDADE = int(os.getenv('FOTO_DERIVADO_QUALIDADE', 80))
+
+
+def gerar_derivado_foto(foto_hash, tamanho, abrir_original):
+    """
+    Retorna a chave da versão reduzida da foto, gerando-a na primeira vez
+    
+    Derivados são guardados no blob store como '<hash>_<tamanho>': o mesmo
+    conteúdo sempre gera o mesmo derivado, então nunca precisam ser invalidados.
+    
+    Args:
+        abrir_original: função que retorna um stream da imagem original
+    
+    Returns:
+        str | None: Chave do derivado, ou None se o Pillow não decodifica o
+                    original (formato desconhecido, arquivo truncado ou
+                    dimensões acima do limite de decompression bomb)
+    """
+    chave = f'{foto_hash}_{tamanho}'
+    if blob_store.existe(chave):
+        return chave
+    if cache.get(f'derivado_invalido:{foto_hash}'):
+        return None
+    
+    lado = FOTO_TAMANHOS[tamanho]
+    
+    def reduzir(chave):
+        """Decodifica, reduz e grava o derivado (no pool de threads: não trava o hub)"""
+        with abrir_original() as origem:
+            try:
+                original = Image.open(origem)
+                original.draft('RGB', (lado, lado))  # JPEG: decodifica já reduzido
+                imagem = ImageOps.exif_transpose(original)  # Fotos de celular vêm "deitadas" via EXIF
+                if imagem.mode != 'RGB':
+                    imagem = imagem.convert('RGB')
+                imagem.thumbnail((lado, lado), Image.LANCZOS)
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+                print(f"⚠️ Derivado {tamanho} impossível para {foto_hash[:12]}: {e}")
+                return None
+        
+        saida = BytesIO()
+        imagem.save(saida, 'JPEG', quality=FOTO_DERIVADO_QUALIDADE, optimize=True, progressive=True)
+        saida.seek(0)
+        blob_store.gravar_como(chave, saida)
+        return saida.getbuffer().nbytes
+    
+    bytes_derivado = mapear_em_threads(reduzir, [chave])[0]
+    if bytes_derivado is None:
+        # O conteúdo nunca muda: não tentar decodificar de novo a cada requisição
+        cache.set(f'derivado_invalido:{foto_hash}', True, timeout=86400)
+        return None
+    
+    print(f"🖼️ Derivado {tamanho} gerado: {foto_hash[:12]} ({bytes_derivado / 1024:.0f} KB)")
+    return chave
+
+
+# Normalização no upload: orientação EXIF aplicada, metadados removidos,
+# maior lado limitado e recompressão no formato configurado
+FOTO_MAX_PX = int(os.getenv('FOTO_MAX_PX', 2048))
+FOTO_QUALIDADE = int(os.getenv('FOTO_QUALIDADE', 82))
+FOTO_WORKERS = int(os.getenv('FOTO_WORKERS', 4))
+
+FOTO_FORMATOS_MIME = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'AVIF': 'image/avif'}
+FOTO_FORMATO = os.getenv('FOTO_FORMATO', 'JPEG').upper()  # JPEG | WEBP | AVIF
+
+
+def codec_disponivel(formato):
+    """Codifica uma imagem mínima no formato (o plugin pode existir sem o encoder funcionar)"""
+    if formato != 'JPEG' and not features.check(formato.lower()):
+        return False
+    try:
+        Image.new('RGB', (8, 8)).save(BytesIO(), formato, quality=FOTO_QUALIDADE)
+        return True
+    except Exception:
+        return False
+
+
+if FOTO_FORMATO not in FOTO_FORMATOS_MIME or not codec_disponivel(FOTO_FORMATO):
+    print(f"⚠️ FOTO_FORMATO={FOTO_FORMATO} indisponível neste Pillow - usando JPEG")
+    FOTO_FORMATO = 'JPEG'
+
+_pool_imagens = None
+_pool_imagens_lock = threading.Lock()
+
+
+def mapear_em_threads(funcao, itens):
+    """
+    Aplica `funcao` a cada item em threads reais do SO, mantendo a ordem
+    
+    O Pillow libera o GIL ao decodificar/redimensionar/codificar, então as
+    fotos são processadas em paralelo. Com eventlet/gevent as threads do
+    threading são verdes: usa-se o pool de threads nativo de cada um.
+    """
+    if ASYNC_MODE == 'eventlet':
+        from eventlet import GreenPool, tpool
+        return list(GreenPool(FOTO_WORKERS).imap(lambda item: tpool.execute(funcao, item), itens))
+    
+    if ASYNC_MODE == 'gevent':
+        from gevent import get_hub
+        pool = get_hub().threadpool
+        return [tarefa.get() for tarefa in [pool.spawn(funcao, item) for item in itens]]
+    
+    global _pool_imagens
+    with _pool_imagens_lock:
+        if _pool_imagens is None:
+            _pool_imagens = ThreadPoolExecutor(FOTO_WORKERS, thread_name_prefix='imagens')
+    return list(_pool_imagens.map(funcao, itens))
+
+
+def codificar_foto(imagem):
+    """
+    Codifica no FOTO_FORMATO; se o encoder falhar nesta foto, grava em JPEG
+    
+    Returns:
+        tuple: (BytesIO no início, formato usado)
+    """
+    # Sem exif=/icc_profile=: metadados (GPS, modelo do aparelho...) não são copiados
+    if FOTO_FORMATO != 'JPEG':
+        saida = BytesIO()
+        try:
+            imagem.save(saida, FOTO_FORMATO, quality=FOTO_QUALIDADE)
+            saida.seek(0)
+            return saida, FOTO_FORMATO
+        except Exception as e:
+            print(f"⚠️ Codificação {FOTO_FORMATO} falhou ({str(e)}) - foto gravada em JPEG")
+    
+    saida = BytesIO()
+    imagem.save(saida, 'JPEG', quality=FOTO_QUALIDADE, optimize=True, progressive=True)
+    saida.seek(0)
+    return saida, 'JPEG'
+
+
+def normalizar_foto(origem):
+    """
+    Prepara a foto para armazenamento (executada no pool de threads)
+    
+    Args:
+        origem: stream posicionável do upload; é decodificado direto dele,
+                sem copiar o arquivo inteiro para a memória
+    
+    Returns:
+        tuple: (stream_para_gravar, mime, largura, altura). Se o Pillow não
+               abrir o arquivo (ex: HEIC), o próprio original (rebobinado) é
+               mantido e as dimensões ficam None.
+    """
+    try:
+        with Image.open(origem) as original:
+            imagem = ImageOps.exif_transpose(original)
+            if imagem.mode != 'RGB':
+                imagem = imagem.convert('RGB')
+            imagem.thumbnail((FOTO_MAX_PX, FOTO_MAX_PX), Image.LANCZOS)
+            saida, formato = codificar_foto(imagem)
+        return saida, FOTO_FORMATOS_MIME[formato], imagem.width, imagem.height
+    except Exception as e:
+        print(f"⚠️ Foto mantida sem normalização: {str(e)}")
+        origem.seek(0)
+        mime = detectar_mime_imagem(origem.read(16))
+        largura, altura = dimensoes_imagem(origem)
+        origem.seek(0)
+        return origem, mime, largura, altura
+
+
+def dimensoes_imagem(dados):
+    """
+    Lê (largura, altura) só do cabeçalho da imagem; (None, None) se não reconhecer
+    
+    Args:
+        dados: bytes ou stream posicionável
+    """
+    try:
+        if isinstance(dados, bytes):
+            dados = BytesIO(dados)
+        dados.seek(0)
+        with Image.open(dados) as imagem:
+            return imagem.size
+    except Exception:
+        return None, None
+
+
+def gravar_fotos_vistoria(arquivos):
+    """
+    Normaliza as fotos do formulário em paralelo e grava no blob store
+    
+    Cada foto vai do arquivo do upload (FileStorage.stream, que o Werkzeug
+    já guarda em arquivo temporário) ao blob store dentro do worker: no
+    máximo FOTO_WORKERS fotos ficam decodificadas em memória ao mesmo tempo,
+    qualquer que seja o tamanho do formulário.
+    
+    Args:
+        arquivos: FileStorage ou arquivos abertos em modo binário
+    
+    Returns:
+        list: um item por arquivo (mesma ordem, para parear com detalhamentos[]):
+              {'hash', 'tamanho', 'tamanho_original', 'mime', 'largura', 'altura'}
+              ou None se vazio
+    
+    Raises:
+        Falha do blob store (disco cheio, S3...): quem salva a vistoria desfaz
+        a transação em vez de gravá-la sem a foto
+    """
+    def processar(indice_arquivo):
+        i, arquivo = indice_arquivo
+        if not arquivo:
+            return None
+        origem = getattr(arquivo, 'stream', arquivo)
+        origem.seek(0, os.SEEK_END)
+        tamanho_original = origem.tell()
+        origem.seek(0)
+        if not tamanho_original:
+            return None
+        
+        dados, mime, largura, altura = normalizar_foto(origem)
+        try:
+            chave, tamanho = blob_store.gravar(dados)
+        except Exception as e:
+            # Propaga: a vistoria não pode ser gravada sem a foto
+            print(f"❌ Erro ao gravar foto {i}: {str(e)}")
+            raise
+        
+        return {
+            'hash': chave,
+            'tamanho': tamanho,
+            'tamanho_original': tamanho_original,
+            'mime': mime,
+            'largura': largura,
+            'altura': altura
+        }
+    
+    t0 = time.time()
+    fotos = mapear_em_threads(processar, list(enumerate(arquivos)))
+    
+    gravadas = [f for f in fotos if f]
+    if gravadas:
+        antes = sum(f['tamanho_original'] for f in gravadas) / 1024 / 1024
+        depois = sum(f['tamanho'] for f in gravadas) / 1024 / 1024
+        print(f"📸 {len(gravadas)} foto(s) normalizada(s) em {time.time() - t0:.2f}s: "
+              f"{antes:.1f} MB → {depois:.1f} MB")
+    
+    return fotos
+
+
+# Linhas por executemany ao inserir itens (uploads muito grandes em vários lotes)
+VISTORIA_ITENS_LOTE = int(os.getenv('VISTORIA_ITENS_LOTE', 100))
+
+
+def inserir_itens_vistoria(cursor, id_vistoria, fotos_gravadas, detalhamentos):
+    """
+    Insere os itens (fotos já gravadas no blob store) com executemany
+    
+    Não faz commit: roda na mesma transação da vistoria. A posição i de
+    fotos_gravadas corresponde a detalhamentos[i] (fotos None são puladas).
+    
+    Returns:
+        int: quantidade de itens inseridos
+    """
+    linhas = [
+        (id_vistoria, foto['hash'], foto['tamanho'], foto['tamanho_original'], foto['mime'],
+         foto.get('largura'), foto.get('altura'),
+         detalhamentos[i] if i < len(detalhamentos) else '')
+        for i, foto in enumerate(fotos_gravadas) if foto
+    ]
+    
+    for inicio in range(0, len(linhas), VISTORIA_ITENS_LOTE):
+        cursor.executemany(
+            """INSERT INTO VISTORIA_ITENS
+               (IDVISTORIA, FOTO_HASH, FOTO_TAMANHO, FOTO_TAMANHO_ORIGINAL, FOTO_MIME,
+                FOTO_LARGURA, FOTO_ALTURA, DETALHAMENTO)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+            linhas[inicio:inicio + VISTORIA_ITENS_LOTE]
+        )
+    
+    return len(linhas)
+
+
+# ============================================================
+# UPLOAD RETOMÁVEL (FOTOS DE VISTORIA)
+# ============================================================
+# Protocolo (inspirado no tus):
+#   POST  /api/uploads                     {tamanho, nome} → {upload_id, offset}
+#   GET   /api/uploads/<id>                → {offset} (retomar após queda)
+#   PATCH /api/uploads/<id>                Upload-Offset + bytes do pedaço
+#   POST  /api/uploads/<id>/finalizar      → normaliza, grava no blob store → {midia_id}
+# Depois, salvar_vistoria/salvar_vistoria3 recebem midias[] no lugar de fotos[].
+# Estado em <dir>/<id>.part (bytes) e <id>.json (metadados); com vários
+# servidores, UPLOAD_RETOMAVEL_DIR deve ser um diretório compartilhado.
+UPLOAD_RETOMAVEL_DIR = os.getenv('UPLOAD_RETOMAVEL_DIR', os.path.join(tempfile.gettempdir(), 'sot_uploads'))
+UPLOAD_PEDACO_MAX = int(os.getenv('UPLOAD_PEDACO_MAX', 1024 * 1024))       # bytes por PATCH
+UPLOAD_TAMANHO_MAX = int(os.getenv('UPLOAD_TAMANHO_MAX', 40 * 1024 * 1024))  # bytes por arquivo
+UPLOAD_VALIDADE = int(os.getenv('UPLOAD_VALIDADE', 24 * 3600))             # segundos
+
+uploads_locks = {}
+uploads_locks_guarda = threading.Lock()
+
+
+def _caminhos_upload(upload_id):
+    """(arquivo .part, arquivo .json) ou None se o id for inválido"""
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+        return None
+    base = os.path.join(UPLOAD_RETOMAVEL_DIR, upload_id)
+    return base + '.part', base + '.json'
+
+
+def _lock_upload(upload_id):
+    with uploads_locks_guarda:
+        return uploads_locks.setdefault(upload_id, threading.Lock())
+
+
+def dono_upload():
+    """Quem pode usar o upload: usuário logado ou a vistoria em confirmação"""
+    if session.get('usuario_login'):
+        return session['usuario_login']
+    if session.get('vistoria_id'):
+        return f"vistoria:{session['vistoria_id']}"
+    return None
+
+
+def ler_upload(upload_id):
+    """Metadados do upload (None se não existir ou pertencer a outra sessão)"""
+    caminhos = _caminhos_upload(upload_id)
+    if not caminhos or not os.path.exists(caminhos[1]):
+        return None
+    with open(caminhos[1], encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('dono') != dono_upload():
+        return None
+    return meta
+
+
+def gravar_meta_upload(upload_id, meta):
+    caminho_json = _caminhos_upload(upload_id)[1]
+    with open(caminho_json + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(caminho_json + '.tmp', caminho_json)
+
+
+def remover_upload(upload_id):
+    for caminho in _caminhos_upload(upload_id):
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+    with uploads_locks_guarda:
+        uploads_locks.pop(upload_id, None)
+
+
+def limpar_uploads_expirados():
+    """
+    Remove uploads abandonados (chamado a cada novo upload)
+    
+    A validade conta do .json, renovado a cada PATCH: um upload em andamento
+    não expira. Expirado, o upload sai inteiro (.part, .json e a trava).
+    """
+    limite = time.time() - UPLOAD_VALIDADE
+    try:
+        nomes = os.listdir(UPLOAD_RETOMAVEL_DIR)
+    except FileNotFoundError:
+        return
+    for nome in nomes:
+        caminho = os.path.join(UPLOAD_RETOMAVEL_DIR, nome)
+        upload_id = nome.split('.', 1)[0]
+        caminhos = _caminhos_upload(upload_id)
+        try:
+            if os.path.getmtime(caminho) >= limite:
+                continue
+            if caminhos and caminho != caminhos[1] and os.path.exists(caminhos[1]):
+                continue  # expira junto com o .json
+            os.remove(caminho)
+        except OSError:
+            continue
+        if caminhos:
+            remover_upload(upload_id)
+
+
+def obter_midias_vistoria(midia_ids):
+    """
+    Converte midias[] (uploads finalizados desta sessão) no formato de gravar_fotos_vistoria
+    
+    Returns:
+        list: mesma ordem de midia_ids, None para id inválido/não finalizado
+    """
+    fotos = []
+    for midia_id in midia_ids:
+        meta = ler_upload(midia_id)
+        fotos.append(meta.get('midia') if meta else None)
+    return fotos
+
+
+def consumir_midias_vistoria(midia_ids):
+    """Descarta os uploads já gravados na vistoria (as fotos ficam no blob store)"""
+    for midia_id in midia_ids:
+        if ler_upload(midia_id):
+            remover_upload(midia_id)
+
+
+# ============================================================
+# ASSINATURAS DA VISTORIA
+# ============================================================
+# As assinaturas ficam em VISTORIA_ASSINATURAS (uma linha por vistoria/tipo),
+# fora de VISTORIAS: consultas da vistoria não arrastam os BLOBs. As colunas
+# ASS_USUARIO/ASS_MOTORISTA só são lidas para registros ainda não migrados.
+ASSINATURA_COLUNAS = {'usuario': 'ASS_USUARIO', 'motorista': 'ASS_MOTORISTA'}
+ASSINATURA_CACHE_TTL = 86400   # PNG em cache por hash (conteúdo imutável)
+
+SQL_VISTORIA_ASSINATURAS = """
+    CREATE TABLE IF NOT EXISTS VISTORIA_ASSINATURAS (
+        IDVISTORIA INT NOT NULL,
+        TIPO VARCHAR(10) NOT NULL,
+        HASH CHAR(64) NOT NULL,
+        TAMANHO INT UNSIGNED NOT NULL,
+        DADOS MEDIUMBLOB NOT NULL,
+        DT_REGISTRO DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (IDVISTORIA, TIPO)
+    )
+"""
+
+
+@migracao
+def _migracao_vistoria_assinaturas(cursor):
+    cursor.execute(SQL_VISTORIA_ASSINATURAS)
+
+
+def decodificar_assinatura(data_url):
+    """Converte o data URL do canvas (data:image/png;base64,...) em bytes; None se vazio/inválido"""
+    if not data_url or ',' not in data_url:
+        return None
+    try:
+        return base64.b64decode(data_url.split(',', 1)[1])
+    except Exception as e:
+        print(f"⚠️ Erro ao decodificar assinatura: {str(e)}")
+        return None
+
+
+def _paleta_exata(imagem):
+    """
+    Mesma imagem RGBA em modo P (paleta com alfa), ou None se tiver mais de 256 cores
+    
+    Cada cor vira uma entrada da paleta, sem aproximação: ao decodificar, os
+    pixels são idênticos aos originais.
+    """
+    cores = imagem.getcolors(256)
+    if cores is None:
+        return None
+    indices = {cor: i for i, (_, cor) in enumerate(cores)}
+    
+    paleta = Image.new('P', imagem.size)
+    paleta.putdata([indices[pixel] for pixel in imagem.getdata()])
+    paleta.putpalette([canal for _, cor in cores for canal in cor[:3]])
+    paleta.info['transparency'] = bytes(cor[3] for _, cor in cores)
+    return paleta
+
+
+def compactar_assinatura(dados):
+    """
+    Recomprime o PNG do canvas sem perda (optimize e, se couber, paleta)
+    
+    O canvas manda RGBA de 32 bits com poucas cores distintas (o traço
+    antisserrilhado varia só no alfa): com até 256 cores a paleta com
+    transparência guarda os mesmos pixels em 8 bits. O resultado só é usado
+    se decodificar igual ao original e for menor; senão o PNG fica como veio.
+    """
+    try:
+        with Image.open(BytesIO(dados)) as original:
+            imagem = original.convert('RGBA')
+        
+        candidatas = [imagem]
+        paleta = _paleta_exata(imagem)
+        if paleta is not None:
+            candidatas.insert(0, paleta)
+        
+        menor = dados
+        for candidata in candidatas:
+            saida = BytesIO()
+            candidata.save(saida, 'PNG', optimize=True)
+            if saida.tell() >= len(menor):
+                continue
+            saida.seek(0)
+            with Image.open(saida) as conferida:
+                if conferida.convert('RGBA').tobytes() == imagem.tobytes():
+                    menor = saida.getvalue()
+        return menor
+    except Exception as e:
+        print(f"⚠️ Assinatura mantida sem compactação: {str(e)}")
+        return dados
+
+
+def gravar_assinatura(cursor, id_vistoria, tipo, dados):
+    """
+    Grava (ou remove, se dados for None) a assinatura na tabela lateral
+    
+    Não faz commit: roda na mesma transação da vistoria. Zera a coluna
+    legada correspondente para que o BLOB antigo não fique para trás.
+    
+    Returns:
+        int: bytes gravados (0 se removida)
+    """
+    if dados:
+        dados = compactar_assinatura(dados)
+        cursor.execute("""
+            INSERT INTO VISTORIA_ASSINATURAS (IDVISTORIA, TIPO, HASH, TAMANHO, DADOS)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE HASH = VALUES(HASH), TAMANHO = VALUES(TAMANHO),
+                                    DADOS = VALUES(DADOS), DT_REGISTRO = CURRENT_TIMESTAMP
+        """, (id_vistoria, tipo, hashlib.sha256(dados).hexdigest(), len(dados), dados))
+    else:
+        cursor.execute("DELETE FROM VISTORIA_ASSINATURAS WHERE IDVISTORIA = %s AND TIPO = %s",
+                       (id_vistoria, tipo))
+    
+    cursor.execute(f"UPDATE VISTORIAS SET {ASSINATURA_COLUNAS[tipo]} = NULL WHERE IDVISTORIA = %s",
+                   (id_vistoria,))
+    return len(dados) if dados else 0
+
+
+def sql_tem_assinatura(tipo, alias='v'):
+    """Expressão SQL 1/NULL indicando se a vistoria tem a assinatura (sem ler o BLOB)"""
+    return (f"IF({alias}.{ASSINATURA_COLUNAS[tipo]} IS NOT NULL OR EXISTS ("
+            f"SELECT 1 FROM VISTORIA_ASSINATURAS a "
+            f"WHERE a.IDVISTORIA = {alias}.IDVISTORIA AND a.TIPO = '{tipo}'), 1, NULL)")
+
+
+# ============================================================
+# CNH DOS MOTORISTAS
+# ============================================================
+# O PDF da CNH fica no blob store; CAD_MOTORISTA guarda só CNH_HASH,
+# CNH_TAMANHO e HAS_CNH, então listagens e validações nunca leem o arquivo.
+# FILE_PDF é legado: `flask migrar-cnh` move o conteúdo e zera a coluna; até
+# lá HAS_CNH = 1 também para quem só tem FILE_PDF (e CNH_HASH fica NULL).
+SQL_CAD_MOTORISTA_CNH = [
+    ("CNH_HASH", "ALTER TABLE CAD_MOTORISTA ADD COLUMN CNH_HASH CHAR(64) NULL"),
+    ("CNH_TAMANHO", "ALTER TABLE CAD_MOTORISTA ADD COLUMN CNH_TAMANHO INT UNSIGNED NULL"),
+    ("HAS_CNH", "ALTER TABLE CAD_MOTORISTA ADD COLUMN HAS_CNH TINYINT(1) NOT NULL DEFAULT 0"),
+]
+
+
+@migracao
+def _migracao_cad_motorista_cnh(cursor):
+    adicionar_colunas(cursor, 'CAD_MOTORISTA', SQL_CAD_MOTORISTA_CNH)
+    # CNHs ainda só em FILE_PDF contam como cadastradas (tabela pequena)
+    cursor.execute("UPDATE CAD_MOTORISTA SET HAS_CNH = 1 WHERE HAS_CNH = 0 AND FILE_PDF IS NOT NULL")
+
+
+def gravar_cnh(arquivo):
+    """Grava o PDF enviado (FileStorage) no blob store sem carregá-lo inteiro; retorna (hash, tamanho)"""
+    return blob_store.gravar(arquivo.stream)
+
+
+def ler_cnh_legada(id_motorista):
+    """PDF da CNH ainda em FILE_PDF (motorista não migrado); None se não houver"""
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute("SELECT FILE_PDF FROM CAD_MOTORISTA WHERE ID_MOTORISTA = %s AND FILE_PDF IS NOT NULL",
+                       (id_motorista,))
+        resultado = cursor.fetchone()
+        return resultado[0] if resultado else None
+    finally:
+        cursor.close()
+
+
+def enviar_cnh(id_motorista, as_attachment):
+    """
+    Resposta com o PDF da CNH lido do blob store (com ETag e Range)
+    
+    Motorista ainda não migrado (`flask migrar-cnh`): o PDF sai de FILE_PDF.
+    
+    Returns:
+        Response ou None se o motorista não tem CNH
+    """
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute("""
+            SELECT CNH_HASH, NOME_ARQUIVO FROM CAD_MOTORISTA
+            WHERE ID_MOTORISTA = %s AND HAS_CNH = 1
+        """, (id_motorista,))
+        resultado = cursor.fetchone()
+        if not resultado:
+            return None
+        
+        cnh_hash, nome_arquivo = resultado
+        if cnh_hash:
+            try:
+                origem = blob_store.caminho(cnh_hash) or blob_store.abrir(cnh_hash)
+            except FileNotFoundError:
+                app.logger.error(f"CNH do motorista {id_motorista}: arquivo {cnh_hash} ausente no blob store")
+                return None
+        else:
+            pdf = ler_cnh_legada(id_motorista)
+            if not pdf:
+                return None
+            origem = BytesIO(pdf)
+            cnh_hash = hashlib.sha256(pdf).hexdigest()
+    finally:
+        cursor.close()
+    
+    return send_file(
+        origem,
+        mimetype='application/pdf',
+        as_attachment=as_attachment,
+        download_name=nome_arquivo or f"cnh_motorista_{id_motorista}.pdf",
+        conditional=True,
+        etag=cnh_hash
+    )
+
+
+# ============================================================
+# VARIÁVEIS GLOBAIS DO WEBSOCKET
+# ============================================================
+# Store de conexões ativas (WebSocket) - usado quando não há Redis
+usuarios_conectados = {}  # {sid: {'usuario': 'login', 'nome': 'Nome Completo'}}
+
+# Com SOCKETIO_MESSAGE_QUEUE, a presença fica no Redis para todos os workers:
+#   hash  sot_presenca         {sid: json(info)}
+#   zset  sot_presenca_expira  {sid: expira_em} - renovado no ping; conexões de
+#                              workers que morreram expiram sozinhas
+PRESENCA_CHAVE = 'sot_presenca'
+PRESENCA_EXPIRA_CHAVE = 'sot_presenca_expira'
+PRESENCA_TTL = 90  # segundos (cliente envia ping a cada 30s)
+
+presenca_redis = None
+if SOCKETIO_MESSAGE_QUEUE:
+    import redis
+    presenca_redis = redis.Redis.from_url(SOCKETIO_MESSAGE_QUEUE, decode_responses=True)
+
+
+# ============================================================
+# CACHE DE SNAPSHOTS SEMANAIS DA AGENDA
+# ============================================================
+# Snapshot materializado do payload de /api/agenda/dados por semana (inicio, fim).
+# As rotas que alteram demandas, diárias, feriados, veículos ou motoristas
+# invalidam apenas as semanas que tocam, então a edição aparece na hora
+# e cargas repetidas da mesma semana não executam SQL.
+AGENDA_SNAPSHOT_TTL = int(os.getenv('AGENDA_SNAPSHOT_TTL', '3600'))  # segundos (rede de segurança)
+AGENDA_SNAPSHOT_MAX = int(os.getenv('AGENDA_SNAPSHOT_MAX', '104'))   # semanas em memória
+
+agenda_snapshots = {}  # {(inicio, fim): {'dados': {...}, 'criado_em': time.time()}}
+agenda_snapshots_lock = threading.Lock()
+agenda_snapshots_geracao = 0  # Incrementa a cada invalidação (evita gravar snapshot obsoleto)
+
+
+# ============================================================
+# SEQUÊNCIA DE ALTERAÇÕES DA AGENDA (DELTA)
 # ============================================================
-# Carregar dados dos aeroportos (código IATA)
-airports = airportsdata.load('IATA')
+# Cada alteração de demanda/diária recebe um número de sequência monotônico.
+# O token de versão é '<epoca>:<seq>'; a época muda a cada reinício do processo,
+# então tokens antigos forçam recarga completa em vez de perder alterações.
+AGENDA_ALTERACOES_MAX = int(os.getenv('AGENDA_ALTERACOES_MAX', '5000'))
+AGENDA_ALTERACOES_EPOCA = uuid.uuid4().hex[:8]
+
+agenda_alteracoes = deque(maxlen=AGENDA_ALTERACOES_MAX)  # [{'seq', 'entidade', 'tipo', 'id_ad', ...}]
+agenda_alteracoes_lock = threading.Lock()
+agenda_alteracoes_seq = 0
+
+# Última alteração por usuário (responde /api/agenda/check-updates sem MySQL).
+# Com o `cache` em Redis é um hash (HSET por usuário, atômico entre workers);
+# com cache local, um dict no cache protegido por agenda_alteracoes_lock.
+AGENDA_ULTIMAS_ALTERACOES_CHAVE = 'agenda_ultimas_alteracoes'  # {usuario: {'seq', 'timestamp'}}
+AGENDA_PROCESSO_INICIO = datetime.now(timezone('America/Manaus')).replace(tzinfo=None)
+AGENDA_LOG_RETENCAO_DIAS = int(os.getenv('AGENDA_LOG_RETENCAO_DIAS', '30'))
 
 
 # ============================================================
-# VARIÁVEIS GLOBAIS DO WEBSOCKET
+# CACHE DE DADOS DE REFERÊNCIA (setores, tipos, categorias...)
 # ============================================================
-# Store de conexões ativas (WebSocket)
-usuarios_conectados = {}  # {sid: {'usuario': 'login', 'nome': 'Nome Completo'}}
+# Corpo JSON + ETag guardados no `cache` sob 'ref:<grupo>:<versao>:<url>'.
+# Invalidar um grupo incrementa 'ref_versao:<grupo>' (as entradas antigas expiram).
+REFERENCIA_TTL = int(os.getenv('REFERENCIA_TTL', 86400))  # segundos
+# Tabelas mantidas fora do sistema: após alterar, rodar `flask limpar-cache-referencia`
+REFERENCIA_GRUPOS = {
+    'setores': 'CAD_SETORES',
+    'tipos_locacao': 'TIPO_LOCACAO',
+    'tipos_demanda': 'TIPO_DEMANDA',
+    'tipos_veiculo': 'TIPO_VEICULO',
+    'categorias_veiculos': 'CATEGORIA_VEICULO',
+    'tipos_item_opa': 'TIPO_ITEMOPA',
+    'fornecedores': 'CAD_FORNECEDOR',
+    'imperfeicoes': 'LISTA_IMPERFEICOES'
+}
 
 
 # ============================================================
@@ -179,39 +1956,91 @@ def authenticated_only(f):
     return wrapped
 
 
+def dados_referencia(grupo):
+    """
+    Decorador para rotas de consulta de tabelas de referência
+    
+    A resposta 200 é guardada no cache até o grupo ser invalidado e sai com
+    ETag forte; o navegador revalida a cada uso (no-cache) e recebe 304 se
+    nada mudou, sem corpo e sem consulta ao banco.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            versao = cache.get(f'ref_versao:{grupo}') or 0
+            chave = f'ref:{grupo}:{versao}:{request.full_path}'
+            
+            entrada = cache.get(chave)
+            if entrada is None:
+                resposta = make_response(f(*args, **kwargs))
+                if resposta.status_code != 200:
+                    return resposta  # Erros não são guardados
+                
+                corpo = resposta.get_data()
+                entrada = {
+                    'corpo': corpo,
+                    'mimetype': resposta.mimetype,
+                    'etag': hashlib.sha256(corpo).hexdigest()[:32]
+                }
+                cache.set(chave, entrada, timeout=REFERENCIA_TTL)
+            
+            resposta = make_response(entrada['corpo'])
+            resposta.mimetype = entrada['mimetype']
+            resposta.set_etag(entrada['etag'])
+            resposta.headers['Cache-Control'] = 'private, no-cache'
+            return resposta.make_conditional(request)
+        return decorated_function
+    return decorator
+
+
+def invalidar_dados_referencia(*grupos):
+    """Invalida os grupos informados (sem argumentos, todos)"""
+    for grupo in grupos or REFERENCIA_GRUPOS:
+        cache.cache.inc(f'ref_versao:{grupo}')  # inc do backend (o Flask-Caching não o expõe)
+
+
 # ============================================================
 # FUNÇÕES AUXILIARES - WEBSOCKET
 # ============================================================
 
-def emitir_alteracao_demanda(tipo_operacao, id_ad, dados_demanda=None):
+def emitir_alteracao_demanda(tipo_operacao, id_ad, dados_demanda=None, periodo_anterior=None, usuario=None):
     """
-    Emite alteração de demanda para todos os clientes conectados via WebSocket
+    Emite alteração de demanda para os clientes que exibem as semanas afetadas
     
     Args:
         tipo_operacao (str): 'INSERT', 'UPDATE', 'DELETE'
         id_ad (int): ID da demanda
         dados_demanda (dict, optional): Dados completos da demanda
+        periodo_anterior (tuple, optional): (DT_INICIO, DT_FIM) antes da alteração
+                                            (UPDATE que muda datas, DELETE)
+        usuario (str, optional): Login do autor; padrão é o da sessão
+                                 (obrigatório fora de requisição, ex.: fila de emails)
     """
     try:
-        usuario_atual = session.get('usuario_login', '')
+        usuario_atual = usuario if usuario is not None else session.get('usuario_login', '')
+        periodos = [periodo_anterior]
+        if dados_demanda:
+            periodos.append((dados_demanda['dt_inicio'], dados_demanda['dt_fim']))
+        versao = anotar_alteracao_agenda('DEMANDA', tipo_operacao, id_ad, usuario=usuario_atual, periodos=periodos)
         
         payload = {
             'tipo': tipo_operacao,
             'entidade': 'DEMANDA',
             'id_ad': id_ad,
             'usuario': usuario_atual,
+            'versao': versao,
             'timestamp': datetime.now().isoformat()
         }
         
         if dados_demanda:
             payload['dados'] = dados_demanda
         
-        # ===== CORREÇÃO: Remover skip_sid (não existe em rotas HTTP) =====
-        socketio.emit('alteracao_agenda', payload, room='agenda')
-        # Emite para TODOS na sala, incluindo quem fez a alteração
-        # O frontend vai ignorar suas próprias alterações
+        # Apenas as salas das semanas afetadas; sem período conhecido, todos na 'agenda'
+        # Emite inclusive para quem fez a alteração (consistência visual)
+        salas = salas_agenda_dos_periodos(periodos) or 'agenda'
+        socketio.emit('alteracao_agenda', payload, to=salas)
         
-        print(f"📡 WebSocket: Emitido {tipo_operacao} - ID_AD: {id_ad} por {usuario_atual}")
+        print(f"📡 WebSocket: Emitido {tipo_operacao} - ID_AD: {id_ad} por {usuario_atual} → {salas}")
         
     except Exception as e:
         print(f"❌ Erro ao emitir alteração WebSocket: {str(e)}")
@@ -219,7 +2048,7 @@ def emitir_alteracao_demanda(tipo_operacao, id_ad, dados_demanda=None):
         traceback.print_exc()
 
 
-def emitir_alteracao_diaria_terceirizado(tipo_operacao, iditem, id_ad, fl_email=None):
+def emitir_alteracao_diaria_terceirizado(tipo_operacao, iditem, id_ad, fl_email=None, periodo=None, usuario=None):
     """
     Emite alteração de diária de terceirizado via WebSocket
     
@@ -228,9 +2057,13 @@ def emitir_alteracao_diaria_terceirizado(tipo_operacao, iditem, id_ad, fl_email=
         iditem (int): ID do item de diária
         id_ad (int): ID da demanda
         fl_email (str, optional): Flag de email ('S' ou 'N')
+        periodo (tuple, optional): (DT_INICIO, DT_FIM) da demanda
+        usuario (str, optional): Login do autor; padrão é o da sessão
     """
     try:
-        usuario_atual = session.get('usuario_login', '')
+        usuario_atual = usuario if usuario is not None else session.get('usuario_login', '')
+        periodos = [periodo]
+        versao = anotar_alteracao_agenda('DIARIA_TERCEIRIZADO', tipo_operacao, id_ad, iditem, usuario_atual, periodos)
         
         payload = {
             'tipo': tipo_operacao,
@@ -238,16 +2071,17 @@ def emitir_alteracao_diaria_terceirizado(tipo_operacao, iditem, id_ad, fl_email=
             'iditem': iditem,
             'id_ad': id_ad,
             'usuario': usuario_atual,
+            'versao': versao,
             'timestamp': datetime.now().isoformat()
         }
         
         if fl_email is not None:
             payload['fl_email'] = fl_email
         
-        # ===== CORREÇÃO: Remover skip_sid =====
-        socketio.emit('alteracao_agenda', payload, room='agenda')
+        salas = salas_agenda_dos_periodos(periodos) or 'agenda'
+        socketio.emit('alteracao_agenda', payload, to=salas)
         
-        print(f"📡 WebSocket: Emitido {tipo_operacao} DIÁRIA - IDITEM: {iditem}")
+        print(f"📡 WebSocket: Emitido {tipo_operacao} DIÁRIA - IDITEM: {iditem} → {salas}")
         
     except Exception as e:
         print(f"❌ Erro ao emitir alteração de diária: {str(e)}")
@@ -255,6 +2089,354 @@ def emitir_alteracao_diaria_terceirizado(tipo_operacao, iditem, id_ad, fl_email=
         traceback.print_exc()
 
 
+# ============================================================
+# FUNÇÕES AUXILIARES - PRESENÇA (USUÁRIOS CONECTADOS)
+# ============================================================
+
+def registrar_presenca(sid, info):
+    """Registra (ou renova) a conexão do sid"""
+    if presenca_redis is None:
+        usuarios_conectados[sid] = info
+        return
+    
+    pipe = presenca_redis.pipeline()
+    pipe.hset(PRESENCA_CHAVE, sid, json.dumps(info))
+    pipe.zadd(PRESENCA_EXPIRA_CHAVE, {sid: time.time() + PRESENCA_TTL})
+    pipe.execute()
+
+
+def renovar_presenca(sid):
+    """Estende a validade da conexão (chamado no ping)"""
+    if presenca_redis is not None:
+        presenca_redis.zadd(PRESENCA_EXPIRA_CHAVE, {sid: time.time() + PRESENCA_TTL}, xx=True)
+
+
+def remover_presenca(sid):
+    """Remove a conexão e retorna seus dados (None se não existir)"""
+    if presenca_redis is None:
+        return usuarios_conectados.pop(sid, None)
+    
+    pipe = presenca_redis.pipeline()
+    pipe.hget(PRESENCA_CHAVE, sid)
+    pipe.hdel(PRESENCA_CHAVE, sid)
+    pipe.zrem(PRESENCA_EXPIRA_CHAVE, sid)
+    info = pipe.execute()[0]
+    return json.loads(info) if info else None
+
+
+def total_presenca():
+    """Total de conexões ativas em todos os workers"""
+    if presenca_redis is None:
+        return len(usuarios_conectados)
+    
+    # Limpar conexões expiradas antes de contar
+    expirados = presenca_redis.zrangebyscore(PRESENCA_EXPIRA_CHAVE, '-inf', time.time())
+    if expirados:
+        pipe = presenca_redis.pipeline()
+        pipe.hdel(PRESENCA_CHAVE, *expirados)
+        pipe.zrem(PRESENCA_EXPIRA_CHAVE, *expirados)
+        pipe.execute()
+    
+    return presenca_redis.zcard(PRESENCA_EXPIRA_CHAVE)
+
+
+# ============================================================
+# FUNÇÕES AUXILIARES - SNAPSHOTS DA AGENDA
+# ============================================================
+
+def _data_iso(valor):
+    """Normaliza date/datetime/str para 'YYYY-MM-DD'"""
+    if hasattr(valor, 'strftime'):
+        return valor.strftime('%Y-%m-%d')
+    return str(valor)[:10]
+
+
+def _geracoes_compartilhadas(inicio, fim):
+    """
+    Contadores de invalidação das semanas no cache compartilhado
+    
+    Com vários workers, cada um guarda seus snapshots, mas a invalidação feita
+    em um worker precisa chegar aos outros: o snapshot só vale se os contadores
+    das suas semanas ISO (e o global) não mudaram. None com cache local.
+    """
+    if not CACHE_COMPARTILHADO:
+        return None
+    
+    chaves = ['agenda_geracao:todas'] + [
+        f'agenda_geracao:{sala}' for sala in salas_agenda_do_periodo(inicio, fim)
+    ]
+    return tuple(cache.get_many(*chaves))
+
+
+def obter_snapshot_agenda(inicio, fim):
+    """
+    Retorna o snapshot da semana ou None se ausente/expirado
+    
+    Returns:
+        tuple: (dados, geracao) - geracao deve ser repassada para salvar_snapshot_agenda
+    """
+    geracoes = _geracoes_compartilhadas(inicio, fim)
+    
+    with agenda_snapshots_lock:
+        chave = (_data_iso(inicio), _data_iso(fim))
+        snapshot = agenda_snapshots.get(chave)
+        
+        if snapshot and (time.time() - snapshot['criado_em'] > AGENDA_SNAPSHOT_TTL
+                         or snapshot['geracoes'] != geracoes):
+            del agenda_snapshots[chave]
+            snapshot = None
+        
+        return (snapshot['dados'] if snapshot else None), (agenda_snapshots_geracao, geracoes)
+
+
+def salvar_snapshot_agenda(inicio, fim, dados, geracao):
+    """
+    Armazena o snapshot da semana
+    
+    Se alguma invalidação ocorreu desde que a leitura começou (geracao diferente),
+    o snapshot é descartado porque pode não conter a alteração.
+    """
+    geracao_local, geracoes = geracao
+    
+    with agenda_snapshots_lock:
+        if geracao_local != agenda_snapshots_geracao:
+            return False
+        
+        if len(agenda_snapshots) >= AGENDA_SNAPSHOT_MAX:
+            mais_antigo = min(agenda_snapshots, key=lambda k: agenda_snapshots[k]['criado_em'])
+            del agenda_snapshots[mais_antigo]
+        
+        agenda_snapshots[(_data_iso(inicio), _data_iso(fim))] = {
+            'dados': dados,
+            'geracoes': geracoes,
+            'criado_em': time.time()
+        }
+        return True
+
+
+def invalidar_snapshots_agenda(*periodos):
+    """
+    Invalida os snapshots das semanas que se sobrepõem aos períodos informados
+    
+    Args:
+        *periodos: tuplas (dt_inicio, dt_fim); None é ignorado.
+                   Sem argumentos, invalida todas as semanas (ex: cadastro de veículo/motorista)
+    """
+    global agenda_snapshots_geracao
+    
+    # Avisar os demais workers (contadores no cache compartilhado; inc é do
+    # backend - INCRBY atômico no Redis - o Flask-Caching não o expõe)
+    if CACHE_COMPARTILHADO:
+        if not periodos:
+            cache.cache.inc('agenda_geracao:todas')
+        else:
+            for sala in salas_agenda_dos_periodos(periodos):
+                cache.cache.inc(f'agenda_geracao:{sala}')
+    
+    with agenda_snapshots_lock:
+        agenda_snapshots_geracao += 1
+        
+        if not periodos:
+            total = len(agenda_snapshots)
+            agenda_snapshots.clear()
+            print(f"🧹 Snapshots da agenda invalidados: {total} (todas as semanas)")
+            return
+        
+        intervalos = [
+            (_data_iso(p[0]), _data_iso(p[1]))
+            for p in periodos if p and p[0] and p[1]
+        ]
+        
+        removidas = [
+            chave for chave in agenda_snapshots
+            if any(chave[0] <= fim and chave[1] >= inicio for inicio, fim in intervalos)
+        ]
+        
+        for chave in removidas:
+            del agenda_snapshots[chave]
+        
+        if removidas:
+            print(f"🧹 Snapshots da agenda invalidados: {', '.join(k[0] for k in removidas)}")
+
+
+# ============================================================
+# FUNÇÕES AUXILIARES - SEQUÊNCIA DE ALTERAÇÕES DA AGENDA
+# ============================================================
+
+def _redis_do_cache():
+    """Cliente Redis por trás do `cache` (CACHE_TYPE=RedisCache), senão None"""
+    return getattr(cache.cache, '_write_client', None)
+
+
+def _chave_ultimas_alteracoes():
+    """Chave do hash de últimas alterações, com o mesmo prefixo das chaves do `cache`"""
+    return f"{getattr(cache.cache, 'key_prefix', '')}{AGENDA_ULTIMAS_ALTERACOES_CHAVE}"
+
+
+def anotar_alteracao_agenda(entidade, tipo_operacao, id_ad, iditem=None, usuario='', periodos=None):
+    """
+    Registra uma alteração na sequência da agenda
+    
+    Args:
+        entidade (str): 'DEMANDA' ou 'DIARIA_TERCEIRIZADO'
+        tipo_operacao (str): 'INSERT', 'UPDATE', 'DELETE'
+        id_ad (int): ID da demanda afetada
+        iditem (int, optional): ID do item de diária
+        usuario (str): Login de quem fez a alteração
+        periodos (list, optional): [(dt_inicio, dt_fim), ...] afetados; None é ignorado
+    
+    Returns:
+        str: Token de versão após a alteração
+    """
+    global agenda_alteracoes_seq
+    
+    with agenda_alteracoes_lock:
+        agenda_alteracoes_seq += 1
+        seq = agenda_alteracoes_seq
+        agenda_alteracoes.append({
+            'seq': seq,
+            'entidade': entidade,
+            'tipo': tipo_operacao,
+            'id_ad': int(id_ad) if id_ad else None,
+            'iditem': iditem,
+            'usuario': usuario,
+            'periodos': [(_data_iso(p[0]), _data_iso(p[1])) for p in (periodos or []) if p],
+            'timestamp': datetime.now().isoformat()
+        })
+        
+        try:
+            info = {
+                'seq': seq,
+                'timestamp': datetime.now(timezone('America/Manaus')).strftime('%Y-%m-%d %H:%M:%S')
+            }
+            redis_cache = _redis_do_cache()
+            if redis_cache is not None:
+                # Só o campo do usuário: workers simultâneos não sobrescrevem uns aos outros
+                redis_cache.hset(_chave_ultimas_alteracoes(), usuario, json.dumps(info))
+            else:
+                # Cache do processo: o lock acima cobre a leitura-modificação-escrita
+                ultimas = cache.get(AGENDA_ULTIMAS_ALTERACOES_CHAVE) or {}
+                ultimas[usuario] = info
+                cache.set(AGENDA_ULTIMAS_ALTERACOES_CHAVE, ultimas, timeout=0)
+        except Exception as e:
+            print(f"❌ Erro ao registrar última alteração do usuário: {str(e)}")
+        
+        return f"{AGENDA_ALTERACOES_EPOCA}:{seq}"
+
+
+def houve_alteracao_de_outros(desde, usuario_atual):
+    """
+    Verifica se outro usuário alterou a agenda após 'desde' (hora local, 'YYYY-MM-DD HH:MM:SS')
+    
+    Returns:
+        bool | None: None quando o mapa em memória não cobre o período
+                     (checagem anterior ao início do processo)
+    """
+    if desde < AGENDA_PROCESSO_INICIO.strftime('%Y-%m-%d %H:%M:%S'):
+        return None
+    
+    redis_cache = _redis_do_cache()
+    if redis_cache is not None:
+        ultimas = {
+            (u.decode() if isinstance(u, bytes) else u): json.loads(info)
+            for u, info in redis_cache.hgetall(_chave_ultimas_alteracoes()).items()
+        }
+    else:
+        ultimas = cache.get(AGENDA_ULTIMAS_ALTERACOES_CHAVE) or {}
+    
+    return any(
+        info['timestamp'] > desde
+        for usuario, info in ultimas.items()
+        if usuario != usuario_atual
+    )
+
+
+def versao_agenda_atual():
+    """Retorna o token de versão atual da agenda"""
+    with agenda_alteracoes_lock:
+        return f"{AGENDA_ALTERACOES_EPOCA}:{agenda_alteracoes_seq}"
+
+
+def alteracoes_agenda_desde(versao):
+    """
+    Lista as alterações posteriores ao token informado
+    
+    Returns:
+        list | None: Alterações em ordem de sequência, ou None quando o token é
+                     inválido, de outra época ou já saiu da janela retida
+                     (cliente deve recarregar a semana inteira)
+    """
+    try:
+        epoca, seq = versao.split(':', 1)
+        seq = int(seq)
+    except (AttributeError, ValueError):
+        return None
+    
+    with agenda_alteracoes_lock:
+        if epoca != AGENDA_ALTERACOES_EPOCA or seq > agenda_alteracoes_seq:
+            return None
+        
+        if seq == agenda_alteracoes_seq:
+            return []
+        
+        # Janela retida não cobre o token (alterações perdidas)
+        if not agenda_alteracoes or agenda_alteracoes[0]['seq'] > seq + 1:
+            return None
+        
+        return [a for a in agenda_alteracoes if a['seq'] > seq]
+
+
+def salas_agenda_do_periodo(dt_inicio, dt_fim):
+    """
+    Salas Socket.IO das semanas ISO que cobrem o período
+    
+    A semana da agenda (domingo a sábado) toca duas semanas ISO, então o
+    cliente assina as duas e a demanda é emitida para as que ela sobrepõe.
+    
+    Returns:
+        list: ['agenda:2026-W41', 'agenda:2026-W42', ...]
+    """
+    inicio = datetime.strptime(_data_iso(dt_inicio), '%Y-%m-%d').date()
+    fim = datetime.strptime(_data_iso(dt_fim), '%Y-%m-%d').date()
+    
+    segunda = inicio - timedelta(days=inicio.weekday())
+    salas = []
+    while segunda <= fim:
+        ano_iso, semana_iso, _ = segunda.isocalendar()
+        salas.append(f"agenda:{ano_iso}-W{semana_iso:02d}")
+        segunda += timedelta(days=7)
+    return salas
+
+
+def salas_agenda_dos_periodos(periodos):
+    """União (ordenada, sem repetição) das salas de vários períodos; None é ignorado"""
+    salas = []
+    for periodo in periodos:
+        if periodo and periodo[0] and periodo[1]:
+            for sala in salas_agenda_do_periodo(periodo[0], periodo[1]):
+                if sala not in salas:
+                    salas.append(sala)
+    return salas
+
+
+def alteracao_afeta_periodo(alteracao, inicio, fim):
+    """Alterações sem período conhecido são consideradas relevantes"""
+    if not alteracao.get('periodos'):
+        return True
+    return any(
+        p_inicio <= _data_iso(fim) and p_fim >= _data_iso(inicio)
+        for p_inicio, p_fim in alteracao['periodos']
+    )
+
+
+def buscar_periodo_demanda(cursor, id_ad):
+    """Retorna (DT_INICIO, DT_FIM) da demanda ou None se não existir"""
+    cursor.execute("""
+        SELECT DT_INICIO, DT_FIM FROM AGENDA_DEMANDAS WHERE ID_AD = %s
+    """, (id_ad,))
+    return cursor.fetchone()
+
+
 # ============================================================
 # FUNÇÕES AUXILIARES - UTILITÁRIOS
 # ============================================================
@@ -306,11 +2488,11 @@ def handle_connect():
         return False  # Rejeitar conexão não autenticada
     
     # Armazenar conexão
-    usuarios_conectados[request.sid] = {
+    registrar_presenca(request.sid, {
         'usuario': usuario_login,
         'nome': usuario_nome,
         'connected_at': datetime.now().isoformat()
-    }
+    })
     
     # Entrar na sala 'agenda' (todos os usuários da agenda ficam nesta sala)
     join_room('agenda')
@@ -320,24 +2502,23 @@ def handle_connect():
     # Notificar outros usuários
     emit('usuario_conectou', {
         'usuario': usuario_nome,
-        'total_conectados': len(usuarios_conectados)
+        'total_conectados': total_presenca()
     }, room='agenda', skip_sid=request.sid)
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Cliente se desconecta do WebSocket"""
-    if request.sid in usuarios_conectados:
-        usuario_info = usuarios_conectados[request.sid]
+    usuario_info = remover_presenca(request.sid)
+    if usuario_info:
         leave_room('agenda')
-        del usuarios_conectados[request.sid]
         
         print(f"❌ WebSocket desconectado: {usuario_info['nome']} - SID: {request.sid}")
         
         # Notificar outros usuários
         emit('usuario_desconectou', {
             'usuario': usuario_info['nome'],
-            'total_conectados': len(usuarios_conectados)
+            'total_conectados': total_presenca()
         }, room='agenda')
 
 
@@ -345,9 +2526,70 @@ def handle_disconnect():
 @authenticated_only
 def handle_ping():
     """Responde ao ping do cliente (keepalive)"""
+    renovar_presenca(request.sid)
     emit('pong', {'timestamp': datetime.now().isoformat()})
 
 
+# ============================================================
+# EVENTOS WEBSOCKET - SINCRONIZAÇÃO DA AGENDA (PUSH)
+# ============================================================
+
+@socketio.on('assinar_agenda')
+@authenticated_only
+def handle_assinar_agenda(dados=None):
+    """
+    Assina as alterações da semana exibida e devolve o que o cliente perdeu
+    
+    Chamado ao abrir/trocar de semana e a cada (re)conexão. Substitui o
+    polling de /api/agenda/check-updates.
+    
+    Args (dados):
+        inicio, fim: Semana exibida ('YYYY-MM-DD')
+        versao: Último token aplicado pelo cliente (opcional)
+    
+    Returns (ack):
+        dict: {'versao', 'salas', 'full_reload', 'alteracoes'} - 'alteracoes' é o
+              replay das alterações perdidas que tocam a semana
+    """
+    dados = dados or {}
+    inicio = dados.get('inicio')
+    fim = dados.get('fim')
+    
+    if not inicio or not fim:
+        return {'erro': 'Semana não informada'}
+    
+    # Trocar de sala: sai das semanas anteriores, entra nas novas
+    novas_salas = salas_agenda_do_periodo(inicio, fim)
+    for sala in rooms():
+        if sala.startswith('agenda:') and sala not in novas_salas:
+            leave_room(sala)
+    for sala in novas_salas:
+        join_room(sala)
+    
+    resposta = {
+        'versao': versao_agenda_atual(),
+        'salas': novas_salas,
+        'full_reload': False,
+        'alteracoes': []
+    }
+    
+    versao_cliente = dados.get('versao')
+    if versao_cliente:
+        alteracoes = alteracoes_agenda_desde(versao_cliente)
+        
+        if alteracoes is None:
+            resposta['full_reload'] = True
+        else:
+            resposta['alteracoes'] = [
+                a for a in alteracoes if alteracao_afeta_periodo(a, inicio, fim)
+            ]
+    
+    print(f"📅 WebSocket: {session.get('usuario_login')} assinou {', '.join(novas_salas)} "
+          f"(replay: {len(resposta['alteracoes'])}, full_reload: {resposta['full_reload']})")
+    
+    return resposta
+
+
 @app.route('/salvar-ordem-cronologica', methods=['POST'])
 def salvar_ordem_cronologica():
     """
@@ -588,6 +2830,105 @@ def api_buscar_contrato(id_contrato):
 
 ###################################
 
+# ============================================================
+# CACHE DE PERMISSÕES (verificar_permissao)
+# ============================================================
+# Matriz {(ID_GRUPO, URL_PAGINA): NIVEL_ACESSO} e {ID_USUARIO: ID_GRUPO}
+# carregadas em lote; invalidadas pelas rotas de usuários, páginas e permissões.
+# Com cache compartilhado, um contador avisa os demais workers.
+permissoes_cache = {'matriz': None, 'grupos': {}, 'versao': None}
+permissoes_cache_lock = threading.Lock()
+permissoes_cache_geracao = 0
+PERMISSOES_VERSAO_CHAVE = 'permissoes_versao'
+
+
+def _versao_permissoes_compartilhada():
+    return cache.get(PERMISSOES_VERSAO_CHAVE) if CACHE_COMPARTILHADO else None
+
+
+def carregar_permissoes():
+    """
+    Carrega a matriz de permissões e o grupo de cada usuário (2 consultas)
+    
+    Returns:
+        tuple: (matriz, grupos)
+    """
+    versao = _versao_permissoes_compartilhada()
+    with permissoes_cache_lock:
+        geracao = permissoes_cache_geracao
+    
+    cur = mysql.connection.cursor()
+    try:
+        cur.execute("""
+            SELECT p.ID_GRUPO, pg.URL_PAGINA, p.NIVEL_ACESSO
+            FROM CAD_PERMISSAO p
+            INNER JOIN CAD_PAGINA pg ON p.ID_PAGINA = pg.ID_PAGINA
+            ORDER BY p.ID_PERMISSAO
+        """)
+        matriz = {}
+        for id_grupo, url, nivel in cur.fetchall():
+            matriz.setdefault((id_grupo, url), nivel)
+        
+        cur.execute("SELECT ID_USUARIO, ID_GRUPO FROM CAD_USUARIO")
+        grupos = {id_usuario: id_grupo for id_usuario, id_grupo in cur.fetchall()}
+    finally:
+        cur.close()
+    
+    with permissoes_cache_lock:
+        # Invalidação durante a carga: não guardar dados possivelmente antigos
+        if geracao == permissoes_cache_geracao:
+            permissoes_cache.update(matriz=matriz, grupos=grupos, versao=versao)
+    
+    print(f"🔐 Permissões carregadas: {len(matriz)} regra(s), {len(grupos)} usuário(s)")
+    return matriz, grupos
+
+
+def nivel_acesso_usuario(id_usuario, url_pagina):
+    """Nível de acesso (E/L/N) do usuário na página, ou None se não houver permissão"""
+    versao = _versao_permissoes_compartilhada()
+    
+    with permissoes_cache_lock:
+        if permissoes_cache['matriz'] is not None and permissoes_cache['versao'] == versao:
+            matriz, grupos = permissoes_cache['matriz'], permissoes_cache['grupos']
+        else:
+            matriz = None
+    
+    if matriz is None:
+        matriz, grupos = carregar_permissoes()
+    
+    id_grupo = grupos.get(id_usuario)
+    if id_grupo is None:
+        # Usuário cadastrado depois da carga
+        cur = mysql.connection.cursor()
+        try:
+            cur.execute("SELECT ID_GRUPO FROM CAD_USUARIO WHERE ID_USUARIO = %s", (id_usuario,))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+        
+        if not row:
+            return None
+        
+        id_grupo = row[0]
+        with permissoes_cache_lock:
+            if permissoes_cache['grupos'] is grupos:
+                grupos[id_usuario] = id_grupo
+    
+    return matriz.get((id_grupo, url_pagina))
+
+
+def invalidar_permissoes():
+    """Descarta a matriz de permissões (recarregada no próximo acesso)"""
+    global permissoes_cache_geracao
+    
+    if CACHE_COMPARTILHADO:
+        cache.cache.inc(PERMISSOES_VERSAO_CHAVE)  # inc do backend (INCRBY no Redis)
+    
+    with permissoes_cache_lock:
+        permissoes_cache_geracao += 1
+        permissoes_cache.update(matriz=None, grupos={}, versao=None)
+
+
 # Decorator para verificar permissão de acesso
 def verificar_permissao(url_pagina, nivel_minimo='L'):
     def decorator(f):
@@ -596,28 +2937,17 @@ def verificar_permissao(url_pagina, nivel_minimo='L'):
             if 'usuario_id' not in session:
                 return redirect(url_for('login'))
                      
-            cur = mysql.connection.cursor()
-            cur.execute("""
-                SELECT p.NIVEL_ACESSO
-                FROM CAD_USUARIO u
-                INNER JOIN CAD_PERMISSAO p ON u.ID_GRUPO = p.ID_GRUPO
-                INNER JOIN CAD_PAGINA pg ON p.ID_PAGINA = pg.ID_PAGINA
-                WHERE u.ID_USUARIO = %s AND pg.URL_PAGINA = %s
-            """, (session['usuario_id'], url_pagina))
-                     
-            permissao = cur.fetchone()
-            cur.close()
+            nivel = nivel_acesso_usuario(session['usuario_id'], url_pagina)
                      
             # Sem permissão ou acesso negado - redireciona para página de erro
-            if not permissao or permissao[0] == 'N':
+            if not nivel or nivel == 'N':
                 return render_template('acesso_negado.html', 
                                      mensagem='Você não tem permissão para acessar esta página.')
                      
             # Se requer edição e tem apenas leitura - permite acesso mas em modo leitura
-            if nivel_minimo == 'E' and permissao[0] == 'L':
-                session['nivel_acesso_atual'] = 'L'
-            else:
-                session['nivel_acesso_atual'] = permissao[0]
+            # (grava na sessão só quando muda, evitando reemitir o cookie a cada acesso)
+            if session.get('nivel_acesso_atual') != nivel:
+                session['nivel_acesso_atual'] = nivel
                      
             return f(*args, **kwargs)
         return decorated_function
@@ -797,6 +3127,8 @@ def atualizar_usuario(id):
     mysql.connection.commit()
     cur.close()
     
+    invalidar_permissoes()
+    
     return jsonify({'sucesso': True})
 
 # Rota para deletar usuário
@@ -812,6 +3144,8 @@ def deletar_usuario(id):
     mysql.connection.commit()
     cur.close()
     
+    invalidar_permissoes()
+    
     return jsonify({'sucesso': True})
 
 @app.route('/logout')
@@ -1053,6 +3387,7 @@ def criar_pagina():
             """, (id_grupo, id_pagina, nivel_acesso))
         
         mysql.connection.commit()
+        invalidar_permissoes()
         
         return jsonify({
             'mensagem': 'Página criada com sucesso',
@@ -1089,6 +3424,7 @@ def atualizar_pagina(id):
         """, (nome, descricao, url, status, id))
         
         mysql.connection.commit()
+        invalidar_permissoes()
         
         if cur.rowcount == 0:
             return jsonify({'erro': 'Página não encontrada'}), 404
@@ -1115,6 +3451,7 @@ def deletar_pagina(id):
         cur.execute("DELETE FROM CAD_PAGINA WHERE ID_PAGINA = %s", (id,))
         
         mysql.connection.commit()
+        invalidar_permissoes()
         
         if cur.rowcount == 0:
             return jsonify({'erro': 'Página não encontrada'}), 404
@@ -1197,6 +3534,8 @@ def atualizar_permissoes_grupo(grupo_id):
         mysql.connection.commit()
         cur.close()
         
+        invalidar_permissoes()
+        
         return jsonify({'sucesso': True})
     
     except Exception as e:
@@ -1241,7 +3580,7 @@ def confirma_vistoria(id):
         SELECT v.IDVISTORIA, v.IDMOTORISTA, m.NM_MOTORISTA as MOTORISTA, v.IDVEICULO, 
                CONCAT(DS_MODELO,' - ',NU_PLACA) AS VEICULO, v.DATA, v.TIPO, v.STATUS, 
                v.COMBUSTIVEL, v.HODOMETRO, ve.DS_MODELO, v.VISTORIA_SAIDA_ID,  
-               v.ASS_USUARIO, v.ASS_MOTORISTA, v.OBS, v.DATA_SAIDA, v.DATA_RETORNO, v.NU_SEI
+               v.OBS, v.DATA_SAIDA, v.DATA_RETORNO, v.NU_SEI
         FROM VISTORIAS v
         JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
         JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
@@ -1258,9 +3597,9 @@ def confirma_vistoria(id):
             veiculo_placa=vistoria[4],
             combustivel=vistoria[8],
             hodometro=vistoria[9],
-	    data_saida=vistoria[15],
-	    data_retorno=vistoria[16],
-	    nu_sei=vistoria[17],
+	    data_saida=vistoria[13],
+	    data_retorno=vistoria[14],
+	    nu_sei=vistoria[15],
             tipo='INICIAL'
         )
     else:
@@ -1298,6 +3637,131 @@ def nova_vistoria_devolucao(vistoria_saida_id):
         tipo='DEVOLUCAO'
     )
 
+# ============================================================
+# API - UPLOAD RETOMÁVEL
+# ============================================================
+
+@app.route('/api/uploads', methods=['POST'])
+def iniciar_upload():
+    dono = dono_upload()
+    if not dono:
+        return jsonify({'success': False, 'error': 'Não autorizado'}), 401
+    
+    dados = request.get_json(silent=True) or {}
+    try:
+        tamanho = int(dados.get('tamanho', 0))
+    except (TypeError, ValueError):
+        tamanho = 0
+    
+    if tamanho <= 0 or tamanho > UPLOAD_TAMANHO_MAX:
+        return jsonify({'success': False, 'error': f'Tamanho inválido (máximo {UPLOAD_TAMANHO_MAX} bytes)'}), 400
+    
+    os.makedirs(UPLOAD_RETOMAVEL_DIR, exist_ok=True)
+    limpar_uploads_expirados()
+    
+    upload_id = uuid.uuid4().hex
+    open(_caminhos_upload(upload_id)[0], 'wb').close()
+    gravar_meta_upload(upload_id, {
+        'dono': dono,
+        'tamanho': tamanho,
+        'nome': secure_filename(dados.get('nome') or '') or 'foto.jpg',
+        'midia': None
+    })
+    
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'offset': 0,
+        'pedaco_max': UPLOAD_PEDACO_MAX
+    }), 201
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def status_upload(upload_id):
+    meta = ler_upload(upload_id)
+    if not meta:
+        return jsonify({'success': False, 'error': 'Upload não encontrado'}), 404
+    
+    offset = os.path.getsize(_caminhos_upload(upload_id)[0]) if not meta['midia'] else meta['tamanho']
+    return jsonify({
+        'success': True,
+        'offset': offset,
+        'tamanho': meta['tamanho'],
+        'finalizado': bool(meta['midia'])
+    })
+
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def enviar_pedaco_upload(upload_id):
+    if not ler_upload(upload_id):  # Sem criar trava para id inexistente
+        return jsonify({'success': False, 'error': 'Upload não encontrado'}), 404
+    
+    with _lock_upload(upload_id):
+        # Relidos com a trava: um finalizar concorrente pode ter acabado de gravar a mídia
+        meta = ler_upload(upload_id)
+        if not meta or meta['midia']:
+            return jsonify({'success': False, 'error': 'Upload não encontrado'}), 404
+        
+        caminho_part = _caminhos_upload(upload_id)[0]
+        offset_atual = os.path.getsize(caminho_part)
+        
+        # Pedaço fora de ordem (ex: reenvio após queda): cliente retoma do offset atual
+        if request.headers.get('Upload-Offset', type=int) != offset_atual:
+            return jsonify({'success': False, 'error': 'Offset divergente', 'offset': offset_atual}), 409
+        
+        restante = min(UPLOAD_PEDACO_MAX, meta['tamanho'] - offset_atual)
+        with open(caminho_part, 'ab') as destino:
+            # Copia do socket para o disco em blocos, sem montar o pedaço em memória
+            while restante > 0:
+                bloco = request.stream.read(min(BLOB_CHUNK, restante))
+                if not bloco:
+                    break
+                destino.write(bloco)
+                restante -= len(bloco)
+        
+        offset = os.path.getsize(caminho_part)
+        os.utime(_caminhos_upload(upload_id)[1])  # em andamento: renova a validade
+    
+    return jsonify({'success': True, 'offset': offset})
+
+
+@app.route('/api/uploads/<upload_id>/finalizar', methods=['POST'])
+def finalizar_upload(upload_id):
+    if not ler_upload(upload_id):  # Sem criar trava para id inexistente
+        return jsonify({'success': False, 'error': 'Upload não encontrado'}), 404
+    
+    with _lock_upload(upload_id):
+        # Dono, tamanho e mídia relidos com a trava: outro finalizar/PATCH pode ter mudado o upload
+        meta = ler_upload(upload_id)
+        if not meta:
+            return jsonify({'success': False, 'error': 'Upload não encontrado'}), 404
+        
+        if not meta['midia']:
+            caminho_part = _caminhos_upload(upload_id)[0]
+            recebido = os.path.getsize(caminho_part)
+            if recebido != meta['tamanho']:
+                return jsonify({'success': False, 'error': 'Upload incompleto', 'offset': recebido}), 409
+            
+            try:
+                with open(caminho_part, 'rb') as arquivo:
+                    midia = gravar_fotos_vistoria([arquivo])[0]
+            except Exception:
+                midia = None  # .part mantido: o cliente pode finalizar de novo
+            if not midia:
+                return jsonify({'success': False, 'error': 'Erro ao processar a foto'}), 500
+            
+            meta['midia'] = midia
+            gravar_meta_upload(upload_id, meta)
+            os.remove(caminho_part)
+    
+    return jsonify({
+        'success': True,
+        'midia_id': upload_id,
+        'tamanho': meta['midia']['tamanho'],
+        'mime': meta['midia']['mime']
+    })
+
+
 @app.route('/salvar_vistoria', methods=['POST'])
 def salvar_vistoria():
     # ============================================
@@ -1377,118 +3841,77 @@ def salvar_vistoria():
         print(f"✅ Checkpoint 7: Assinaturas obtidas", file=sys.stderr)
         
         # Processar as assinaturas de base64 para binário, se existirem
-        assinatura_usuario_bin = None
-        assinatura_motorista_bin = None
+        assinatura_usuario_bin = decodificar_assinatura(assinatura_usuario_data)
+        assinatura_motorista_bin = decodificar_assinatura(assinatura_motorista_data)
         
-        if assinatura_usuario_data and ',' in assinatura_usuario_data:
-            assinatura_usuario_data = assinatura_usuario_data.split(',')[1]
-            assinatura_usuario_bin = base64.b64decode(assinatura_usuario_data)
+        print(f"✅ Checkpoint 8: Assinaturas processadas", file=sys.stderr)
         
-        if assinatura_motorista_data and ',' in assinatura_motorista_data:
-            assinatura_motorista_data = assinatura_motorista_data.split(',')[1]
-            assinatura_motorista_bin = base64.b64decode(assinatura_motorista_data)
+        # Fotos primeiro (normalização + blob store): a transação fica curta.
+        # midias[] = fotos já enviadas por /api/uploads; fotos[] = envio direto
+        midias = request.form.getlist('midias[]')
+        fotos = request.files.getlist('fotos[]')
+        detalhamentos = request.form.getlist('detalhamentos[]')
         
-        print(f"✅ Checkpoint 8: Assinaturas processadas", file=sys.stderr)
+        print(f"✅ Checkpoint 9: Tipo={tipo}, Fotos={len(fotos)}, Mídias={len(midias)}, Detalhamentos={len(detalhamentos)}", file=sys.stderr)
         
-        # Criar uma nova vistoria
-        cur = mysql.connection.cursor()
+        fotos_gravadas = obter_midias_vistoria(midias) if midias else gravar_fotos_vistoria(fotos)
         
-        # Capturar o último ID antes da inserção
-        cur.execute("SELECT MAX(IDVISTORIA) FROM VISTORIAS")
-        ultimo_id = cur.fetchone()[0] or 0
         data_e_hora_atual = datetime.now()
         fuso_horario = timezone('America/Manaus')
         data_hora = data_e_hora_atual.astimezone(fuso_horario)
         
-        print(f"✅ Checkpoint 9: Preparando INSERT...", file=sys.stderr)
-    
-        if tipo == 'SAIDA':
-            # Para vistorias de SAIDA, definir status como EM_TRANSITO
-            print(f"✅ Checkpoint 10: Inserindo SAIDA - ID_MOTORISTA={id_motorista}, NC_MOTORISTA={nc_motorista}", file=sys.stderr)
-            cur.execute(
-                """INSERT INTO VISTORIAS 
-                   (IDMOTORISTA, IDVEICULO, DATA, TIPO, STATUS, COMBUSTIVEL, HODOMETRO, 
-                   ASS_USUARIO, ASS_MOTORISTA, OBS, USUARIO, DATA_SAIDA, NU_SEI, NC_MOTORISTA) 
-                   VALUES (%s, %s, %s, %s, 'EM_TRANSITO', %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                (id_motorista, id_veiculo, data_hora, tipo, combustivel, hodometro, 
-                 assinatura_usuario_bin, assinatura_motorista_bin, obs, usuario_nome, data_saida, nu_sei, nc_motorista)
-            )
-        else:  # DEVOLUCAO
-            # Para vistorias de DEVOLUCAO, definir status como FINALIZADA
-            print(f"✅ Checkpoint 10: Inserindo DEVOLUCAO - ID_MOTORISTA={id_motorista}, NC_MOTORISTA={nc_motorista}", file=sys.stderr)
-            cur.execute(
-                """INSERT INTO VISTORIAS 
-                   (IDMOTORISTA, IDVEICULO, DATA, TIPO, STATUS, VISTORIA_SAIDA_ID, COMBUSTIVEL, 
-                   HODOMETRO, ASS_USUARIO, ASS_MOTORISTA, OBS, USUARIO, DATA_SAIDA, DATA_RETORNO, NU_SEI, NC_MOTORISTA) 
-                   VALUES (%s, %s, %s, %s, 'FINALIZADA', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                (id_motorista, id_veiculo, data_hora, tipo, vistoria_saida_id, combustivel, hodometro, 
-                 assinatura_usuario_bin, assinatura_motorista_bin, obs, usuario_nome, data_saida, data_retorno, nu_sei, nc_motorista)
-            )
-            # Atualizar status da vistoria de saida para finalizada
-            cur.execute(
-                "UPDATE VISTORIAS SET STATUS = 'FINALIZADA' WHERE IDVISTORIA = %s",
-                (vistoria_saida_id,)
-            )
-        
-        print(f"✅ Checkpoint 11: INSERT executado com sucesso", file=sys.stderr)
+        # Vistoria + itens em uma única transação
+        cur = mysql.connection.cursor()
+        try:
+            if tipo == 'SAIDA':
+                # Para vistorias de SAIDA, definir status como EM_TRANSITO
+                print(f"✅ Checkpoint 10: Inserindo SAIDA - ID_MOTORISTA={id_motorista}, NC_MOTORISTA={nc_motorista}", file=sys.stderr)
+                cur.execute(
+                    """INSERT INTO VISTORIAS 
+                       (IDMOTORISTA, IDVEICULO, DATA, TIPO, STATUS, COMBUSTIVEL, HODOMETRO, 
+                       OBS, USUARIO, DATA_SAIDA, NU_SEI, NC_MOTORISTA) 
+                       VALUES (%s, %s, %s, %s, 'EM_TRANSITO', %s, %s, %s, %s, %s, %s, %s)""",
+                    (id_motorista, id_veiculo, data_hora, tipo, combustivel, hodometro, 
+                     obs, usuario_nome, data_saida, nu_sei, nc_motorista)
+                )
+                id_vistoria = cur.lastrowid
+            else:  # DEVOLUCAO
+                # Para vistorias de DEVOLUCAO, definir status como FINALIZADA
+                print(f"✅ Checkpoint 10: Inserindo DEVOLUCAO - ID_MOTORISTA={id_motorista}, NC_MOTORISTA={nc_motorista}", file=sys.stderr)
+                cur.execute(
+                    """INSERT INTO VISTORIAS 
+                       (IDMOTORISTA, IDVEICULO, DATA, TIPO, STATUS, VISTORIA_SAIDA_ID, COMBUSTIVEL, 
+                       HODOMETRO, OBS, USUARIO, DATA_SAIDA, DATA_RETORNO, NU_SEI, NC_MOTORISTA) 
+                       VALUES (%s, %s, %s, %s, 'FINALIZADA', %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                    (id_motorista, id_veiculo, data_hora, tipo, vistoria_saida_id, combustivel, hodometro, 
+                     obs, usuario_nome, data_saida, data_retorno, nu_sei, nc_motorista)
+                )
+                id_vistoria = cur.lastrowid
+                # Atualizar status da vistoria de saida para finalizada
+                cur.execute(
+                    "UPDATE VISTORIAS SET STATUS = 'FINALIZADA' WHERE IDVISTORIA = %s",
+                    (vistoria_saida_id,)
+                )
             
-        # Realizar o commit para garantir que a vistoria foi salva
-        mysql.connection.commit()
-        
-        print(f"✅ Checkpoint 12: COMMIT realizado", file=sys.stderr)
-        
-        # Buscar o ID da vistoria recém-inserida procurando o ID maior que o último ID conhecido
-        cur.execute("SELECT IDVISTORIA FROM VISTORIAS WHERE IDVISTORIA > %s ORDER BY IDVISTORIA ASC LIMIT 1", (ultimo_id,))
-        result = cur.fetchone()
-        
-        if not result:
-            raise Exception("Não foi possível recuperar o ID da vistoria criada")
-        
-        id_vistoria = result[0]
-        print(f"✅ Checkpoint 13: ID da vistoria recuperado: {id_vistoria} (último ID: {ultimo_id})", file=sys.stderr)
-        
-        # Debug: Verificar recebimento das fotos
-        fotos = request.files.getlist('fotos[]')
-        detalhamentos = request.form.getlist('detalhamentos[]')
-        
-        print(f"✅ Checkpoint 14: Tipo={tipo}, Fotos={len(fotos)}, Detalhamentos={len(detalhamentos)}", file=sys.stderr)
-        
-        # Processar todas as fotos de uma vez
-        for i, foto in enumerate(fotos):
-            if foto:  # Apenas verificar se o objeto de arquivo existe
-                try:
-                    # Ler o conteúdo binário da imagem
-                    foto_data = foto.read()
-                    
-                    detalhamento = detalhamentos[i] if i < len(detalhamentos) else ""
-                    
-                    # Inserir explicitamente o conteúdo binário da imagem com o ID da vistoria confirmado
-                    print(f"  📸 Inserindo foto {i+1}/{len(fotos)} para vistoria {id_vistoria}", file=sys.stderr)
-                    
-                    # VERIFICAÇÃO EXTRA: Confirmar que a vistoria existe antes de inserir
-                    cur.execute("SELECT 1 FROM VISTORIAS WHERE IDVISTORIA = %s", (id_vistoria,))
-                    if not cur.fetchone():
-                        print(f"  ❌ ALERTA: Vistoria com ID {id_vistoria} não encontrada!", file=sys.stderr)
-                        continue
-                    
-                    cur.execute(
-                        "INSERT INTO VISTORIA_ITENS (IDVISTORIA, FOTO) VALUES (%s, %s)",
-                        (id_vistoria, foto_data)
-                    )
-                    mysql.connection.commit()
-                    
-                    # VERIFICAÇÃO FINAL: Confirmar que o item foi inserido corretamente
-                    cur.execute("SELECT IDVISTORIA FROM VISTORIA_ITENS WHERE ID = LAST_INSERT_ID()")
-                    item_result = cur.fetchone()
-                    if item_result and item_result[0] != id_vistoria:
-                        print(f"  ❌ ALERTA: Item inserido com IDVISTORIA incorreto: {item_result[0]} != {id_vistoria}", file=sys.stderr)
-                        
-                except Exception as e:
-                    print(f"  ❌ Erro ao processar foto {i}: {str(e)}", file=sys.stderr)
+            print(f"✅ Checkpoint 11: Vistoria {id_vistoria} inserida", file=sys.stderr)
+            
+            for tipo_assinatura, dados in (('usuario', assinatura_usuario_bin), ('motorista', assinatura_motorista_bin)):
+                if dados:
+                    gravar_assinatura(cur, id_vistoria, tipo_assinatura, dados)
+            
+            total_itens = inserir_itens_vistoria(cur, id_vistoria, fotos_gravadas, detalhamentos)
+            
+            mysql.connection.commit()
+            print(f"✅ Checkpoint 12: COMMIT realizado ({total_itens} foto(s))", file=sys.stderr)
+        except Exception:
+            mysql.connection.rollback()
+            raise
+        finally:
+            cur.close()
         
-        cur.close()
+        consumir_midias_vistoria(midias)
         
-        print(f"✅ Checkpoint 15: Tudo OK! Redirecionando...", file=sys.stderr)
+        print(f"✅ Checkpoint 13: Tudo OK! Redirecionando...", file=sys.stderr)
         print("=" * 80, file=sys.stderr)
         
         flash('Vistoria salva com sucesso!', 'success')
@@ -1610,14 +4033,7 @@ def salvar_vistoria3():
         assinatura_motorista_data = request.form.get('assinatura_motorista')
         
         # Processar as assinaturas de base64 para binário, se existirem
-        assinatura_motorista_bin = None
-                    
-        if assinatura_motorista_data and ',' in assinatura_motorista_data:
-            assinatura_motorista_data = assinatura_motorista_data.split(',')[1]
-            try:
-                assinatura_motorista_bin = base64.b64decode(assinatura_motorista_data)
-            except Exception as e:
-                print(f"Erro ao decodificar assinatura: {str(e)}")
+        assinatura_motorista_bin = decodificar_assinatura(assinatura_motorista_data)
         
         # Iniciar transação
         cur = mysql.connection.cursor()
@@ -1627,6 +4043,20 @@ def salvar_vistoria3():
             fuso_horario = timezone('America/Manaus')
             data_hora = data_e_hora_atual.astimezone(fuso_horario)
             
+            # Processar todas as fotos (midias[] = já enviadas por /api/uploads)
+            midias = request.form.getlist('midias[]')
+            fotos = request.files.getlist('fotos[]')
+            detalhamentos = request.form.getlist('detalhamentos[]')
+            
+            print(f"Tipo de vistoria: {tipo}")
+            print(f"Número de fotos recebidas: {len(fotos)} (mídias: {len(midias)})")
+            print(f"Número de detalhamentos recebidos: {len(detalhamentos)}")
+            
+            
+            # Normalizar (em paralelo) e gravar no blob store antes do UPDATE,
+            # para não segurar o lock da vistoria durante o processamento
+            fotos_gravadas = obter_midias_vistoria(midias) if midias else gravar_fotos_vistoria(fotos)
+            
             print(f"Dados para UPDATE: data={data_hora}, combustivel={combustivel}, hodometro={hodometro}, obs={obs}, tipo={tipo}, id={id_vistoria}")
             
             # Use o valor de tipo do formulário em vez de definir estaticamente
@@ -1635,58 +4065,29 @@ def salvar_vistoria3():
                     DATA = %s,
                     COMBUSTIVEL = %s, 
                     HODOMETRO = %s,
-                    ASS_MOTORISTA = %s,
                     OBS = %s,
                     TIPO = %s
                     WHERE IDVISTORIA = %s 
                     """,
-                (data_hora, combustivel, hodometro, assinatura_motorista_bin, obs, tipo, id_vistoria)
+                (data_hora, combustivel, hodometro, obs, tipo, id_vistoria)
             )
             
             # Debug: Verificar se o update afetou alguma linha
             rows_affected = cur.rowcount
             print(f"Linhas afetadas pelo UPDATE: {rows_affected}")
             
-            # Processar todas as fotos
-            fotos = request.files.getlist('fotos[]')
-            detalhamentos = request.form.getlist('detalhamentos[]')
-            
-            print(f"Tipo de vistoria: {tipo}")
-            print(f"Número de fotos recebidas: {len(fotos)}")
-            print(f"Número de detalhamentos recebidos: {len(detalhamentos)}")
-            
+            # Como antes, sem assinatura no formulário a do motorista é removida
+            gravar_assinatura(cur, id_vistoria, 'motorista', assinatura_motorista_bin)
             
-            # Processar todas as fotos de uma vez
-            for i, foto in enumerate(fotos):
-                if foto and foto.filename:  # Verificar se o arquivo existe e tem um nome
-                    try:
-                        # Ler o conteúdo binário da imagem
-                        foto_data = foto.read()
-                        
-                        # Obter o detalhamento correspondente
-                        detalhamento = detalhamentos[i] if i < len(detalhamentos) else ""
-                        
-                        # Inserir a foto e o detalhamento
-                        print(f"Inserindo item {i} para vistoria {id_vistoria}")
-                        
-                        # Adicione o campo detalhamento à sua query se ele existir na tabela
-                        cur.execute(
-                            "INSERT INTO VISTORIA_ITENS (IDVISTORIA, FOTO, DETALHAMENTO) VALUES (%s, %s, %s)",
-                            (id_vistoria, foto_data, detalhamento)
-                        )
-                        
-                        # Verificar se o item foi inserido
-                        item_id = cur.lastrowid
-                        print(f"Item inserido com ID: {item_id}")
-                        
-                    except Exception as e:
-                        print(f"Erro ao processar foto {i}: {str(e)}")
-                        # Não fazemos rollback aqui para continuar processando outras fotos
+            total_itens = inserir_itens_vistoria(cur, id_vistoria, fotos_gravadas, detalhamentos)
+            print(f"Itens inseridos: {total_itens}")
             
             # Commit após todas as operações
             mysql.connection.commit()
             flash('Vistoria salva com sucesso!', 'success')
             
+            consumir_midias_vistoria(midias)
+            
         except Exception as e:
             # Se houver erro, fazemos rollback
             mysql.connection.rollback()
@@ -1724,164 +4125,273 @@ def salvar_foto():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/vistorias')
-def listar_vistorias():
-    cur = mysql.connection.cursor()
+# Seções da lista de vistorias: filtro de cada uma
+VISTORIAS_SITUACOES = {
+    'em_transito': "v.STATUS = 'EM_TRANSITO' AND v.TIPO = 'SAIDA'",
+    'pendentes': "v.TIPO IN ('INICIAL', 'CONFIRMACAO')",
+    'finalizadas': "v.TIPO = 'SAIDA' AND v.STATUS = 'FINALIZADA'",
+}
+VISTORIAS_POR_PAGINA = int(os.getenv('VISTORIAS_POR_PAGINA', 25))
+VISTORIAS_LIMITE_MAX = 100
+
+
+def filtros_lista_vistorias(args):
+    """
+    Lê os filtros da lista de vistorias (veiculo, data_inicio, data_fim) dos query params
     
-    # Buscar vistorias em trânsito (Saidas não finalizadas)
-    cur.execute("""
-        SELECT v.IDVISTORIA, 
-        CASE WHEN v.IDMOTORISTA='0'
-        THEN CONCAT('* ',v.NC_MOTORISTA)
-        ELSE m.NM_MOTORISTA END as MOTORISTA, 
-        CONCAT(ve.DS_MODELO,' - ',ve.NU_PLACA) AS VEICULO, 
-        v.DATA, v.TIPO, v.STATUS, v.OBS 
-        FROM VISTORIAS v
-        JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
-        JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
-        WHERE v.STATUS = 'EM_TRANSITO' AND v.TIPO = 'SAIDA'
-        ORDER BY v.DATA DESC
-    """)
-    vistorias_em_transito = cur.fetchall()
-    # Buscar vistorias em Pendentes
-    cur.execute("""
+    Raises:
+        ValueError: data fora do formato AAAA-MM-DD
+    """
+    filtros = {}
+    if args.get('veiculo', type=int):
+        filtros['veiculo'] = args.get('veiculo', type=int)
+    if args.get('data_inicio'):
+        filtros['data_inicio'] = datetime.strptime(args['data_inicio'], '%Y-%m-%d').date()
+    if args.get('data_fim'):
+        filtros['data_fim'] = datetime.strptime(args['data_fim'], '%Y-%m-%d').date()
+    return filtros
+
+
+def cursor_lista_vistorias(data, id_vistoria):
+    """Cursor opaco da próxima página: posição (DATA, IDVISTORIA) da última linha (DATA nula = vazio)"""
+    return f"{data.isoformat() if data else ''}_{id_vistoria}"
+
+
+def buscar_pagina_vistorias(cursor, situacao, filtros, apos=None, limite=VISTORIAS_POR_PAGINA):
+    """
+    Uma página de vistorias de uma seção, mais recentes primeiro
+    
+    Paginação por chave (keyset) em (DATA, IDVISTORIA): cada página custa o
+    mesmo, não importa o tamanho do histórico. Vistorias sem DATA vêm por
+    último (como no ORDER BY ... DESC do MySQL), em ordem de IDVISTORIA.
+    
+    Returns:
+        tuple: (linhas, proximo_cursor). Linhas no formato do template:
+               (IDVISTORIA, MOTORISTA, VEICULO, DATA, TIPO, STATUS, OBS, ID_DEVOLUCAO)
+    
+    Raises:
+        ValueError: cursor inválido
+    """
+    condicoes = [VISTORIAS_SITUACOES[situacao]]
+    parametros = []
+    
+    if 'veiculo' in filtros:
+        condicoes.append("v.IDVEICULO = %s")
+        parametros.append(filtros['veiculo'])
+    if 'data_inicio' in filtros:
+        condicoes.append("v.DATA >= %s")
+        parametros.append(filtros['data_inicio'])
+    if 'data_fim' in filtros:
+        condicoes.append("v.DATA < %s")
+        parametros.append(filtros['data_fim'] + timedelta(days=1))
+    
+    if apos:
+        data_cursor, _, id_cursor = apos.rpartition('_')
+        id_cursor = int(id_cursor)
+        if data_cursor:
+            data_cursor = datetime.fromisoformat(data_cursor)
+            # (DATA, ID) < cursor não vale para DATA nula: elas vêm depois de todas as datadas
+            condicoes.append("(v.DATA < %s OR (v.DATA = %s AND v.IDVISTORIA < %s) OR v.DATA IS NULL)")
+            parametros.extend([data_cursor, data_cursor, id_cursor])
+        else:
+            condicoes.append("(v.DATA IS NULL AND v.IDVISTORIA < %s)")
+            parametros.append(id_cursor)
+    
+    # Devolução por JOIN (no máximo uma por saída) em vez de subconsulta por linha;
+    # LEFT JOIN no motorista para não perder as vistorias com IDMOTORISTA = '0'
+    cursor.execute(f"""
         SELECT v.IDVISTORIA, 
         CASE WHEN v.IDMOTORISTA='0'
         THEN CONCAT('* ',v.NC_MOTORISTA)
         ELSE m.NM_MOTORISTA END as MOTORISTA,
         CONCAT(ve.DS_MODELO,' - ',ve.NU_PLACA) AS VEICULO,
-        v.DATA, v.TIPO, v.STATUS, v.OBS 
+        v.DATA, v.TIPO, v.STATUS, v.OBS,
+        COALESCE(d.IDVISTORIA, '') AS ID_DEVOLUCAO
         FROM VISTORIAS v
-        JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
+        LEFT JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
         JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
-        WHERE v.TIPO IN ('INICIAL', 'CONFIRMACAO')
-        ORDER BY v.DATA DESC
-    """)
-    vistorias_pendentes = cur.fetchall()
-    # Buscar vistorias finalizadas (Saidas com devolução ou devoluções)
+        LEFT JOIN VISTORIAS d ON d.VISTORIA_SAIDA_ID = v.IDVISTORIA
+        WHERE {' AND '.join(condicoes)}
+        ORDER BY v.DATA DESC, v.IDVISTORIA DESC
+        LIMIT %s
+    """, parametros + [limite + 1])
+    linhas = cursor.fetchall()
+    
+    proximo = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        proximo = cursor_lista_vistorias(linhas[-1][3], linhas[-1][0])
+    
+    return linhas, proximo
+
+
+@app.route('/vistorias')
+def listar_vistorias():
+    try:
+        filtros = filtros_lista_vistorias(request.args)
+    except ValueError:
+        filtros = {}
+    
+    cur = mysql.connection.cursor()
+    
+    # Primeira página de cada seção; as demais vêm de /api/vistorias sob demanda
+    paginas = {
+        situacao: buscar_pagina_vistorias(cur, situacao, filtros)
+        for situacao in VISTORIAS_SITUACOES
+    }
+    
     cur.execute("""
-        SELECT v.IDVISTORIA, 
-        CASE WHEN v.IDMOTORISTA='0'
-        THEN CONCAT('* ',v.NC_MOTORISTA)
-        ELSE m.NM_MOTORISTA END as MOTORISTA,		
-        CONCAT(ve.DS_MODELO,' - ',ve.NU_PLACA) AS VEICULO, 
-        v.DATA, v.TIPO, v.STATUS, v.OBS, 
-        COALESCE((SELECT IDVISTORIA FROM VISTORIAS WHERE VISTORIA_SAIDA_ID = v.IDVISTORIA),'') AS ID_DEVOLUCAO
-        FROM VISTORIAS v
-        JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
-        JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
-        WHERE v.TIPO = 'SAIDA' 
-        AND v.STATUS = 'FINALIZADA'
-        ORDER BY v.DATA DESC
+        SELECT ID_VEICULO, CONCAT(DS_MODELO,' - ',NU_PLACA) AS VEICULO
+        FROM CAD_VEICULOS ORDER BY DS_MODELO, NU_PLACA
     """)
-    vistorias_finalizadas = cur.fetchall()
+    veiculos = cur.fetchall()
     
     cur.close()
     
     return render_template(
         'vistorias.html', 
-        vistorias_em_transito=vistorias_em_transito,
-        vistorias_pendentes=vistorias_pendentes,
-        vistorias_finalizadas=vistorias_finalizadas
+        vistorias_em_transito=paginas['em_transito'][0],
+        vistorias_pendentes=paginas['pendentes'][0],
+        vistorias_finalizadas=paginas['finalizadas'][0],
+        proximos={situacao: pagina[1] for situacao, pagina in paginas.items()},
+        filtros=filtros,
+        veiculos=veiculos
     )
 
+
+@app.route('/api/vistorias')
+def api_listar_vistorias():
+    """
+    Lista paginada de vistorias
+    
+    Query params:
+        situacao: em_transito | pendentes | finalizadas (padrão)
+        veiculo, data_inicio, data_fim (AAAA-MM-DD): filtros opcionais
+        apos: cursor `proximo` da página anterior
+        limite: linhas por página (padrão VISTORIAS_POR_PAGINA, máx. VISTORIAS_LIMITE_MAX)
+    """
+    situacao = request.args.get('situacao', 'finalizadas')
+    if situacao not in VISTORIAS_SITUACOES:
+        return jsonify({'success': False, 'error': f"Situação inválida (use: {', '.join(VISTORIAS_SITUACOES)})"}), 400
+    
+    limite = min(max(request.args.get('limite', VISTORIAS_POR_PAGINA, type=int), 1), VISTORIAS_LIMITE_MAX)
+    
+    cursor = mysql.connection.cursor()
+    try:
+        filtros = filtros_lista_vistorias(request.args)
+        linhas, proximo = buscar_pagina_vistorias(
+            cursor, situacao, filtros, request.args.get('apos'), limite
+        )
+        
+        vistorias = [{
+            'id': linha[0],
+            'motorista': linha[1],
+            'veiculo': linha[2],
+            'data': linha[3].strftime('%d/%m/%Y %H:%M') if linha[3] else '',
+            'tipo': linha[4],
+            'status': linha[5],
+            'obs': linha[6],
+            'id_devolucao': linha[7] or None
+        } for linha in linhas]
+        
+        return jsonify({
+            'success': True,
+            'vistorias': vistorias,
+            'proximo': proximo
+        })
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Filtro ou cursor inválido'}), 400
+    except Exception as e:
+        print(f"❌ Erro ao listar vistorias: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        cursor.close()
+
+# Fotos renderizadas por grupo na página; o resto vem da galeria ao rolar
+GALERIA_POR_PAGINA = int(os.getenv('GALERIA_POR_PAGINA', 12))
+GALERIA_LIMITE_MAX = 100
+
+
+def item_galeria(item_id, detalhamento, largura, altura):
+    """Item de VISTORIA_ITENS no formato da galeria (template e API)"""
+    return {
+        'id': item_id,
+        'detalhamento': detalhamento,
+        'largura': largura,
+        'altura': altura
+    }
+
+
+def carregar_par_vistoria(cursor, id_vistoria):
+    """
+    Carrega a vistoria, a saída/devolução relacionada e os itens das duas em uma consulta
+    
+    Assinaturas vêm só como indicador (1/None) nas posições 9 e 10: os bytes
+    são servidos por get_assinatura.
+    
+    Returns:
+        tuple: (vistoria, vistoria_saida, vistoria_devolucao, itens_por_vistoria)
+               itens_por_vistoria = {IDVISTORIA: [item_galeria, ...]}
+    """
+    cursor.execute(f"""
+        SELECT v.IDVISTORIA, 
+               CASE WHEN v.IDMOTORISTA='0'
+               THEN CONCAT('* ',v.NC_MOTORISTA)
+               ELSE m.NM_MOTORISTA END as MOTORISTA, 
+               CONCAT(ve.DS_MODELO,' - ',ve.NU_PLACA) AS VEICULO, 
+               v.DATA, v.TIPO, v.STATUS, v.COMBUSTIVEL, ve.DS_MODELO, v.VISTORIA_SAIDA_ID, 
+               {sql_tem_assinatura('usuario')}, {sql_tem_assinatura('motorista')},
+               v.HODOMETRO, v.OBS, v.USUARIO, 
+               v.DATA_SAIDA, v.DATA_RETORNO, v.NU_SEI, v.NC_MOTORISTA,
+               i.ID, i.DETALHAMENTO, i.FOTO_LARGURA, i.FOTO_ALTURA
+        FROM (
+            SELECT %s AS IDVISTORIA
+            UNION SELECT VISTORIA_SAIDA_ID FROM VISTORIAS WHERE IDVISTORIA = %s
+            UNION SELECT IDVISTORIA FROM VISTORIAS WHERE VISTORIA_SAIDA_ID = %s
+        ) par
+        JOIN VISTORIAS v ON v.IDVISTORIA = par.IDVISTORIA
+        LEFT JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
+        JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
+        LEFT JOIN VISTORIA_ITENS i ON i.IDVISTORIA = v.IDVISTORIA
+        ORDER BY v.IDVISTORIA, i.ID
+    """, (id_vistoria, id_vistoria, id_vistoria))
+    
+    vistorias = {}
+    itens_por_vistoria = {}
+    for linha in cursor.fetchall():
+        vistorias.setdefault(linha[0], linha[:18])
+        itens = itens_por_vistoria.setdefault(linha[0], [])
+        if linha[18] is not None:
+            itens.append(item_galeria(*linha[18:22]))
+    
+    vistoria = vistorias.get(id_vistoria)
+    vistoria_saida = None
+    vistoria_devolucao = None
+    
+    if vistoria:
+        # Saída só para devolução; devolução só para saída (a primeira, como antes)
+        if vistoria[4] == 'DEVOLUCAO' and vistoria[8]:
+            vistoria_saida = vistorias.get(vistoria[8])
+        if vistoria[4] == 'SAIDA':
+            vistoria_devolucao = next(
+                (v for v in vistorias.values() if v[8] == id_vistoria), None
+            )
+    
+    return vistoria, vistoria_saida, vistoria_devolucao, itens_por_vistoria
+
+
 @app.route('/vistoria/<int:id>')
 def ver_vistoria(id):
     try:
         cur = mysql.connection.cursor()
-        # Buscar detalhes da vistoria
-        cur.execute("""
-            SELECT v.IDVISTORIA, 
-                   CASE WHEN v.IDMOTORISTA='0'
-                   THEN CONCAT('* ',v.NC_MOTORISTA)
-                   ELSE m.NM_MOTORISTA END as MOTORISTA, 
-                   CONCAT(ve.DS_MODELO,' - ',ve.NU_PLACA) AS VEICULO, 
-                   v.DATA, v.TIPO, v.STATUS, v.COMBUSTIVEL, ve.DS_MODELO, v.VISTORIA_SAIDA_ID, 
-                   v.ASS_USUARIO, v.ASS_MOTORISTA, v.HODOMETRO, v.OBS, v.USUARIO, 
-                   v.DATA_SAIDA, v.DATA_RETORNO, v.NU_SEI, v.NC_MOTORISTA
-            FROM VISTORIAS v
-            LEFT JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
-            JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
-            WHERE v.IDVISTORIA = %s
-        """, (id,))
-        vistoria = cur.fetchone()
-       
-        # Verificações seguras para evitar erros
-        vistoria_saida = None
-        vistoria_saida_itens = []
-        vistoria_devolucao = None
-        vistoria_devolucao_itens = []
-        itens = []
-        
-        if vistoria:
-            # Se for uma vistoria de devolução, buscar também a vistoria de saida
-            if vistoria[4] == 'DEVOLUCAO' and vistoria[8]:
-                cur.execute("""
-                    SELECT v.IDVISTORIA, 
-                           CASE WHEN v.IDMOTORISTA='0'
-                           THEN CONCAT('* ',v.NC_MOTORISTA)
-                           ELSE m.NM_MOTORISTA END as MOTORISTA,
-                           CONCAT(ve.DS_MODELO,' - ',ve.NU_PLACA) AS VEICULO, 
-                           v.DATA, v.TIPO, v.STATUS, v.COMBUSTIVEL, ve.DS_MODELO,
-                           v.VISTORIA_SAIDA_ID, v.ASS_USUARIO, v.ASS_MOTORISTA, v.HODOMETRO, 
-                           v.OBS, v.USUARIO, v.NC_MOTORISTA
-                    FROM VISTORIAS v
-                    LEFT JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
-                    JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
-                    WHERE v.IDVISTORIA = %s
-                """, (vistoria[8],))
-                vistoria_saida = cur.fetchone()
-                
-                # Buscar fotos da vistoria de saída
-                cur.execute("""
-                    SELECT ID, DETALHAMENTO
-                    FROM VISTORIA_ITENS
-                    WHERE IDVISTORIA = %s
-                """, (vistoria[8],))
-                vistoria_saida_itens = cur.fetchall() or []
-            
-            # Se for uma vistoria de saida, buscar se já existe uma vistoria de devolução
-            if vistoria[4] == 'SAIDA':
-                cur.execute("""
-                    SELECT v.IDVISTORIA, 
-                           CASE WHEN v.IDMOTORISTA='0'
-                           THEN CONCAT('* ',v.NC_MOTORISTA)
-                           ELSE m.NM_MOTORISTA END as MOTORISTA,
-                           CONCAT(ve.DS_MODELO,' - ',ve.NU_PLACA) AS VEICULO, 
-                           v.DATA, v.TIPO, v.STATUS, v.COMBUSTIVEL, ve.DS_MODELO,
-                           v.VISTORIA_SAIDA_ID, v.ASS_USUARIO, v.ASS_MOTORISTA, v.HODOMETRO, 
-                           v.OBS, v.USUARIO, v.NC_MOTORISTA
-                    FROM VISTORIAS v
-                    LEFT JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
-                    JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
-                    WHERE v.VISTORIA_SAIDA_ID = %s
-                """, (id,))
-                vistoria_devolucao = cur.fetchone()
-                
-                # Buscar fotos da vistoria de devolução
-                if vistoria_devolucao:
-                    cur.execute("""
-                        SELECT ID, DETALHAMENTO
-                        FROM VISTORIA_ITENS
-                        WHERE IDVISTORIA = %s
-                    """, (vistoria_devolucao[0],))
-                    vistoria_devolucao_itens = cur.fetchall() or []
-            
-            # Buscar fotos desta vistoria atual
-            cur.execute("""
-                SELECT ID, DETALHAMENTO
-                FROM VISTORIA_ITENS
-                WHERE IDVISTORIA = %s
-            """, (id,))
-            itens_raw = cur.fetchall() or []
-            
-            # Converter para dicionários para uso no template
-            itens = [{'id': item[0], 'detalhamento': item[1]} for item in itens_raw]
-            vistoria_saida_itens = [{'id': item[0], 'detalhamento': item[1]} for item in vistoria_saida_itens]
-            vistoria_devolucao_itens = [{'id': item[0], 'detalhamento': item[1]} for item in vistoria_devolucao_itens]
-        
+        vistoria, vistoria_saida, vistoria_devolucao, itens_por_vistoria = carregar_par_vistoria(cur, id)
         cur.close()
         
+        # Verificações seguras para evitar erros
+        itens = itens_por_vistoria.get(id, [])
+        vistoria_saida_itens = itens_por_vistoria.get(vistoria_saida[0], []) if vistoria_saida else []
+        vistoria_devolucao_itens = itens_por_vistoria.get(vistoria_devolucao[0], []) if vistoria_devolucao else []
+        
         return render_template(
             'ver_vistoria.html', 
             vistoria=vistoria, 
@@ -1889,28 +4399,397 @@ def ver_vistoria(id):
             vistoria_saida=vistoria_saida,
             vistoria_saida_itens=vistoria_saida_itens,
             vistoria_devolucao=vistoria_devolucao,
-            vistoria_devolucao_itens=vistoria_devolucao_itens
+            vistoria_devolucao_itens=vistoria_devolucao_itens,
+            galeria_por_pagina=GALERIA_POR_PAGINA
         )
     except Exception as e:
         # Adiciona log do erro para depuração
         app.logger.error(f"Erro na rota ver_vistoria: {str(e)}")
         
-        # Encerra o cursor se ainda estiver aberto
-        if 'cur' in locals() and cur:
-            cur.close()
+        # Encerra o cursor se ainda estiver aberto
+        if 'cur' in locals() and cur:
+            cur.close()
+        
+        # Retorna uma página de erro amigável
+        return render_template('error.html', error_message=str(e)), 500
+
+
+@app.route('/api/vistoria/<int:id>/fotos')
+def galeria_vistoria(id):
+    """
+    Galeria paginada das fotos de uma vistoria
+    
+    Query params:
+        apos: ID do último item recebido (cursor; omitir na primeira página)
+        limite: itens por página (padrão GALERIA_POR_PAGINA, máx. GALERIA_LIMITE_MAX)
+    """
+    apos = request.args.get('apos', 0, type=int)
+    limite = min(max(request.args.get('limite', GALERIA_POR_PAGINA, type=int), 1), GALERIA_LIMITE_MAX)
+    
+    cursor = mysql.connection.cursor()
+    try:
+        # Uma linha a mais só para saber se existe próxima página
+        cursor.execute("""
+            SELECT ID, DETALHAMENTO, FOTO_LARGURA, FOTO_ALTURA
+            FROM VISTORIA_ITENS
+            WHERE IDVISTORIA = %s AND ID > %s
+            ORDER BY ID
+            LIMIT %s
+        """, (id, apos, limite + 1))
+        registros = cursor.fetchall()
+        
+        itens = []
+        for registro in registros[:limite]:
+            item = item_galeria(*registro)
+            item['thumb_url'] = url_for('get_foto', item_id=item['id'], size='thumb')
+            item['medium_url'] = url_for('get_foto', item_id=item['id'], size='medium')
+            item['url'] = url_for('get_foto', item_id=item['id'])
+            itens.append(item)
+        
+        proxima = None
+        if len(registros) > limite:
+            proxima = url_for('galeria_vistoria', id=id, apos=itens[-1]['id'], limite=limite)
+        
+        return jsonify({
+            'success': True,
+            'itens': itens,
+            'proxima': proxima
+        })
+    except Exception as e:
+        print(f"❌ Erro na galeria da vistoria {id}: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        cursor.close()
+    
+# ============================================================
+# DOSSIÊ DA VISTORIA (PDF)
+# ============================================================
+# Saída + devolução, fotos, assinaturas, hodômetro e combustível em um PDF.
+# O arquivo pronto fica no blob store como 'dossie_<versão>', onde a versão é
+# o hash do conteúdo da vistoria: qualquer alteração gera um dossiê novo, e o
+# anterior (apontado por 'dossie_vistoria_<id>') é removido em seguida.
+DOSSIE_FOTO_PX = int(os.getenv('DOSSIE_FOTO_PX', 1000))
+DOSSIE_FOTO_QUALIDADE = 70
+DOSSIE_LAYOUT = 1  # incrementar ao mudar o layout: invalida os PDFs gerados
+DOSSIE_CACHE_CONTROL = 'private, no-cache'
+
+
+def reduzir_foto_dossie(item):
+    """
+    Lê, decodifica e reduz uma foto para o dossiê (executada no pool de threads)
+    
+    Args:
+        item: (item_id, foto_hash, dados). Com foto_hash o original é lido do
+              blob store aqui, no worker; sem ele, `dados` traz o BLOB legado
+    
+    Returns:
+        tuple: (jpeg, largura, altura) ou None se a imagem não abrir
+    """
+    item_id, foto_hash, dados = item
+    try:
+        origem = blob_store.abrir(foto_hash) if foto_hash else BytesIO(dados)
+    except FileNotFoundError:
+        app.logger.error(f"Dossiê: foto {item_id} ({foto_hash}) ausente no blob store")
+        return None
+    
+    try:
+        with origem, Image.open(origem) as original:
+            original.draft('RGB', (DOSSIE_FOTO_PX, DOSSIE_FOTO_PX))  # JPEG: decodifica já reduzido
+            imagem = ImageOps.exif_transpose(original)
+            if imagem.mode != 'RGB':
+                imagem = imagem.convert('RGB')
+            imagem.thumbnail((DOSSIE_FOTO_PX, DOSSIE_FOTO_PX), Image.LANCZOS)
+            
+            saida = BytesIO()
+            imagem.save(saida, 'JPEG', quality=DOSSIE_FOTO_QUALIDADE, optimize=True)
+        return saida.getvalue(), imagem.width, imagem.height
+    except Exception as e:
+        print(f"⚠️ Foto ignorada no dossiê: {str(e)}")
+        return None
+
+
+def carregar_dossie_vistoria(cursor, id_vistoria):
+    """
+    Dados do dossiê (sem bytes de fotos/assinaturas) e a versão do conteúdo
+    
+    Returns:
+        dict: {'secoes', 'itens', 'fotos', 'assinaturas', 'versao'} ou None
+              se a vistoria não existir. secoes = saída antes da devolução.
+    """
+    vistoria, vistoria_saida, vistoria_devolucao, itens_por_vistoria = carregar_par_vistoria(cursor, id_vistoria)
+    if not vistoria:
+        return None
+    
+    if vistoria[4] == 'DEVOLUCAO':
+        secoes = [v for v in (vistoria_saida, vistoria) if v]
+    elif vistoria[4] == 'SAIDA':
+        secoes = [v for v in (vistoria, vistoria_devolucao) if v]
+    else:
+        secoes = [vistoria]
+    
+    ids = [secao[0] for secao in secoes]
+    marcadores = ', '.join(['%s'] * len(ids))
+    
+    cursor.execute(f"SELECT ID, FOTO_HASH FROM VISTORIA_ITENS WHERE IDVISTORIA IN ({marcadores})", ids)
+    fotos = dict(cursor.fetchall())
+    
+    cursor.execute(f"""
+        SELECT IDVISTORIA, TIPO, HASH FROM VISTORIA_ASSINATURAS
+        WHERE IDVISTORIA IN ({marcadores})
+    """, ids)
+    assinaturas = {(linha[0], linha[1]): linha[2] for linha in cursor.fetchall()}
+    
+    # Itens e assinaturas legadas não mudam no lugar: IDs + hashes bastam
+    conteudo = repr((DOSSIE_LAYOUT, secoes, sorted(fotos.items()), sorted(assinaturas.items())))
+    
+    return {
+        'secoes': secoes,
+        'itens': itens_por_vistoria,
+        'fotos': fotos,
+        'assinaturas': assinaturas,
+        'versao': hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+    }
+
+
+def reduzir_fotos_dossie(cursor, dossie):
+    """
+    Fotos do dossiê reduzidas em paralelo, com no máximo FOTO_WORKERS originais em memória
+    
+    As do blob store são lidas pelo próprio worker; as legadas (BLOB no banco,
+    que só o cursor da requisição lê) vão em lotes de FOTO_WORKERS.
+    
+    Returns:
+        dict: {item_id: (jpeg, largura, altura) | None}
+    """
+    no_blob = [(item_id, foto_hash, None) for item_id, foto_hash in dossie['fotos'].items() if foto_hash]
+    legadas = [item_id for item_id, foto_hash in dossie['fotos'].items() if not foto_hash]
+    
+    reduzidas = dict(zip([item[0] for item in no_blob], mapear_em_threads(reduzir_foto_dossie, no_blob)))
+    
+    for inicio in range(0, len(legadas), FOTO_WORKERS):
+        lote = legadas[inicio:inicio + FOTO_WORKERS]
+        marcadores = ', '.join(['%s'] * len(lote))
+        cursor.execute(f"SELECT ID, FOTO FROM VISTORIA_ITENS WHERE ID IN ({marcadores})", lote)
+        blobs = dict(cursor.fetchall())
+        itens = [(item_id, None, blobs[item_id]) for item_id in lote if blobs.get(item_id)]
+        del blobs
+        reduzidas.update(zip([item[0] for item in itens], mapear_em_threads(reduzir_foto_dossie, itens)))
+    
+    return reduzidas
+
+
+def ler_assinaturas_dossie(cursor, dossie):
+    """
+    Bytes originais das assinaturas do dossiê (pequenas: lidas de uma vez)
+    
+    Returns:
+        dict: {(id_vistoria, tipo): bytes}
+    """
+    assinaturas = {}
+    for secao in dossie['secoes']:
+        for tipo, posicao in (('usuario', 9), ('motorista', 10)):
+            if not secao[posicao]:
+                continue
+            if (secao[0], tipo) in dossie['assinaturas']:
+                cursor.execute("SELECT DADOS FROM VISTORIA_ASSINATURAS WHERE IDVISTORIA = %s AND TIPO = %s",
+                               (secao[0], tipo))
+            else:
+                cursor.execute(f"SELECT {ASSINATURA_COLUNAS[tipo]} FROM VISTORIAS WHERE IDVISTORIA = %s",
+                               (secao[0],))
+            assinaturas[(secao[0], tipo)] = cursor.fetchone()[0]
+    
+    return assinaturas
+
+
+def gerar_dossie_vistoria(cursor, dossie, destino):
+    """Monta o PDF do dossiê no arquivo `destino` (fotos reduzidas em paralelo)"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import (SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer,
+                                    PageBreak, Image as ImagemPDF)
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import cm
+    from reportlab.lib.enums import TA_CENTER
+    from xml.sax.saxutils import escape
+    
+    t0 = time.time()
+    reduzidas = reduzir_fotos_dossie(cursor, dossie)
+    assinaturas = ler_assinaturas_dossie(cursor, dossie)
+    
+    def imagem_ajustada(dados, largura, altura, largura_max, altura_max):
+        escala = min(largura_max / largura, altura_max / altura)
+        return ImagemPDF(BytesIO(dados), width=largura * escala, height=altura * escala)
+    
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'],
+                                 fontSize=16, textColor=colors.HexColor('#1a73e8'),
+                                 spaceAfter=8, alignment=TA_CENTER, fontName='Helvetica-Bold')
+    secao_style = ParagraphStyle('Secao', parent=styles['Heading2'], fontSize=13, spaceAfter=6)
+    normal_style = ParagraphStyle('Normal9', parent=styles['Normal'], fontSize=9)
+    legenda_style = ParagraphStyle('Legenda', parent=styles['Normal'], fontSize=8,
+                                   alignment=TA_CENTER, textColor=colors.HexColor('#555555'))
+    
+    doc = SimpleDocTemplate(destino, pagesize=A4,
+                            rightMargin=1.5*cm, leftMargin=1.5*cm,
+                            topMargin=1.5*cm, bottomMargin=1.5*cm,
+                            title=f"Vistoria {dossie['secoes'][0][0]}")
+    largura_util = A4[0] - 3*cm
+    
+    elements = [Paragraph('Dossiê de Vistoria de Veículo', title_style)]
+    
+    for indice, v in enumerate(dossie['secoes']):
+        if indice:
+            elements.append(PageBreak())
+        
+        titulo = {'SAIDA': 'Vistoria de Saída', 'DEVOLUCAO': 'Vistoria de Devolução'}.get(v[4], f'Vistoria ({v[4]})')
+        elements.append(Paragraph(f'{titulo} nº {v[0]}', secao_style))
+        
+        # Dados da vistoria
+        campos = [
+            ('Motorista', v[1]),
+            ('Veículo', v[2]),
+            ('Data', v[3].strftime('%d/%m/%Y %H:%M') if v[3] else ''),
+            ('Hodômetro', v[11]),
+            ('Combustível', f'{v[6]}%' if v[6] is not None else ''),
+            ('Vistoriador', v[13]),
+        ]
+        if v[16]:
+            campos.append(('Nº do SEI', v[16]))
+        if v[14] and v[15]:
+            campos.append(('Período do Deslocamento', f'{v[14]} a {v[15]}'))
+        if v[12]:
+            campos.append(('Observações', v[12]))
+        
+        dados_tabela = [[Paragraph(f'<b>{rotulo}</b>', normal_style),
+                         Paragraph(escape(str(valor if valor is not None else '')), normal_style)]
+                        for rotulo, valor in campos]
+        tabela = Table(dados_tabela, colWidths=[4.5*cm, largura_util - 4.5*cm])
+        tabela.setStyle(TableStyle([
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#cccccc')),
+            ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f2f2f2')),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ]))
+        elements.extend([tabela, Spacer(1, 0.4*cm)])
+        
+        # Fotos em duas colunas
+        celulas = []
+        largura_foto = largura_util / 2 - 0.4*cm
+        for item in dossie['itens'].get(v[0], []):
+            reduzida = reduzidas.get(item['id'])
+            if not reduzida:
+                continue
+            jpeg, largura, altura = reduzida
+            celulas.append([
+                imagem_ajustada(jpeg, largura, altura, largura_foto, 7*cm),
+                Paragraph(escape(item['detalhamento'] or ''), legenda_style)
+            ])
+        
+        if celulas:
+            elements.append(Paragraph('<b>Fotos</b>', normal_style))
+            linhas = [celulas[i:i + 2] + [''] * (2 - len(celulas[i:i + 2])) for i in range(0, len(celulas), 2)]
+            grade = Table(linhas, colWidths=[largura_util / 2] * 2)
+            grade.setStyle(TableStyle([
+                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+                ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+            ]))
+            elements.extend([grade, Spacer(1, 0.4*cm)])
+        
+        # Assinaturas
+        linha_assinaturas = []
+        for tipo, rotulo in (('usuario', 'Assinatura do Vistoriador'), ('motorista', 'Assinatura do Motorista')):
+            dados = assinaturas.get((v[0], tipo))
+            conteudo = Paragraph('Sem assinatura', legenda_style)
+            if dados:
+                try:
+                    with Image.open(BytesIO(dados)) as assinatura:
+                        largura, altura = assinatura.size
+                    conteudo = imagem_ajustada(dados, largura, altura, largura_util / 2 - 1*cm, 3*cm)
+                except Exception as e:
+                    print(f"⚠️ Assinatura {tipo} da vistoria {v[0]} ignorada no dossiê: {str(e)}")
+            linha_assinaturas.append([conteudo, Paragraph(rotulo, legenda_style)])
         
-        # Retorna uma página de erro amigável
-        return render_template('error.html', error_message=str(e)), 500
+        tabela_assinaturas = Table([linha_assinaturas], colWidths=[largura_util / 2] * 2)
+        tabela_assinaturas.setStyle(TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'BOTTOM'),
+        ]))
+        elements.append(tabela_assinaturas)
+    
+    data_geracao = datetime.now(timezone('America/Manaus')).strftime('%d/%m/%Y às %H:%M')
+    elements.extend([Spacer(1, 0.6*cm), Paragraph(f'Documento gerado em {data_geracao}', legenda_style)])
+    
+    doc.build(elements)
+    print(f"📄 Dossiê da vistoria {dossie['secoes'][0][0]} gerado em {time.time() - t0:.2f}s "
+          f"({len(reduzidas)} foto(s))")
+
+
+def substituir_dossie_anterior(dossie, chave):
+    """
+    Aponta a vistoria para o dossiê novo e remove a versão anterior do blob store
+    
+    O ponteiro fica em 'dossie_vistoria_<id da primeira seção>': saída e
+    devolução geram o mesmo dossiê e compartilham o ponteiro.
+    """
+    ponteiro = f"dossie_vistoria_{dossie['secoes'][0][0]}"
+    try:
+        with blob_store.abrir(ponteiro) as origem:
+            anterior = origem.read().decode('ascii')
+    except FileNotFoundError:
+        anterior = None
+    
+    blob_store.gravar_como(ponteiro, BytesIO(chave.encode('ascii')))
+    if anterior and anterior != chave:
+        blob_store.remover(anterior)
+
+
+@app.route('/vistoria/<int:id>/pdf')
+@login_required
+def vistoria_pdf(id):
+    """Dossiê em PDF da vistoria (gerado uma vez por versão do conteúdo)"""
+    download_name = f'vistoria_{id}.pdf'
+    
+    cur = mysql.connection.cursor()
+    try:
+        dossie = carregar_dossie_vistoria(cur, id)
+        if not dossie:
+            return "Vistoria não encontrada", 404
+        
+        versao = dossie['versao']
+        if request.if_none_match.contains(versao):
+            return enviar_imagem(None, versao, 'application/pdf', download_name, DOSSIE_CACHE_CONTROL)
+        
+        chave = f'dossie_{versao}'
+        if not blob_store.existe(chave):
+            # Monta em arquivo temporário (não em memória) e publica no blob store
+            with tempfile.TemporaryFile() as temporario:
+                gerar_dossie_vistoria(cur, dossie, temporario)
+                temporario.seek(0)
+                blob_store.gravar_como(chave, temporario)
+            substituir_dossie_anterior(dossie, chave)
+    except Exception as e:
+        app.logger.error(f"Erro ao gerar dossiê da vistoria {id}: {str(e)}")
+        import traceback
+        app.logger.error(traceback.format_exc())
+        return f"Erro ao gerar dossiê: {str(e)}", 500
+    finally:
+        cur.close()
     
+    # Enviado em partes a partir do blob store (com suporte a Range)
+    origem = blob_store.caminho(chave) or blob_store.abrir(chave)
+    return enviar_imagem(origem, versao, 'application/pdf', download_name, DOSSIE_CACHE_CONTROL)
+
+
 @app.route('/vistoria_finaliza/<int:id>')
 def vistoria_finaliza(id):
     cur = mysql.connection.cursor()
     
     # Buscar detalhes da vistoria
-    cur.execute("""
+    cur.execute(f"""
         SELECT v.IDVISTORIA, m.NM_MOTORISTA as MOTORISTA, CONCAT(DS_MODELO,' - ',NU_PLACA) AS VEICULO, 
                v.DATA, v.TIPO, v.STATUS, v.COMBUSTIVEL, ve.DS_MODELO,
-               v.VISTORIA_SAIDA_ID, v.ASS_USUARIO, v.ASS_MOTORISTA, v.HODOMETRO, v.OBS
+               v.VISTORIA_SAIDA_ID, {sql_tem_assinatura('usuario')}, {sql_tem_assinatura('motorista')},
+               v.HODOMETRO, v.OBS
         FROM VISTORIAS v
         JOIN CAD_MOTORISTA m ON v.IDMOTORISTA = m.ID_MOTORISTA
         JOIN CAD_VEICULOS ve ON v.IDVEICULO = ve.ID_VEICULO
@@ -1978,15 +4857,14 @@ def salvar_assinatura():
         try:
             # Conecta ao banco de dados
             cur = mysql.connection.cursor()
-            cur.execute("UPDATE VISTORIAS SET TIPO = 'SAIDA', ASS_USUARIO = %s WHERE IDVISTORIA = %s", 
-                        (img_binary, vistoria_id))
-                        
-            # Fecha a conexão
-            cur.close()
-            
-            # Verifica se alguma linha foi afetada
-            if cur.rowcount == 0:
+            # Verifica se a vistoria existe (rowcount do UPDATE é 0 se TIPO já era SAIDA)
+            cur.execute("SELECT 1 FROM VISTORIAS WHERE IDVISTORIA = %s", (vistoria_id,))
+            if not cur.fetchone():
+                cur.close()
                 return jsonify({'success': False, 'message': f'Vistoria ID {vistoria_id} não encontrada'}), 404
+            
+            cur.execute("UPDATE VISTORIAS SET TIPO = 'SAIDA' WHERE IDVISTORIA = %s", (vistoria_id,))
+            gravar_assinatura(cur, int(vistoria_id), 'usuario', img_binary)
                 
             # Commit das alterações
             mysql.connection.commit()
@@ -2004,46 +4882,136 @@ def salvar_assinatura():
         app.logger.error(f"Erro interno: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/get_foto/<int:item_id>')
-def get_foto(item_id):
-    cur = mysql.connection.cursor()
-    cur.execute("SELECT FOTO FROM VISTORIA_ITENS WHERE ID = %s", (item_id,))
-    foto = cur.fetchone()
-    cur.close()
+# Foto de um item nunca muda (novo conteúdo = novo item): cache permanente.
+# Assinaturas podem ser regravadas na mesma URL: o navegador revalida (304).
+FOTO_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+ASSINATURA_CACHE_CONTROL = 'private, no-cache'
+
+
+def enviar_imagem(origem, etag, mimetype, download_name, cache_control):
+    """
+    Envia a imagem com ETag forte; responde 304 para If-None-Match e 206 para Range
     
-    if foto and foto[0]:
-        return send_file(
-            BytesIO(foto[0]),
-            mimetype='image/jpeg',
+    Args:
+        origem: caminho no disco ou stream (None = apenas 304)
+    """
+    if request.if_none_match.contains(etag) or origem is None:
+        resposta = make_response('', 304)
+        resposta.set_etag(etag)
+    else:
+        resposta = send_file(
+            origem,
+            mimetype=mimetype,
             as_attachment=False,
-            download_name=f'foto_{item_id}.jpg'
+            download_name=download_name,
+            conditional=True,
+            etag=etag
         )
+    resposta.headers['Cache-Control'] = cache_control
+    return resposta
+
+
+@app.route('/get_foto/<int:item_id>')
+def get_foto(item_id):
+    tamanho = request.args.get('size', 'original')
+    if tamanho != 'original' and tamanho not in FOTO_TAMANHOS:
+        return f"size inválido (use: original, {', '.join(FOTO_TAMANHOS)})", 400
     
-    return 'Imagem não encontrada', 404
+    cur = mysql.connection.cursor()
+    try:
+        # Itens ainda não migrados (flask migrar-fotos): hash calculado pelo MySQL,
+        # sem trafegar o BLOB quando o navegador já tem a imagem
+        cur.execute("""
+            SELECT FOTO_HASH, FOTO_MIME, IF(FOTO_HASH IS NULL, SHA2(FOTO, 256), NULL)
+            FROM VISTORIA_ITENS WHERE ID = %s
+        """, (item_id,))
+        foto = cur.fetchone()
+        
+        if not foto or not (foto[0] or foto[2]):
+            return 'Imagem não encontrada', 404
+        
+        foto_hash, mime, hash_legado = foto
+        mime_original = mime
+        etag = foto_hash or hash_legado
+        if tamanho != 'original':
+            etag = f'{etag}_{tamanho}'
+            mime = 'image/jpeg'
+        download_name = f'foto_{item_id}.jpg'
+        
+        if request.if_none_match.contains(etag):
+            return enviar_imagem(None, etag, mime, download_name, FOTO_CACHE_CONTROL)
+        
+        if foto_hash:
+            def abrir_original():
+                return blob_store.abrir(foto_hash)
+        else:
+            cur.execute("SELECT FOTO FROM VISTORIA_ITENS WHERE ID = %s", (item_id,))
+            blob = cur.fetchone()[0]
+            
+            def abrir_original():
+                return BytesIO(blob)
+        
+        try:
+            chave = None
+            if tamanho != 'original':
+                chave = gerar_derivado_foto(foto_hash or hash_legado, tamanho, abrir_original)
+                if not chave:
+                    # Sem derivado possível: o original vai como está, com o ETag dele
+                    etag, mime = foto_hash or hash_legado, mime_original
+            if chave:
+                origem = blob_store.caminho(chave) or blob_store.abrir(chave)
+            elif foto_hash:
+                origem = blob_store.caminho(foto_hash) or blob_store.abrir(foto_hash)
+            else:
+                origem = abrir_original()
+        except FileNotFoundError:
+            app.logger.error(f"Foto {item_id}: arquivo {foto_hash} ausente no blob store")
+            return 'Imagem não encontrada', 404
+        
+        return enviar_imagem(origem, etag, mime or 'image/jpeg', download_name, FOTO_CACHE_CONTROL)
+    finally:
+        cur.close()
 
 @app.route('/get_assinatura/<tipo>/<int:vistoria_id>')
 def get_assinatura(tipo, vistoria_id):
-    cur = mysql.connection.cursor()
-    
-    if tipo == 'usuario':
-        cur.execute("SELECT ASS_USUARIO FROM VISTORIAS WHERE IDVISTORIA = %s", (vistoria_id,))
-    else:  # tipo == 'motorista'
-        cur.execute("SELECT ASS_MOTORISTA FROM VISTORIAS WHERE IDVISTORIA = %s", (vistoria_id,))
-    
-    resultado = cur.fetchone()
-    cur.close()
-    
-    if not resultado or not resultado[0]:
-        return "Sem assinatura", 404
+    tipo = 'usuario' if tipo == 'usuario' else 'motorista'  # senão, motorista
+    download_name = f'assinatura_{tipo}_{vistoria_id}.png'
     
-    assinatura = resultado[0]
+    cur = mysql.connection.cursor()
+    try:
+        # Primeiro só o hash: 304 e cache não precisam dos bytes
+        cur.execute("SELECT HASH FROM VISTORIA_ASSINATURAS WHERE IDVISTORIA = %s AND TIPO = %s",
+                    (vistoria_id, tipo))
+        resultado = cur.fetchone()
+        legado = not resultado
+        
+        if legado:
+            # Registro ainda não migrado: assinatura na coluna de VISTORIAS
+            coluna = ASSINATURA_COLUNAS[tipo]
+            cur.execute(f"SELECT SHA2({coluna}, 256) FROM VISTORIAS WHERE IDVISTORIA = %s", (vistoria_id,))
+            resultado = cur.fetchone()
+            if not resultado or not resultado[0]:
+                return "Sem assinatura", 404
+        
+        etag = resultado[0]
+        if request.if_none_match.contains(etag):
+            return enviar_imagem(None, etag, 'image/png', download_name, ASSINATURA_CACHE_CONTROL)
+        
+        chave_cache = f'assinatura:{etag}'
+        assinatura = cache.get(chave_cache)
+        if assinatura is None:
+            if legado:
+                cur.execute(f"SELECT {coluna} FROM VISTORIAS WHERE IDVISTORIA = %s", (vistoria_id,))
+                assinatura = compactar_assinatura(cur.fetchone()[0])
+            else:
+                cur.execute("SELECT DADOS FROM VISTORIA_ASSINATURAS WHERE IDVISTORIA = %s AND TIPO = %s",
+                            (vistoria_id, tipo))
+                assinatura = cur.fetchone()[0]
+            cache.set(chave_cache, assinatura, timeout=ASSINATURA_CACHE_TTL)
+    finally:
+        cur.close()
     
-    return send_file(
-        BytesIO(assinatura),
-        mimetype='image/png',  # ou 'image/jpeg' dependendo do formato da assinatura
-        as_attachment=False,
-        download_name=f'assinatura_{tipo}_{vistoria_id}.png'  # nome do arquivo ao baixar
-    )
+    return enviar_imagem(BytesIO(assinatura), etag, 'image/png', download_name, ASSINATURA_CACHE_CONTROL)
     
 def criptografar(texto):
     key = '123456'
@@ -2082,6 +5050,7 @@ def pagina_motoristas():
 
 @app.route('/api/setores')
 @login_required
+@dados_referencia('setores')
 def listar_setores():
     try:
         cursor = mysql.connection.cursor()
@@ -2112,7 +5081,7 @@ def listar_motoristas():
                 CASE WHEN ATIVO='S' THEN NM_MOTORISTA 
                 ELSE CONCAT(NM_MOTORISTA,' (INATIVO)') END AS MOTORISTA,
                 ORDEM_LISTA AS TIPO_CADASTRO, SIGLA_SETOR,
-                FILE_PDF IS NOT NULL AS FILE_PDF, ATIVO
+                HAS_CNH AS FILE_PDF, ATIVO
             FROM CAD_MOTORISTA 
             WHERE ID_MOTORISTA > 0
             AND CONCAT(CAD_MOTORISTA, NM_MOTORISTA, TIPO_CADASTRO, SIGLA_SETOR) LIKE %s 
@@ -2127,7 +5096,7 @@ def listar_motoristas():
                 CASE WHEN ATIVO='S' THEN NM_MOTORISTA 
                 ELSE CONCAT(NM_MOTORISTA,' (INATIVO)') END AS MOTORISTA, 
                 ORDEM_LISTA AS TIPO_CADASTRO, SIGLA_SETOR,
-                FILE_PDF IS NOT NULL AS FILE_PDF, ATIVO
+                HAS_CNH AS FILE_PDF, ATIVO
             FROM CAD_MOTORISTA
             WHERE ID_MOTORISTA > 0
             ORDER BY NM_MOTORISTA
@@ -2194,6 +5163,7 @@ def detalhe_motorista(id_motorista):
 # API para listar fornecedores
 @app.route('/api/motorista/fornecedores')
 @login_required
+@dados_referencia('fornecedores')
 def motorista_listar_fornecedores():
     try:
         cursor = mysql.connection.cursor()
@@ -2223,10 +5193,6 @@ def cadastrar_motorista():
     try:
         cursor = mysql.connection.cursor()
         
-        # Get last ID and increment
-        cursor.execute("SELECT COALESCE(MAX(ID_MOTORISTA), 0) + 1 FROM CAD_MOTORISTA")
-        novo_id = cursor.fetchone()[0]
-        
         # Form data
         cad_motorista = request.form.get('cad_motorista')
         nm_motorista = request.form.get('nm_motorista')
@@ -2246,32 +5212,35 @@ def cadastrar_motorista():
         
         tipo_cadastro_desc = tipo_cad[tipo_cadastro]
         
-        # File handling
+        # File handling (PDF vai para o blob store)
         file_pdf = request.files.get('file_pdf')
         nome_arquivo = None
-        file_blob = None
+        cnh_hash = cnh_tamanho = None
         if file_pdf:
             nome_arquivo = file_pdf.filename
-            file_blob = file_pdf.read()
+            cnh_hash, cnh_tamanho = gravar_cnh(file_pdf)
         
         # Get current timestamp in Manaus timezone
         manaus_tz = timezone('America/Manaus')
         dt_transacao = datetime.now(manaus_tz).strftime('%d/%m/%Y %H:%M:%S')
+        
+        # ID só depois do upload: a linha da sequência fica travada até o commit
+        novo_id = proximo_id('CAD_MOTORISTA')
                 
         # Insert query
         query = """
         INSERT INTO CAD_MOTORISTA (
             ID_MOTORISTA, CAD_MOTORISTA, NM_MOTORISTA, TIPO_CADASTRO, SIGLA_SETOR, CAT_CNH, 
             DT_VALIDADE_CNH, ULTIMA_ATUALIZACAO, NU_TELEFONE, OBS_MOTORISTA, ATIVO, USUARIO, 
-            DT_TRANSACAO, FILE_PDF, NOME_ARQUIVO, ORDEM_LISTA, EMAIL, ID_FORNECEDOR
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'S', %s, %s, %s, %s, %s, %s, %s)
+            DT_TRANSACAO, CNH_HASH, CNH_TAMANHO, HAS_CNH, NOME_ARQUIVO, ORDEM_LISTA, EMAIL, ID_FORNECEDOR
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'S', %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """
         
         cursor.execute(query, (
             novo_id, cad_motorista, nm_motorista, tipo_cadastro_desc, 
             sigla_setor, cat_cnh, dt_validade_cnh, ultima_atualizacao, 
             nu_telefone, obs_motorista, session.get('usuario_id'), 
-            dt_transacao, file_blob, nome_arquivo, tipo_cadastro, email,
+            dt_transacao, cnh_hash, cnh_tamanho, 1 if cnh_hash else 0, nome_arquivo, tipo_cadastro, email,
             id_fornecedor
         ))
 
@@ -2286,6 +5255,7 @@ def cadastrar_motorista():
         
         mysql.connection.commit()
         cursor.close()
+        invalidar_snapshots_agenda()
         
         return jsonify({'sucesso': True, 'id_motorista': novo_id})
     except Exception as e:
@@ -2327,15 +5297,15 @@ def atualizar_motorista():
         
         tipo_cadastro_desc = tipo_cad[tipo_cadastro]
         
-        # File 
+        # File (PDF vai para o blob store)
         file_pdf = request.files.get('file_pdf')
         nome_arquivo = None
-        file_blob = None
+        cnh_hash = cnh_tamanho = None
         
         # Check if new file is uploaded
         if file_pdf:
             nome_arquivo = file_pdf.filename
-            file_blob = file_pdf.read()
+            cnh_hash, cnh_tamanho = gravar_cnh(file_pdf)
         
         # Get current timestamp in Manaus timezone
         manaus_tz = timezone('America/Manaus')
@@ -2350,7 +5320,8 @@ def atualizar_motorista():
                 SIGLA_SETOR = %s, CAT_CNH = %s, DT_VALIDADE_CNH = %s, 
                 ULTIMA_ATUALIZACAO = %s, NU_TELEFONE = %s, OBS_MOTORISTA = %s, 
                 ATIVO = %s, USUARIO = %s, 
-                FILE_PDF = %s, NOME_ARQUIVO = %s, ORDEM_LISTA = %s, EMAIL = %s,
+                CNH_HASH = %s, CNH_TAMANHO = %s, HAS_CNH = 1, FILE_PDF = NULL,
+                NOME_ARQUIVO = %s, ORDEM_LISTA = %s, EMAIL = %s,
                 ID_FORNECEDOR = %s
             WHERE ID_MOTORISTA = %s
             """
@@ -2359,7 +5330,7 @@ def atualizar_motorista():
                 cad_motorista, nm_motorista, tipo_cadastro_desc, 
                 sigla_setor, cat_cnh, dt_validade_cnh, ultima_atualizacao, 
                 nu_telefone, obs_motorista, ativo, session.get('usuario_id'), 
-                file_blob, nome_arquivo, tipo_cadastro, email,
+                cnh_hash, cnh_tamanho, nome_arquivo, tipo_cadastro, email,
                 id_fornecedor, id_motorista
             ))
         else:
@@ -2383,6 +5354,7 @@ def atualizar_motorista():
         
         mysql.connection.commit()
         cursor.close()
+        invalidar_snapshots_agenda()
         
         return jsonify({'sucesso': True, 'id_motorista': id_motorista})
     except Exception as e:
@@ -2394,18 +5366,9 @@ def atualizar_motorista():
 @login_required
 def download_cnh(id_motorista):
     try:
-        cursor = mysql.connection.cursor()
-        query = "SELECT FILE_PDF, NOME_ARQUIVO FROM CAD_MOTORISTA WHERE ID_MOTORISTA = %s"
-        cursor.execute(query, (id_motorista,))
-        result = cursor.fetchone()
-        cursor.close()
-        if result and result[0]:
-            return send_file(
-                BytesIO(result[0]),
-                mimetype='application/pdf',
-                as_attachment=True,  # Mantém o download
-                download_name=result[1]
-            )
+        resposta = enviar_cnh(id_motorista, as_attachment=True)  # Mantém o download
+        if resposta is not None:
+            return resposta
         else:
             return "Arquivo não encontrado", 404
     except Exception as e:
@@ -2416,18 +5379,9 @@ def download_cnh(id_motorista):
 @login_required
 def visualizar_cnh(id_motorista):
     try:
-        cursor = mysql.connection.cursor()
-        query = "SELECT FILE_PDF, NOME_ARQUIVO FROM CAD_MOTORISTA WHERE ID_MOTORISTA = %s"
-        cursor.execute(query, (id_motorista,))
-        result = cursor.fetchone()
-        cursor.close()
-        if result and result[0]:
-            return send_file(
-                BytesIO(result[0]),
-                mimetype='application/pdf',
-                as_attachment=False,  # AQUI: False para visualizar
-                download_name=result[1]
-            )
+        resposta = enviar_cnh(id_motorista, as_attachment=False)  # AQUI: False para visualizar
+        if resposta is not None:
+            return resposta
         else:
             return "Arquivo não encontrado", 404
     except Exception as e:
@@ -2516,6 +5470,7 @@ def adicionar_periodo_motorista(id_motorista):
         id_periodo = cursor.lastrowid
         mysql.connection.commit()
         cursor.close()
+        invalidar_snapshots_agenda()
         
         return jsonify({
             'success': True, 
@@ -2595,6 +5550,7 @@ def atualizar_periodo_motorista(id_motorista, id_periodo):
         
         mysql.connection.commit()
         cursor.close()
+        invalidar_snapshots_agenda()
         
         return jsonify({
             'success': True,
@@ -2642,6 +5598,7 @@ def excluir_periodo_motorista(id_motorista, id_periodo):
         
         mysql.connection.commit()
         cursor.close()
+        invalidar_snapshots_agenda()
         
         return jsonify({
             'success': True,
@@ -2695,6 +5652,7 @@ def controle_locacoes():
 
 @app.route('/api/tipos_locacao')
 @login_required
+@dados_referencia('tipos_locacao')
 def api_tipos_locacao():
     try:
         cursor = mysql.connection.cursor()
@@ -3592,7 +6550,7 @@ def listar_motoristas_loc():
         print("Executando consulta SQL")
         cursor.execute("""
             SELECT ID_MOTORISTA, NM_MOTORISTA, NU_TELEFONE, 
-            FILE_PDF, NOME_ARQUIVO FROM CAD_MOTORISTA
+            HAS_CNH, NOME_ARQUIVO FROM CAD_MOTORISTA
             WHERE ID_MOTORISTA <> 0 AND ATIVO = 'S' ORDER BY NM_MOTORISTA
         """)
         
@@ -3605,14 +6563,11 @@ def listar_motoristas_loc():
         motoristas = []
         for i, row in enumerate(results):
             try:
-                # Verificar se FILE_PDF é None antes de processar
-                file_pdf = row[3] if row[3] is not None else None
-                
                 motorista = {
                     'ID_MOTORISTA': row[0],
                     'NM_MOTORISTA': row[1],
                     'NU_TELEFONE': row[2],
-                    'FILE_PDF': file_pdf is not None,  # Apenas indicar presença, não enviar arquivo
+                    'FILE_PDF': bool(row[3]),  # Apenas indicar presença, não enviar arquivo
                     'NOME_ARQUIVO': row[4]
                 }
                 motoristas.append(motorista)
@@ -3658,13 +6613,7 @@ def api_empenhos_loc():
         
 # Rota para obter o próximo ID_ITEM
 def obter_proximo_id_item():
-    cursor = mysql.connection.cursor()
-    cursor.execute("SELECT MAX(ID_ITEM) FROM CONTROLE_LOCACAO_ITENS")
-    resultado = cursor.fetchone()
-    cursor.close()
-    
-    ultimo_id = resultado[0] if resultado[0] else 0
-    return ultimo_id + 1
+    return proximo_id('CONTROLE_LOCACAO_ITENS')
 
 #####....#####.....
 
@@ -3726,7 +6675,7 @@ def verificar_vinculo_locacao():
         
         # Verificar CNH do motorista
         sql_cnh = """
-            SELECT FILE_PDF 
+            SELECT HAS_CNH 
             FROM CAD_MOTORISTA 
             WHERE ID_MOTORISTA = %s
         """
@@ -3947,7 +6896,7 @@ def obter_usuario_logado():
 def salvar_diaria_terceirizado():
     """
     Salva ou atualiza registro de diária de motorista terceirizado
-    IDITEM é obtido manualmente via SELECT MAX(IDITEM) + 1
+    IDITEM vem da sequência DIARIAS_TERCEIRIZADOS (proximo_id)
     """
     cursor = None
     try:
@@ -3996,18 +6945,12 @@ def salvar_diaria_terceirizado():
             iditem = registro_existente[0]
             
         else:
-            # ===== OBTER PRÓXIMO IDITEM MANUALMENTE =====
-            cursor.execute("SELECT MAX(IDITEM) FROM DIARIAS_TERCEIRIZADOS")
-            resultado = cursor.fetchone()
-            
-            if resultado and resultado[0]:
-                iditem = resultado[0] + 1
-            else:
-                iditem = 1  # Primeira diária
+            # ===== OBTER PRÓXIMO IDITEM (SEQUÊNCIA) =====
+            iditem = proximo_id('DIARIAS_TERCEIRIZADOS')
             
             app.logger.info(f"Próximo IDITEM: {iditem}")
             
-            # INSERIR novo registro com IDITEM manual
+            # INSERIR novo registro com IDITEM da sequência
             cursor.execute("""
                 INSERT INTO DIARIAS_TERCEIRIZADOS
                 (IDITEM, ID_AD, ID_FORNECEDOR, ID_MOTORISTA, QT_DIARIAS, VL_DIARIA, VL_TOTAL, FL_EMAIL)
@@ -4017,26 +6960,14 @@ def salvar_diaria_terceirizado():
             app.logger.info(f"Novo registro inserido - IDITEM: {iditem}")
         
         mysql.connection.commit()
+        periodo_demanda = buscar_periodo_demanda(cursor, id_ad)
+        invalidar_snapshots_agenda(periodo_demanda)
         
         # ===== EMITIR WEBSOCKET =====
-        usuario_atual = session.get('usuario_login', '')
-        
-        try:
-            payload = {
-                'tipo': 'INSERT' if not registro_existente else 'UPDATE',
-                'entidade': 'DIARIA_TERCEIRIZADO',
-                'iditem': iditem,
-                'id_ad': id_ad,
-                'usuario': usuario_atual,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            socketio.emit('alteracao_agenda', payload, room='agenda')
-            
-            print(f"📡 WebSocket: {payload['tipo']} DIARIA_TERCEIRIZADO - IDITEM: {iditem}")
-            
-        except Exception as e:
-            print(f"❌ Erro ao emitir WebSocket: {str(e)}")
+        emitir_alteracao_diaria_terceirizado(
+            'INSERT' if not registro_existente else 'UPDATE', iditem, id_ad,
+            periodo=periodo_demanda
+        )
         
         app.logger.info(f"✅ Diária salva com sucesso - IDITEM: {iditem}")
         
@@ -4074,6 +7005,10 @@ def excluir_diaria_terceirizado(id_ad):
         """, (id_ad,))
         
         mysql.connection.commit()
+        periodo_demanda = buscar_periodo_demanda(cursor, id_ad)
+        invalidar_snapshots_agenda(periodo_demanda)
+        
+        emitir_alteracao_diaria_terceirizado('DELETE', None, id_ad, periodo=periodo_demanda)
         
         return jsonify({
             'success': True,
@@ -4158,9 +7093,6 @@ def nova_locacao():
         nu_sei = request.form.get('nu_sei')
         obs = request.form.get('obs')
         
-        # Obter o próximo ID_ITEM
-        id_item = obter_proximo_id_item()
-        
         # Converter data_inicio e data_fim para objetos datetime
         data_inicio_obj = datetime.strptime(data_inicio, '%Y-%m-%d')
         data_fim_obj = datetime.strptime(data_fim, '%Y-%m-%d')
@@ -4182,7 +7114,7 @@ def nova_locacao():
         cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
         
         # Verificar se o motorista tem CNH cadastrada
-        cursor.execute("SELECT FILE_PDF, NM_MOTORISTA, NU_TELEFONE, NOME_ARQUIVO, EMAIL FROM CAD_MOTORISTA WHERE ID_MOTORISTA = %s", (id_motorista,))
+        cursor.execute("SELECT HAS_CNH, CNH_HASH, NM_MOTORISTA, NU_TELEFONE, NOME_ARQUIVO, EMAIL FROM CAD_MOTORISTA WHERE ID_MOTORISTA = %s", (id_motorista,))
         motorista_info = cursor.fetchone()
         
         # Buscar o email do fornecedor
@@ -4198,24 +7130,37 @@ def nova_locacao():
             }), 400
         
         # Verificar se é necessário salvar a CNH
-        file_pdf = motorista_info['FILE_PDF'] if motorista_info['FILE_PDF'] else None
+        cnh_hash = motorista_info['CNH_HASH'] if motorista_info['HAS_CNH'] else None
         nome_arquivo_cnh = motorista_info['NOME_ARQUIVO'] if motorista_info['NOME_ARQUIVO'] else None
         
-        if not file_pdf and 'file_cnh' in request.files:
+        if motorista_info['HAS_CNH'] and not cnh_hash:
+            # CNH ainda em FILE_PDF: copiar para o blob store (o anexo sai de lá);
+            # FILE_PDF fica para o `flask migrar-cnh`, como com --manter-blob
+            pdf = ler_cnh_legada(id_motorista)
+            if pdf:
+                cnh_hash, cnh_tamanho = blob_store.gravar(BytesIO(pdf))
+                cursor.execute("UPDATE CAD_MOTORISTA SET CNH_HASH = %s, CNH_TAMANHO = %s WHERE ID_MOTORISTA = %s",
+                               (cnh_hash, cnh_tamanho, id_motorista))
+                mysql.connection.commit()
+        
+        if not cnh_hash and 'file_cnh' in request.files:
             file_cnh = request.files['file_cnh']
             
             if file_cnh and file_cnh.filename != '':
-                # Salvar o conteúdo do arquivo
-                file_content = file_cnh.read()
+                # Salvar o arquivo no blob store
+                cnh_hash, cnh_tamanho = gravar_cnh(file_cnh)
                 nome_arquivo_cnh = file_cnh.filename
                 
                 # Atualizar o motorista com o arquivo da CNH
                 cursor.execute(
-                    "UPDATE CAD_MOTORISTA SET FILE_PDF = %s, NOME_ARQUIVO = %s WHERE ID_MOTORISTA = %s",
-                    (file_content, nome_arquivo_cnh, id_motorista)
+                    """UPDATE CAD_MOTORISTA SET CNH_HASH = %s, CNH_TAMANHO = %s, HAS_CNH = 1,
+                       FILE_PDF = NULL, NOME_ARQUIVO = %s WHERE ID_MOTORISTA = %s""",
+                    (cnh_hash, cnh_tamanho, nome_arquivo_cnh, id_motorista)
                 )
                 mysql.connection.commit()
-                file_pdf = file_content
+        
+        # Obter o próximo ID_ITEM (depois dos commits da CNH, logo antes do INSERT)
+        id_item = obter_proximo_id_item()
         
         # Inserir na tabela CONTROLE_LOCACAO_ITENS
         cursor.execute("""
@@ -4247,12 +7192,14 @@ def nova_locacao():
         email_enviado, erro_email = enviar_email_locacao(
             id_item, id_cl, nu_sei, motorista_info['NM_MOTORISTA'], motorista_info['NU_TELEFONE'], 
             dt_inicial, dt_final, hr_inicial, de_veiculo, obs, nome_arquivo_cnh, 
-            motorista_email, objetivo, email_fornecedor, file_pdf
+            motorista_email, objetivo, email_fornecedor, cnh_hash
         )
         
+        # email_enviado = aceito na fila de envio; FL_EMAIL muda quando sair
         response_data = {
             'sucesso': True,
             'email_enviado': email_enviado,
+            'email_status': 'FILA' if email_enviado else 'ERRO',
             'mensagem': 'Locação cadastrada com sucesso!'
         }
         
@@ -4271,7 +7218,7 @@ def nova_locacao():
 
 def enviar_email_locacao(id_item, id_cl, nu_sei, nm_motorista, nu_telefone, dt_inicial, dt_final, 
                          hr_inicial, de_veiculo, obs, nome_arquivo_cnh, email_mot, objetivo, 
-                         email_fornecedor, file_pdf_content=None):
+                         email_fornecedor, cnh_hash=None):
     try:
         # Importar pytz para timezone
         from pytz import timezone
@@ -4320,152 +7267,21 @@ def enviar_email_locacao(id_item, id_cl, nu_sei, nm_motorista, nu_telefone, dt_i
         else:
             obs_texto = "Sem observações adicionais"
 
-        # Corpo do email em HTML
-        corpo_html = f'''
-        <!DOCTYPE html>
-        <html lang="pt-BR">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Solicitação de Locação de Veículo</title>
-        </head>
-        <body style="font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px; background-color: #f5f5f5;">
-            <div style="background-color: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
-                <!-- Header -->
-                <div style="text-align: center; margin-bottom: 30px; padding-bottom: 20px; border-bottom: 3px solid #1e3a8a;">
-                    <h1 style="color: #1e3a8a; margin: 0; font-size: 20px; font-weight: bold;">
-                        TRIBUNAL DE JUSTIÇA DO ESTADO DE RONDÔNIA
-                    </h1>
-                    <p style="color: #6b7280; margin: 5px 0 0 0; font-size: 14px;">
-                        Seção de Gestão Operacional do Transporte
-                    </p>
-                </div>
-                
-                <!-- Saudação -->
-                <div style="margin-bottom: 25px;">
-                    <p style="font-size: 16px; margin: 0; color: #374151;">
-                        <strong>{saudacao},</strong>
-                    </p>
-                </div>
-                
-                <!-- Conteúdo Principal -->
-                <div style="margin-bottom: 30px;">
-                    <p style="margin-bottom: 20px; color: #374151;">
-                        Prezados,
-                    </p>
-                    <p style="margin-bottom: 25px; color: #374151;">
-                        {texto_processo}
-                    </p>
-                </div>
-                
-                <!-- Informações da Locação -->
-                <div style="background-color: #f8fafc; padding: 25px; border-radius: 8px; border-left: 4px solid #1e3a8a; margin-bottom: 25px;">
-                    <h3 style="color: #1e3a8a; margin-top: 0; margin-bottom: 20px; font-size: 18px;">
-                        📋 Detalhes da Solicitação - ID {id_item}
-                    </h3>
-                    
-                    <table style="width: 100%; border-collapse: collapse;">
-                        <tr>
-                            <td style="padding: 3px 0; font-weight: bold; color: #1e3a8a; font-size: 15px; width: 30%;">
-                                🗓️ Período:
-                            </td>
-                            <td style="padding: 3px 0; color: #374151; font-weight: 500;">
-                                {dt_inicial} ({hr_inicial}) a {dt_final}
-                            </td>
-                        </tr>
-                        <tr>
-                            <td style="padding: 3px 0; font-weight: bold; color: #1e3a8a; font-size: 15px;">
-                                🚗 Veículo:
-                            </td>
-                            <td style="padding: 3px 0; color: #374151; font-weight: 500;">
-                                {de_veiculo} ou Similar
-                            </td>
-                        </tr>
-                        <tr>
-                            <td style="padding: 3px 0; font-weight: bold; color: #1e3a8a; font-size: 15px;">
-                                👤 Condutor:
-                            </td>
-                            <td style="padding: 3px 0; color: #374151; font-weight: 500;">
-                                {info_condutor}
-                            </td>
-                        </tr>
-                        <tr>
-                            <td style="padding: 3px 0; font-weight: bold; color: #1e3a8a; font-size: 15px; vertical-align: top;">
-                                🔂 Objetivo:
-                            </td>
-                            <td style="padding: 3px 0; color: #374151; font-weight: 500;">
-                                {objetivo}
-                            </td>							
-                        </tr>
-                        <tr>
-                            <td style="padding: 3px 0; font-weight: bold; color: #1e3a8a; font-size: 15px; vertical-align: top;">
-                                📝 Observações:
-                            </td>
-                            <td style="padding: 3px 0; color: #374151; font-weight: 500;">
-                                {obs_texto}
-                            </td>
-                        </tr>
-                    </table>
-                </div>
-                
-                <!-- Anexo -->
-                <div style="background-color: #ecfdf5; padding: 15px; border-radius: 8px; border-left: 4px solid #10b981; margin-bottom: 25px;">
-                    <p style="margin: 0; color: #065f46; font-weight: 500;">
-                        📎 Segue anexo CNH do condutor.
-                    </p>
-                </div>
-                
-                <!-- Assinatura -->
-                <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-                    <p style="margin-bottom: 15px; color: #374151;">
-                        Atenciosamente,
-                    </p>
-                    <p style="margin-bottom: 2px; font-weight: bold; color: #1e3a8a;">
-                        {nome_usuario}
-                    </p>
-                    <p style="margin-bottom: 2px; color: #6b7280; font-size: 14px;">
-                        Tribunal de Justiça do Estado de Rondônia
-                    </p>
-                    <p style="margin-bottom: 2px; color: #6b7280; font-size: 14px;">
-                        Seção de Gestão Operacional do Transporte
-                    </p>
-                    <p style="margin: 0; color: #1e3a8a; font-size: 14px; font-weight: 500;">
-                        📞 (69) 3309-6229/6227
-                    </p>
-                </div>
-	
-                <!-- Footer -->
-                <div style="text-align: center; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-                    <p style="margin: 0; color: #9ca3af; font-size: 12px;">
-                        Este e-mail foi gerado automaticamente pelo Sistema de Operações de Transporte do TJRO
-                    </p>
-                </div>
-            </div>
-        </body>
-        </html>
-        '''
-        
-        # Versão texto simples (fallback)
-        corpo_texto = f'''{saudacao},
-
-Prezados,
-
-{texto_processo}
-
-    Período: {dt_inicial} ({hr_inicial}) a {dt_final}
-    Veículo: {de_veiculo} ou Similar
-    Condutor: {info_condutor}
-    Objetivo: {objetivo}
-    Observações: {obs_texto}
-
-Segue anexo CNH do condutor.
-
-Atenciosamente,
-
-{nome_usuario}
-Tribunal de Justiça do Estado de Rondônia
-Seção de Gestão Operacional do Transporte
-(69) 3309-6229/6227'''
+        # Corpo do email (templates/emails/locacao.html e .txt, já compilados)
+        corpo_html, corpo_texto = renderizar_email(
+            'locacao',
+            saudacao=saudacao,
+            texto_processo=texto_processo,
+            id_item=id_item,
+            dt_inicial=dt_inicial,
+            hr_inicial=hr_inicial,
+            dt_final=dt_final,
+            de_veiculo=de_veiculo,
+            info_condutor=info_condutor,
+            objetivo=objetivo,
+            obs_texto=obs_texto,
+            nome_usuario=nome_usuario
+        )
 
         # Criar mensagem usando a lista de emails tratada
         msg = Message(
@@ -4476,12 +7292,16 @@ Seção de Gestão Operacional do Transporte
             sender=("TJRO-SEGEOP", "segeop@tjro.jus.br")
         )
 
-        # Anexar CNH
-        if file_pdf_content:
+        # Anexar CNH (lida do blob store só aqui, no envio)
+        if cnh_hash:
             nome_anexo = f"CNH_{nm_motorista.replace(' ', '_')}.pdf"
             if nome_arquivo_cnh:
                 nome_anexo = 'CNH_' + os.path.basename(nome_arquivo_cnh)
-            msg.attach(nome_anexo, 'application/pdf', file_pdf_content)
+            try:
+                with blob_store.abrir(cnh_hash) as origem:
+                    msg.attach(nome_anexo, 'application/pdf', origem.read())
+            except FileNotFoundError:
+                app.logger.warning(f"CNH {cnh_hash} ausente no blob store")
         elif nome_arquivo_cnh and nome_arquivo_cnh != 'None':
             try:
                 with open(nome_arquivo_cnh, 'rb') as f:
@@ -4489,58 +7309,55 @@ Seção de Gestão Operacional do Transporte
             except FileNotFoundError:
                 app.logger.warning(f"Arquivo CNH não encontrado: {nome_arquivo_cnh}")
         
-        # Enviar email
-        mail.send(msg)
-        
-        # Registrar email no banco de dados
+        # Enfileirar: CONTROLE_LOCACAO_EMAIL e FL_EMAIL são gravados na entrega
         cursor = mysql.connection.cursor()
-        
-        # Formatação da data e hora atual no fuso de Manaus
-        data_hora_atual = datetime.now(tz_manaus).strftime("%d/%m/%Y %H:%M:%S")
-        
-        # Inserir na tabela de emails usando a string formatada de emails
-        cursor.execute(
-            "INSERT INTO CONTROLE_LOCACAO_EMAIL (ID_ITEM, ID_CL, DESTINATARIO, ASSUNTO, TEXTO, DATA_HORA) VALUES (%s, %s, %s, %s, %s, %s)",
-            (id_item, id_cl, emails_string, assunto, corpo_texto, data_hora_atual)
-        )
-        
-        # Atualizar flag de email na tabela de locações
-        cursor.execute(
-            "UPDATE CONTROLE_LOCACAO_ITENS SET FL_EMAIL = 'S' WHERE ID_ITEM = %s",
-            (id_item,)
-        )
-        
-        mysql.connection.commit()
-        cursor.close()
+        try:
+            enfileirar_email(cursor, msg, 'locacao', {
+                'id_item': id_item,
+                'id_cl': id_cl,
+                'destinatario': emails_string,
+                'assunto': assunto,
+                'texto': corpo_texto
+            })
+            mysql.connection.commit()
+        finally:
+            cursor.close()
+        acordar_envio_emails()
         
         return True, None
     
     except Exception as e:
-        app.logger.error(f"Erro ao enviar email: {str(e)}")
+        app.logger.error(f"Erro ao enfileirar email: {str(e)}")
         return False, str(e)
+
+
+@callback_email('locacao')
+def registrar_email_locacao(cursor, dados, entregue):
+    """Entrega do email de locação: histórico em CONTROLE_LOCACAO_EMAIL e FL_EMAIL = 'S'"""
+    if not entregue:
+        return None
+    
+    from pytz import timezone
+    data_hora_atual = datetime.now(timezone('America/Manaus')).strftime("%d/%m/%Y %H:%M:%S")
+    
+    cursor.execute(
+        "INSERT INTO CONTROLE_LOCACAO_EMAIL (ID_ITEM, ID_CL, DESTINATARIO, ASSUNTO, TEXTO, DATA_HORA) VALUES (%s, %s, %s, %s, %s, %s)",
+        (dados['id_item'], dados['id_cl'], dados['destinatario'], dados['assunto'], dados['texto'], data_hora_atual)
+    )
+    cursor.execute(
+        "UPDATE CONTROLE_LOCACAO_ITENS SET FL_EMAIL = 'S' WHERE ID_ITEM = %s",
+        (dados['id_item'],)
+    )
+    return None
 		
         
 @app.route('/api/download_cnh_loc/<int:id_motorista>')
 @login_required
 def download_cnh_loc(id_motorista):
     try:
-        cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)  # IMPORTANTE: Use dictionary=True aqui também
-        cursor.execute("""
-            SELECT FILE_PDF, NOME_ARQUIVO FROM CAD_MOTORISTA
-            WHERE ID_MOTORISTA = %s
-        """, (id_motorista,))
-        
-        result = cursor.fetchone()
-        cursor.close()
-        
-        if result and result['FILE_PDF']:  # Acesso usando chave string
-            pdf_data = result['FILE_PDF']
-            filename = result['NOME_ARQUIVO'] or f"cnh_motorista_{id_motorista}.pdf"
-            
-            response = make_response(pdf_data)
-            response.headers['Content-Type'] = 'application/pdf'
-            response.headers['Content-Disposition'] = f'inline; filename="{filename}"'
-            return response
+        resposta = enviar_cnh(id_motorista, as_attachment=False)
+        if resposta is not None:
+            return resposta
         else:
             return jsonify({'erro': 'PDF não encontrado'}), 404
     except Exception as e:
@@ -5403,13 +8220,7 @@ def fluxo_saida_item(idfluxo):
         
 # Rota para obter o próximo ID_ITEM
 def obter_proximo_id_fluxo():
-    cursor = mysql.connection.cursor()
-    cursor.execute("SELECT MAX(ID_FLUXO) FROM FLUXO_VEICULOS")
-    resultado = cursor.fetchone()
-    cursor.close()
-    
-    ultimo_id = resultado[0] if resultado[0] else 0
-    return ultimo_id + 1
+    return proximo_id('FLUXO_VEICULOS')
     
 @app.route('/api/fluxo_nova_saida', methods=['POST'])
 @login_required
@@ -5689,6 +8500,7 @@ def cadastrar_veiculo():
         
         mysql.connection.commit()
         cursor.close()
+        invalidar_snapshots_agenda()
         
         return jsonify({'sucesso': True, 'id_veiculo': novo_id})
     
@@ -5769,6 +8581,7 @@ def atualizar_veiculo():
         
         mysql.connection.commit()
         cursor.close()
+        invalidar_snapshots_agenda()
         
         return jsonify({'sucesso': True, 'mensagem': 'Veículo atualizado com sucesso'})
         
@@ -5781,6 +8594,7 @@ def atualizar_veiculo():
         
 @app.route('/api/categorias_veiculos', methods=['GET'])
 @login_required
+@dados_referencia('categorias_veiculos')
 def listar_categorias():
     try:
         cursor = mysql.connection.cursor()
@@ -6153,6 +8967,74 @@ def listar_semanas():
         if cursor:
             cursor.close()
 
+# SELECT base das demandas da agenda (mesmas colunas de /api/agenda/dados)
+SQL_DEMANDAS_AGENDA = """
+    SELECT ae.ID_AD, ae.ID_MOTORISTA, 
+           CASE 
+               WHEN ae.ID_MOTORISTA = 0 THEN CONCAT(ae.NC_MOTORISTA, ' (Não Cadast.)')
+               ELSE m.NM_MOTORISTA 
+           END as NOME_MOTORISTA, 
+           ae.ID_TIPOVEICULO, td.DE_TIPODEMANDA, ae.ID_TIPODEMANDA, 
+           tv.DE_TIPOVEICULO, ae.ID_VEICULO, ae.DT_INICIO, ae.DT_FIM,
+           ae.SETOR, ae.SOLICITANTE, ae.DESTINO, ae.NU_SEI, 
+           ae.DT_LANCAMENTO, ae.USUARIO, ae.OBS, ae.SOLICITADO, ae.HORARIO,
+           ae.TODOS_VEICULOS, ae.NC_MOTORISTA, m.TIPO_CADASTRO
+    FROM AGENDA_DEMANDAS ae
+    LEFT JOIN CAD_MOTORISTA m ON m.ID_MOTORISTA = ae.ID_MOTORISTA
+    LEFT JOIN TIPO_DEMANDA td ON td.ID_TIPODEMANDA = ae.ID_TIPODEMANDA
+    LEFT JOIN TIPO_VEICULO tv ON tv.ID_TIPOVEICULO = ae.ID_TIPOVEICULO
+"""
+
+
+def formatar_demanda_agenda(r):
+    """Converte uma linha de SQL_DEMANDAS_AGENDA no dicionário usado pela agenda"""
+    dt_lancamento = r[14].strftime('%Y-%m-%d %H:%M:%S') if r[14] else ''
+    
+    horario = ''
+    if r[18]:
+        try:
+            if isinstance(r[18], str):
+                horario = r[18][:5] if len(r[18]) >= 5 else ''
+            elif hasattr(r[18], 'total_seconds'):
+                total_seconds = int(r[18].total_seconds())
+                hours = total_seconds // 3600
+                minutes = (total_seconds % 3600) // 60
+                if hours > 0 or minutes > 0:
+                    horario = f"{hours:02d}:{minutes:02d}"
+            elif hasattr(r[18], 'strftime'):
+                horario_formatted = r[18].strftime('%H:%M')
+                if horario_formatted != '00:00':
+                    horario = horario_formatted
+        except Exception as e:
+            print(f"Erro ao formatar horário: {e}, tipo: {type(r[18])}, valor: {r[18]}")
+            horario = ''
+    
+    return {
+        'id': r[0], 
+        'id_motorista': r[1], 
+        'nm_motorista': r[2],
+        'id_tipoveiculo': r[3], 
+        'de_tipodemanda': r[4], 
+        'id_tipodemanda': r[5],
+        'de_tipoveiculo': r[6], 
+        'id_veiculo': r[7], 
+        'dt_inicio': r[8].strftime('%Y-%m-%d'), 
+        'dt_fim': r[9].strftime('%Y-%m-%d'),
+        'setor': r[10] or '', 
+        'solicitante': r[11] or '', 
+        'destino': r[12] or '', 
+        'nu_sei': r[13] or '', 
+        'dt_lancamento': dt_lancamento,
+        'usuario': r[15] or '',
+        'obs': r[16] or '',
+        'solicitado': r[17] or 'N',
+        'horario': horario,
+        'todos_veiculos': r[19] or 'N',
+        'nc_motorista': r[20] or '',
+        'tipo_cadastro': r[21] or ''
+    }
+
+
 # Decorator para medir tempo de queries
 def log_query_time(query_name):
     def decorator(func):
@@ -6167,7 +9049,6 @@ def log_query_time(query_name):
     return decorator
 
 @app.route('/api/agenda/dados', methods=['GET'])
-@cache.cached(timeout=30, query_string=True)
 @login_required
 def buscar_dados_agenda():
     tempo_total_inicio = time.time()
@@ -6178,6 +9059,25 @@ def buscar_dados_agenda():
         inicio = request.args.get('inicio')
         fim = request.args.get('fim')
         
+        # Versão lida ANTES dos dados: alterações concorrentes serão reenviadas pelo delta
+        versao = versao_agenda_atual()
+        
+        # ========== SNAPSHOT DA SEMANA (sem SQL se já materializado) ==========
+        snapshot, geracao = obter_snapshot_agenda(inicio, fim)
+        if snapshot is not None:
+            tempo_total = (time.time() - tempo_total_inicio) * 1000
+            print(f"⚡ Agenda {inicio} até {fim} servida do snapshot ({tempo_total:.2f}ms)")
+            return jsonify({
+                **snapshot,
+                'versao': versao,
+                '_debug': {
+                    'snapshot': 'HIT',
+                    'tempo_total_ms': tempo_total,
+                    'tempo_total_s': tempo_total / 1000,
+                    'detalhamento': {}
+                }
+            })
+        
         print(f"\n{'='*60}")
         print(f"🔍 DIAGNÓSTICO DE PERFORMANCE - Agenda")
         print(f"📅 Período: {inicio} até {fim}")
@@ -6288,21 +9188,7 @@ def buscar_dados_agenda():
 
         # ========== 5. DEMANDAS (GERALMENTE A MAIS PESADA) ==========
         t5 = time.time()
-        cursor.execute("""
-            SELECT ae.ID_AD, ae.ID_MOTORISTA, 
-                   CASE 
-                       WHEN ae.ID_MOTORISTA = 0 THEN CONCAT(ae.NC_MOTORISTA, ' (Não Cadast.)')
-                       ELSE m.NM_MOTORISTA 
-                   END as NOME_MOTORISTA, 
-                   ae.ID_TIPOVEICULO, td.DE_TIPODEMANDA, ae.ID_TIPODEMANDA, 
-                   tv.DE_TIPOVEICULO, ae.ID_VEICULO, ae.DT_INICIO, ae.DT_FIM,
-                   ae.SETOR, ae.SOLICITANTE, ae.DESTINO, ae.NU_SEI, 
-                   ae.DT_LANCAMENTO, ae.USUARIO, ae.OBS, ae.SOLICITADO, ae.HORARIO,
-                   ae.TODOS_VEICULOS, ae.NC_MOTORISTA, m.TIPO_CADASTRO
-            FROM AGENDA_DEMANDAS ae
-            LEFT JOIN CAD_MOTORISTA m ON m.ID_MOTORISTA = ae.ID_MOTORISTA
-            LEFT JOIN TIPO_DEMANDA td ON td.ID_TIPODEMANDA = ae.ID_TIPODEMANDA
-            LEFT JOIN TIPO_VEICULO tv ON tv.ID_TIPOVEICULO = ae.ID_TIPOVEICULO
+        cursor.execute(SQL_DEMANDAS_AGENDA + """
             WHERE ae.DT_INICIO <= %s AND ae.DT_FIM >= %s
             ORDER BY 
                 CASE 
@@ -6315,53 +9201,7 @@ def buscar_dados_agenda():
         """, (fim, inicio))
         
         t5_processamento = time.time()
-        demandas = []
-        for r in cursor.fetchall():
-            dt_lancamento = r[14].strftime('%Y-%m-%d %H:%M:%S') if r[14] else ''
-            
-            horario = ''
-            if r[18]:
-                try:
-                    if isinstance(r[18], str):
-                        horario = r[18][:5] if len(r[18]) >= 5 else ''
-                    elif hasattr(r[18], 'total_seconds'):
-                        total_seconds = int(r[18].total_seconds())
-                        hours = total_seconds // 3600
-                        minutes = (total_seconds % 3600) // 60
-                        if hours > 0 or minutes > 0:
-                            horario = f"{hours:02d}:{minutes:02d}"
-                    elif hasattr(r[18], 'strftime'):
-                        horario_formatted = r[18].strftime('%H:%M')
-                        if horario_formatted != '00:00':
-                            horario = horario_formatted
-                except Exception as e:
-                    print(f"Erro ao formatar horário: {e}, tipo: {type(r[18])}, valor: {r[18]}")
-                    horario = ''
-            
-            demandas.append({
-                'id': r[0], 
-                'id_motorista': r[1], 
-                'nm_motorista': r[2],
-                'id_tipoveiculo': r[3], 
-                'de_tipodemanda': r[4], 
-                'id_tipodemanda': r[5],
-                'de_tipoveiculo': r[6], 
-                'id_veiculo': r[7], 
-                'dt_inicio': r[8].strftime('%Y-%m-%d'), 
-                'dt_fim': r[9].strftime('%Y-%m-%d'),
-                'setor': r[10] or '', 
-                'solicitante': r[11] or '', 
-                'destino': r[12] or '', 
-                'nu_sei': r[13] or '', 
-                'dt_lancamento': dt_lancamento,
-                'usuario': r[15] or '',
-                'obs': r[16] or '',
-                'solicitado': r[17] or 'N',
-                'horario': horario,
-                'todos_veiculos': r[19] or 'N',
-                'nc_motorista': r[20] or '',
-				'tipo_cadastro': r[21] or ''
-            })
+        demandas = [formatar_demanda_agenda(r) for r in cursor.fetchall()]
         
         tempos['demandas_query'] = (t5_processamento - t5) * 1000
         tempos['demandas_processamento'] = (time.time() - t5_processamento) * 1000
@@ -6472,7 +9312,7 @@ def buscar_dados_agenda():
         print(f"⏱️  TEMPO TOTAL: {tempo_total:.2f}ms ({tempo_total/1000:.2f}s)")
         print(f"{'='*60}\n")
 
-        return jsonify({
+        dados = {
             'motoristas': motoristas,
             'motoristas_administrativo': motoristas_administrativo,
             'outros_motoristas': outros_motoristas,
@@ -6480,8 +9320,15 @@ def buscar_dados_agenda():
             'demandas': demandas,
             'diarias_terceirizados': diarias_terceirizados,
             'veiculos': veiculos,
-            'veiculos_extras': veiculos_extras,
+            'veiculos_extras': veiculos_extras
+        }
+        salvar_snapshot_agenda(inicio, fim, dados, geracao)
+
+        return jsonify({
+            **dados,
+            'versao': versao,
             '_debug': {
+                'snapshot': 'MISS',
                 'tempo_total_ms': tempo_total,
                 'tempo_total_s': tempo_total / 1000,
                 'detalhamento': tempos
@@ -6506,55 +9353,163 @@ def buscar_dados_agenda():
     finally:
         if cursor:
             cursor.close()
-			
+			
+# ============================================================
+# BLOCO 1: ROTA DE VERIFICAÇÃO DE SINCRONIZAÇÃO
+# Adicionar após a rota /api/agenda/dados
+# ============================================================
+
+@app.route('/api/agenda/check-updates', methods=['GET'])
+@login_required
+def check_agenda_updates():
+    """
+    Verifica se houve alterações na agenda desde o último check
+    
+    Responde a partir do mapa de últimas alterações por usuário (sem MySQL).
+    Só consulta AGENDA_ALTERACOES_LOG quando o check é anterior ao que o mapa
+    cobre (ex: logo após reinício), e mesmo assim sem função sobre a coluna.
+    """
+    cursor = None
+    try:
+        ultimo_check = request.args.get('last_check')
+        agora_local = datetime.now(timezone('America/Manaus')).replace(tzinfo=None)
+        last_update = agora_local.strftime('%Y-%m-%d %H:%M:%S')
+        
+        if not ultimo_check:
+            return jsonify({'has_updates': False, 'last_update': last_update})
+        
+        usuario_atual = session.get('usuario_login', '')
+        
+        has_updates = houve_alteracao_de_outros(ultimo_check, usuario_atual)
+        
+        if has_updates is None:
+            # DATA_ALTERACAO é gravada em UTC: converte o parâmetro (-04:00),
+            # não a coluna, para o índice em DATA_ALTERACAO poder ser usado
+            try:
+                ultimo_check_utc = datetime.strptime(ultimo_check[:19], '%Y-%m-%d %H:%M:%S') + timedelta(hours=4)
+            except ValueError:
+                return jsonify({'has_updates': False, 'last_update': last_update})
+            
+            cursor = mysql.connection.cursor()
+            cursor.execute("""
+                SELECT 1
+                FROM AGENDA_ALTERACOES_LOG 
+                WHERE DATA_ALTERACAO > %s
+                  AND USUARIO_ALTERACAO != %s
+                LIMIT 1
+            """, (ultimo_check_utc, usuario_atual))
+            
+            has_updates = cursor.fetchone() is not None
+        
+        return jsonify({
+            'has_updates': has_updates,
+            'last_update': last_update
+        })
+        
+    except Exception as e:
+        app.logger.error(f"❌ Erro em check_agenda_updates: {str(e)}")
+        return jsonify({'has_updates': False, 'error': str(e)}), 500
+    finally:
+        if cursor:
+            cursor.close()
+
 # ============================================================
-# BLOCO 1: ROTA DE VERIFICAÇÃO DE SINCRONIZAÇÃO
-# Adicionar após a rota /api/agenda/dados
+# DELTA DA AGENDA: APENAS DEMANDAS/DIÁRIAS ALTERADAS
 # ============================================================
 
-@app.route('/api/agenda/check-updates', methods=['GET'])
+AGENDA_DELTA_MAX_DEMANDAS = 500  # Acima disso é mais barato recarregar a semana
+
+@app.route('/api/agenda/delta', methods=['GET'])
 @login_required
-def check_agenda_updates():
-    """Verifica se houve alterações na agenda desde o último check"""
+def buscar_delta_agenda():
+    """
+    Retorna apenas as demandas e diárias alteradas desde o token 'since'
+    
+    Query params:
+        since: token de versão recebido de /api/agenda/dados ou de um delta anterior
+        inicio, fim: semana exibida (demandas que saíram dela vão em 'demandas_removidas')
+    
+    Se o token for inválido, de outro processo ou antigo demais, retorna
+    full_reload=True e o cliente deve recarregar /api/agenda/dados.
+    """
     cursor = None
     try:
-        ultimo_check = request.args.get('last_check')
+        since = request.args.get('since')
+        inicio = request.args.get('inicio')
+        fim = request.args.get('fim')
         
-        if not ultimo_check:
-            return jsonify({'has_updates': False})
+        alteracoes = alteracoes_agenda_desde(since)
         
-        usuario_atual = session.get('usuario_login', '')
+        if alteracoes is None:
+            return jsonify({'versao': versao_agenda_atual(), 'full_reload': True})
         
-        cursor = mysql.connection.cursor()
+        if not alteracoes:
+            return jsonify({
+                'versao': since,
+                'full_reload': False,
+                'demandas': [],
+                'demandas_removidas': [],
+                'diarias_terceirizados': [],
+                'id_ads_alterados': [],
+                'usuarios': []
+            })
         
-        # ===== BUSCAR em tabela de LOG em vez de SYNC =====
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total,
-                CONVERT_TZ(NOW(), '+00:00', '-04:00') as agora_local
-            FROM AGENDA_ALTERACOES_LOG 
-            WHERE CONVERT_TZ(DATA_ALTERACAO, '+00:00', '-04:00') > %s
-              AND USUARIO_ALTERACAO != %s
-        """, (ultimo_check, usuario_atual))
+        versao = f"{AGENDA_ALTERACOES_EPOCA}:{alteracoes[-1]['seq']}"
+        id_ads = sorted({a['id_ad'] for a in alteracoes if a['id_ad']})
+        usuarios = sorted({a['usuario'] for a in alteracoes if a['usuario']})
         
-        result = cursor.fetchone()
-        count = result[0]
-        agora_local = result[1]
+        if len(id_ads) > AGENDA_DELTA_MAX_DEMANDAS:
+            return jsonify({'versao': versao, 'full_reload': True})
         
-        # Formatar timestamp corretamente
-        if agora_local:
-            last_update = agora_local.strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            last_update = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        demandas = []
+        diarias_terceirizados = []
+        ids_visiveis = set()
+        
+        if id_ads:
+            cursor = mysql.connection.cursor()
+            marcadores = ', '.join(['%s'] * len(id_ads))
+            
+            # Estado ATUAL das demandas tocadas (a alteração pode ter sido sobrescrita)
+            cursor.execute(SQL_DEMANDAS_AGENDA + f"""
+                WHERE ae.ID_AD IN ({marcadores})
+            """, id_ads)
+            
+            for r in cursor.fetchall():
+                demanda = formatar_demanda_agenda(r)
+                if inicio and fim and not (demanda['dt_inicio'] <= fim and demanda['dt_fim'] >= inicio):
+                    continue  # Saiu da semana exibida
+                demandas.append(demanda)
+                ids_visiveis.add(demanda['id'])
+            
+            cursor.execute(f"""
+                SELECT IDITEM, ID_AD, FL_EMAIL
+                FROM DIARIAS_TERCEIRIZADOS
+                WHERE ID_AD IN ({marcadores})
+            """, id_ads)
+            
+            for r in cursor.fetchall():
+                if r[1] in ids_visiveis:
+                    diarias_terceirizados.append({
+                        'iditem': r[0],
+                        'id_ad': r[1],
+                        'fl_email': r[2] or 'N'
+                    })
         
         return jsonify({
-            'has_updates': count > 0,
-            'last_update': last_update
+            'versao': versao,
+            'full_reload': False,
+            'demandas': demandas,
+            'demandas_removidas': [i for i in id_ads if i not in ids_visiveis],
+            'diarias_terceirizados': diarias_terceirizados,
+            'id_ads_alterados': id_ads,  # Cliente substitui as diárias destes ID_AD
+            'usuarios': usuarios
         })
         
     except Exception as e:
-        app.logger.error(f"❌ Erro em check_agenda_updates: {str(e)}")
-        return jsonify({'has_updates': False, 'error': str(e)}), 500
+        print(f"❌ ERRO em buscar_delta_agenda: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e), 'full_reload': True}), 500
     finally:
         if cursor:
             cursor.close()
@@ -6586,6 +9541,444 @@ def registrar_alteracao_agenda(tipo_operacao='UPDATE'):
         if cursor:
             cursor.close()
 
+def limpar_log_alteracoes_agenda(dias=AGENDA_LOG_RETENCAO_DIAS, lote=5000):
+    """
+    Remove registros de AGENDA_ALTERACOES_LOG mais antigos que 'dias'
+    
+    Exclui em lotes (DELETE ... LIMIT) para não segurar locks longos na tabela.
+    
+    Returns:
+        int: Total de linhas removidas
+    """
+    cursor = mysql.connection.cursor()
+    limite = datetime.utcnow() - timedelta(days=dias)
+    total = 0
+    
+    try:
+        while True:
+            cursor.execute("""
+                DELETE FROM AGENDA_ALTERACOES_LOG
+                WHERE DATA_ALTERACAO < %s
+                LIMIT %s
+            """, (limite, lote))
+            mysql.connection.commit()
+            
+            total += cursor.rowcount
+            if cursor.rowcount < lote:
+                break
+    finally:
+        cursor.close()
+    
+    return total
+
+
+@app.cli.command('limpar-log-agenda')
+@click.option('--dias', default=AGENDA_LOG_RETENCAO_DIAS, show_default=True,
+              help='Mantém apenas os últimos N dias do log')
+def limpar_log_agenda_command(dias):
+    """Compacta AGENDA_ALTERACOES_LOG (uso: flask --app app limpar-log-agenda)"""
+    total = limpar_log_alteracoes_agenda(dias)
+    print(f"🧹 AGENDA_ALTERACOES_LOG: {total} registro(s) com mais de {dias} dia(s) removido(s)")
+
+
+@app.cli.command('teste-carga-agenda')
+@click.option('--login', required=True, help='Login usado nas requisições')
+@click.option('--concorrencia', default=8, show_default=True,
+              help='Quantidade de semanas carregadas ao mesmo tempo')
+def teste_carga_agenda_command(login, concorrencia):
+    """
+    Verifica se cargas simultâneas da agenda são serializadas pelo worker
+    (uso: ASYNC_MODE=eventlet flask --app app teste-carga-agenda --login fulano)
+    
+    Cada requisição pede uma semana diferente e os snapshots são descartados
+    antes de cada rodada, então todas vão ao banco. Com o worker serializando
+    (ex: mysqlclient sob eventlet), o tempo em paralelo fica próximo da soma
+    dos tempos sequenciais.
+    """
+    hoje = datetime.now(timezone('America/Manaus')).date()
+    domingo = hoje - timedelta(days=(hoje.weekday() + 1) % 7)
+    semanas = [
+        (domingo - timedelta(weeks=i), domingo - timedelta(weeks=i) + timedelta(days=6))
+        for i in range(concorrencia)
+    ]
+    
+    def carregar(inicio, fim, tempos):
+        with app.test_client() as client:
+            with client.session_transaction() as sessao:
+                sessao['usuario_login'] = login
+                sessao['usuario_nome'] = login
+            t0 = time.time()
+            resposta = client.get(f'/api/agenda/dados?inicio={inicio}&fim={fim}')
+            tempos.append(time.time() - t0)
+            if resposta.status_code != 200:
+                print(f"⚠️ {inicio}: HTTP {resposta.status_code}")
+    
+    print(f"🔧 ASYNC_MODE={ASYNC_MODE} | {concorrencia} semana(s)")
+    
+    # Rodada sequencial
+    invalidar_snapshots_agenda()
+    tempos_sequenciais = []
+    for inicio, fim in semanas:
+        carregar(inicio, fim, tempos_sequenciais)
+    soma_sequencial = sum(tempos_sequenciais)
+    
+    # Rodada simultânea
+    invalidar_snapshots_agenda()
+    tempos_paralelos = []
+    threads = [
+        threading.Thread(target=carregar, args=(inicio, fim, tempos_paralelos))
+        for inicio, fim in semanas
+    ]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total_paralelo = time.time() - t0
+    
+    razao = total_paralelo / soma_sequencial if soma_sequencial else 0
+    print(f"⏱️ Sequencial (soma): {soma_sequencial * 1000:.0f}ms")
+    print(f"⏱️ Simultâneo (total): {total_paralelo * 1000:.0f}ms")
+    print(f"📊 Simultâneo/sequencial: {razao:.2f} "
+          f"({'SERIALIZADO' if razao > 0.8 else 'concorrente'})")
+
+
+@app.cli.command('teste-sequencias')
+@click.option('--threads', default=8, show_default=True, help='Alocações simultâneas')
+@click.option('--ids', default=200, show_default=True, help='IDs pedidos por thread')
+def teste_sequencias_command(threads, ids):
+    """
+    Prova que proximo_id não repete IDs sob concorrência
+    (uso: flask --app app teste-sequencias)
+    
+    Usa a sequência TESTE_CONCORRENCIA (removida ao final), nada de dados reais.
+    Cada thread tem sua conexão e pede IDs com commit a cada um, como uma rota
+    de cadastro; a trava é a mesma linha de SEQUENCIAS que os processos disputam.
+    """
+    nome = 'TESTE_CONCORRENCIA'
+    if threads > app.config['MYSQL_POOL_MAX']:
+        threads = app.config['MYSQL_POOL_MAX']
+        print(f"⚠️ Limitado a {threads} thread(s) pelo MYSQL_POOL_MAX")
+    garantir_esquema()  # SEQUENCIAS
+    
+    obtidos = []
+    erros = []
+    lock = threading.Lock()
+    
+    def alocar():
+        try:
+            with app.app_context():
+                meus = []
+                for _ in range(ids):
+                    meus.append(proximo_id(nome))
+                    mysql.connection.commit()
+            with lock:
+                obtidos.extend(meus)
+        except Exception as e:
+            erros.append(e)
+    
+    print(f"🔧 SEQUENCIA_BLOCO={SEQUENCIA_BLOCO} | {threads} thread(s) x {ids} ID(s)")
+    workers = [threading.Thread(target=alocar) for _ in range(threads)]
+    t0 = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    total = time.time() - t0
+    
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute("DELETE FROM SEQUENCIAS WHERE NOME = %s", (nome,))
+        mysql.connection.commit()
+    finally:
+        cursor.close()
+    _sequencia_faixas.pop(nome, None)
+    
+    for e in erros:
+        print(f"❌ {e}")
+    repetidos = len(obtidos) - len(set(obtidos))
+    print(f"⏱️ {len(obtidos)} ID(s) em {total * 1000:.0f}ms ({len(obtidos) / total if total else 0:.0f}/s)")
+    if repetidos or erros:
+        raise click.ClickException(f"{repetidos} ID(s) repetido(s), {len(erros)} erro(s)")
+    print("✅ Nenhum ID repetido")
+
+
+@app.cli.command('limpar-cache-referencia')
+@click.argument('grupos', nargs=-1)
+def limpar_cache_referencia_command(grupos):
+    """Invalida dados de referência alterados direto no banco (sem grupos, todos)"""
+    desconhecidos = [grupo for grupo in grupos if grupo not in REFERENCIA_GRUPOS]
+    if desconhecidos:
+        raise click.BadParameter(f"{', '.join(desconhecidos)} (use: {', '.join(REFERENCIA_GRUPOS)})")
+    
+    invalidar_dados_referencia(*grupos)
+    print(f"🧹 Cache de referência invalidado: {', '.join(grupos or REFERENCIA_GRUPOS)}")
+
+
+# Colunas do blob store em VISTORIA_ITENS (FOTO passa a ficar NULL após migrar)
+SQL_VISTORIA_ITENS_BLOB_STORE = [
+    ("FOTO_HASH", "ALTER TABLE VISTORIA_ITENS ADD COLUMN FOTO_HASH CHAR(64) NULL"),
+    ("FOTO_TAMANHO", "ALTER TABLE VISTORIA_ITENS ADD COLUMN FOTO_TAMANHO INT UNSIGNED NULL"),
+    ("FOTO_TAMANHO_ORIGINAL", "ALTER TABLE VISTORIA_ITENS ADD COLUMN FOTO_TAMANHO_ORIGINAL INT UNSIGNED NULL"),
+    ("FOTO_MIME", "ALTER TABLE VISTORIA_ITENS ADD COLUMN FOTO_MIME VARCHAR(30) NULL"),
+    ("FOTO_LARGURA", "ALTER TABLE VISTORIA_ITENS ADD COLUMN FOTO_LARGURA SMALLINT UNSIGNED NULL"),
+    ("FOTO_ALTURA", "ALTER TABLE VISTORIA_ITENS ADD COLUMN FOTO_ALTURA SMALLINT UNSIGNED NULL"),
+]
+
+
+@migracao
+def _migracao_vistoria_itens_blob_store(cursor):
+    adicionar_colunas(cursor, 'VISTORIA_ITENS', SQL_VISTORIA_ITENS_BLOB_STORE)
+
+
+@app.cli.command('migrar-esquema')
+def migrar_esquema_command():
+    """Cria as tabelas e colunas novas (uso no deploy: flask --app app migrar-esquema)"""
+    garantir_esquema()
+
+
+@app.cli.command('migrar-fotos')
+@click.option('--lote', default=50, show_default=True, help='Fotos lidas do banco por vez')
+@click.option('--manter-blob', is_flag=True, help='Não apaga o BLOB do banco após copiar')
+def migrar_fotos_command(lote, manter_blob):
+    """
+    Copia VISTORIA_ITENS.FOTO para o blob store (uso: flask --app app migrar-fotos)
+    
+    Sem --manter-blob o BLOB é apagado do banco: antes, confirme que
+    BLOB_STORE_DIR é um volume persistente (ou BLOB_STORE=s3).
+    """
+    garantir_esquema()  # colunas do blob store
+    
+    cursor = mysql.connection.cursor()
+    try:
+        ultimo_id = 0
+        total = 0
+        bytes_total = 0
+        
+        while True:
+            # Lote limitado: no máximo `lote` BLOBs em memória
+            cursor.execute("""
+                SELECT ID, FOTO FROM VISTORIA_ITENS
+                WHERE ID > %s AND FOTO IS NOT NULL AND FOTO_HASH IS NULL
+                ORDER BY ID
+                LIMIT %s
+            """, (ultimo_id, lote))
+            registros = cursor.fetchall()
+            if not registros:
+                break
+            
+            for item_id, foto in registros:
+                foto_hash, tamanho = blob_store.gravar(BytesIO(foto))
+                if not blob_store.existe(foto_hash):
+                    raise click.ClickException(f"Foto {item_id} não confirmada no blob store")
+                largura, altura = dimensoes_imagem(foto)
+                
+                cursor.execute(f"""
+                    UPDATE VISTORIA_ITENS
+                    SET FOTO_HASH = %s, FOTO_TAMANHO = %s, FOTO_TAMANHO_ORIGINAL = %s, FOTO_MIME = %s,
+                        FOTO_LARGURA = %s, FOTO_ALTURA = %s
+                        {'' if manter_blob else ', FOTO = NULL'}
+                    WHERE ID = %s
+                """, (foto_hash, tamanho, tamanho, detectar_mime_imagem(foto[:16]),
+                      largura, altura, item_id))
+                
+                ultimo_id = item_id
+                total += 1
+                bytes_total += tamanho
+            
+            mysql.connection.commit()
+            print(f"📦 {total} foto(s) migrada(s) ({bytes_total / 1024 / 1024:.1f} MB) - último ID {ultimo_id}")
+    finally:
+        cursor.close()
+    
+    print(f"✅ Migração concluída: {total} foto(s)")
+
+
+@app.cli.command('migrar-assinaturas')
+@click.option('--lote', default=100, show_default=True, help='Vistorias lidas do banco por vez')
+def migrar_assinaturas_command(lote):
+    """Move ASS_USUARIO/ASS_MOTORISTA para VISTORIA_ASSINATURAS (uso: flask --app app migrar-assinaturas)"""
+    garantir_esquema()  # VISTORIA_ASSINATURAS
+    
+    cursor = mysql.connection.cursor()
+    try:
+        ultimo_id = 0
+        total = 0
+        bytes_antes = 0
+        bytes_depois = 0
+        
+        while True:
+            cursor.execute("""
+                SELECT IDVISTORIA, ASS_USUARIO, ASS_MOTORISTA FROM VISTORIAS
+                WHERE IDVISTORIA > %s AND (ASS_USUARIO IS NOT NULL OR ASS_MOTORISTA IS NOT NULL)
+                ORDER BY IDVISTORIA
+                LIMIT %s
+            """, (ultimo_id, lote))
+            registros = cursor.fetchall()
+            if not registros:
+                break
+            
+            for id_vistoria, ass_usuario, ass_motorista in registros:
+                for tipo, dados in (('usuario', ass_usuario), ('motorista', ass_motorista)):
+                    if not dados:
+                        continue
+                    # Não sobrescreve assinatura já gravada na tabela nova
+                    cursor.execute("SELECT 1 FROM VISTORIA_ASSINATURAS WHERE IDVISTORIA = %s AND TIPO = %s",
+                                   (id_vistoria, tipo))
+                    if cursor.fetchone():
+                        cursor.execute(f"UPDATE VISTORIAS SET {ASSINATURA_COLUNAS[tipo]} = NULL WHERE IDVISTORIA = %s",
+                                       (id_vistoria,))
+                        continue
+                    
+                    bytes_depois += gravar_assinatura(cursor, id_vistoria, tipo, dados)
+                    bytes_antes += len(dados)
+                    total += 1
+                ultimo_id = id_vistoria
+            
+            mysql.connection.commit()
+            print(f"✍️ {total} assinatura(s) migrada(s) ({bytes_antes / 1024:.0f} KB → {bytes_depois / 1024:.0f} KB) "
+                  f"- última vistoria {ultimo_id}")
+    finally:
+        cursor.close()
+    
+    print(f"✅ Migração concluída: {total} assinatura(s)")
+
+
+# Índices da lista paginada (TIPO/STATUS + DATA; o PK completa a chave do
+# cursor) e da busca da devolução pela saída
+SQL_VISTORIAS_INDICES = [
+    ("IDX_VISTORIAS_LISTA", "CREATE INDEX IDX_VISTORIAS_LISTA ON VISTORIAS (TIPO, STATUS, DATA)"),
+    ("IDX_VISTORIAS_SAIDA", "CREATE INDEX IDX_VISTORIAS_SAIDA ON VISTORIAS (VISTORIA_SAIDA_ID)"),
+]
+
+
+@app.cli.command('criar-indices-vistorias')
+def criar_indices_vistorias_command():
+    """Cria os índices usados pela lista de vistorias (uso: flask --app app criar-indices-vistorias)"""
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute("""
+            SELECT DISTINCT INDEX_NAME FROM INFORMATION_SCHEMA.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'VISTORIAS'
+        """)
+        existentes = {row[0].upper() for row in cursor.fetchall()}
+        for indice, ddl in SQL_VISTORIAS_INDICES:
+            if indice in existentes:
+                print(f"✓ Índice {indice} já existe")
+                continue
+            cursor.execute(ddl)
+            print(f"🔧 Índice {indice} criado")
+    finally:
+        cursor.close()
+
+
+@app.cli.command('migrar-cnh')
+@click.option('--lote', default=20, show_default=True, help='PDFs lidos do banco por vez')
+@click.option('--manter-blob', is_flag=True, help='Não apaga o FILE_PDF do banco após copiar')
+def migrar_cnh_command(lote, manter_blob):
+    """Copia CAD_MOTORISTA.FILE_PDF para o blob store (uso: flask --app app migrar-cnh)"""
+    garantir_esquema()  # colunas da CNH
+    
+    cursor = mysql.connection.cursor()
+    try:
+        ultimo_id = -1
+        total = 0
+        bytes_total = 0
+        
+        while True:
+            cursor.execute("""
+                SELECT ID_MOTORISTA, FILE_PDF FROM CAD_MOTORISTA
+                WHERE ID_MOTORISTA > %s AND FILE_PDF IS NOT NULL AND CNH_HASH IS NULL
+                ORDER BY ID_MOTORISTA
+                LIMIT %s
+            """, (ultimo_id, lote))
+            registros = cursor.fetchall()
+            if not registros:
+                break
+            
+            for id_motorista, pdf in registros:
+                cnh_hash, tamanho = blob_store.gravar(BytesIO(pdf))
+                if not blob_store.existe(cnh_hash):
+                    raise click.ClickException(f"CNH do motorista {id_motorista} não confirmada no blob store")
+                
+                cursor.execute(f"""
+                    UPDATE CAD_MOTORISTA
+                    SET CNH_HASH = %s, CNH_TAMANHO = %s, HAS_CNH = 1
+                        {'' if manter_blob else ', FILE_PDF = NULL'}
+                    WHERE ID_MOTORISTA = %s
+                """, (cnh_hash, tamanho, id_motorista))
+                
+                ultimo_id = id_motorista
+                total += 1
+                bytes_total += tamanho
+            
+            mysql.connection.commit()
+            print(f"📦 {total} CNH(s) migrada(s) ({bytes_total / 1024 / 1024:.1f} MB) - último ID {ultimo_id}")
+    finally:
+        cursor.close()
+    
+    print(f"✅ Migração concluída: {total} CNH(s)")
+
+
+@app.cli.command('benchmark-email')
+@click.option('--vezes', default=1000, show_default=True, help='Renderizações medidas')
+def benchmark_email_command(vezes):
+    """Mede a renderização dos templates de email (uso: flask --app app benchmark-email)"""
+    contexto = {
+        'saudacao': 'Bom dia', 'texto_processo': 'Solicito locação de veículo conforme informações abaixo:',
+        'id_item': 1, 'dt_inicial': '01/01/2025', 'hr_inicial': '08:00', 'dt_final': '02/01/2025',
+        'de_veiculo': 'Sedan', 'info_condutor': 'Condutor de Teste', 'objetivo': 'Teste',
+        'obs_texto': 'Sem observações adicionais', 'nome_usuario': 'Administrador'
+    }
+    for nome in EMAIL_TEMPLATES:
+        inicio = time.perf_counter()
+        for _ in range(vezes):
+            html, _ = renderizar_email(nome, **contexto)
+        render_ms = (time.perf_counter() - inicio) * 1000 / vezes
+        
+        inicio = time.perf_counter()
+        for _ in range(vezes):
+            html_para_texto(html)
+        texto_ms = (time.perf_counter() - inicio) * 1000 / vezes
+        
+        print(f"📨 {nome}: render {render_ms:.3f} ms, HTML→texto {texto_ms:.4f} ms (cache), {len(html)} bytes")
+
+
+@app.cli.command('enviar-emails')
+@click.option('--reenviar-falhas', is_flag=True, help='Devolve para a fila as mensagens com FALHA')
+def enviar_emails_command(reenviar_falhas):
+    """Envia as mensagens vencidas de EMAIL_FILA (uso: flask --app app enviar-emails)"""
+    garantir_esquema()  # EMAIL_FILA
+    
+    cursor = mysql.connection.cursor()
+    try:
+        if reenviar_falhas:
+            cursor.execute("""
+                UPDATE EMAIL_FILA SET STATUS = 'PENDENTE', TENTATIVAS = 0, PROXIMA_TENTATIVA = NOW()
+                WHERE STATUS = 'FALHA'
+            """)
+            print(f"🔁 {cursor.rowcount} mensagem(ns) com falha devolvida(s) para a fila")
+        mysql.connection.commit()
+    finally:
+        cursor.close()
+    
+    total = 0
+    conexao = ConexaoSMTP()
+    try:
+        while True:
+            processadas = processar_fila_emails(conexao=conexao)
+            total += processadas
+            if processadas < EMAIL_LOTE:
+                break
+    finally:
+        conexao.fechar()
+    
+    m = estatisticas_envio_emails()
+    print(f"✅ {total} mensagem(ns) processada(s): {m['mensagens']} enviada(s), {m['falhas']} falha(s), "
+          f"{m['conexoes']} conexão(ões), {m['mensagens_por_segundo']:.1f} msg/s "
+          f"(conexão {m['conexao_media_ms']:.0f} ms, envio {m['envio_medio_ms']:.0f} ms)")
+
+
 def calcular_quantidade_diarias(dt_inicio, dt_fim):
     """
     Calcula a quantidade de diárias baseado nas datas de início e fim
@@ -6835,6 +10228,7 @@ def buscar_veiculos_disponiveis():
 # API: Buscar tipos de demanda
 @app.route('/api/agenda/tipos-demanda', methods=['GET'])
 @login_required
+@dados_referencia('tipos_demanda')
 def buscar_tipos_demanda():
     try:
         cursor = mysql.connection.cursor()
@@ -6924,6 +10318,7 @@ def buscar_tipos_demanda_completo():
 # API: Buscar tipos de veículo
 @app.route('/api/agenda/tipos-veiculo', methods=['GET'])
 @login_required
+@dados_referencia('tipos_veiculo')
 def buscar_tipos_veiculo():
     try:
         cursor = mysql.connection.cursor()
@@ -7064,6 +10459,7 @@ def criar_feriado():
         
         mysql.connection.commit()
         id_feriado = cursor.lastrowid
+        invalidar_snapshots_agenda((data['dt_feriado'], data['dt_feriado']))
         
         return jsonify({'success': True, 'id': id_feriado})
         
@@ -7082,9 +10478,15 @@ def excluir_feriado(id_feriado):
     cursor = None
     try:
         cursor = mysql.connection.cursor()
+        cursor.execute("SELECT DT_FERIADO FROM AGENDA_FERIADOS WHERE ID_FERIADO = %s", (id_feriado,))
+        feriado = cursor.fetchone()
+        
         cursor.execute("DELETE FROM AGENDA_FERIADOS WHERE ID_FERIADO = %s", (id_feriado,))
         mysql.connection.commit()
         
+        if feriado:
+            invalidar_snapshots_agenda((feriado[0], feriado[0]))
+        
         return jsonify({'success': True})
         
     except Exception as e:
@@ -8421,6 +11823,7 @@ def criar_locacao_fornecedor():
 
 @app.route('/api/tipo-demanda', methods=['GET'])
 @login_required
+@dados_referencia('tipos_demanda')
 def listar_tipo_demanda():
     cursor = None
     try:
@@ -8576,6 +11979,7 @@ def criar_tipo_demanda():
         ))
         
         mysql.connection.commit()
+        invalidar_dados_referencia('tipos_demanda')
         
         return jsonify({
             'message': 'Tipo de demanda criado com sucesso',
@@ -8649,6 +12053,10 @@ def atualizar_tipo_demanda(id):
         if cursor.rowcount == 0:
             return jsonify({'error': 'Tipo de demanda não encontrado'}), 404
         
+        # DE_TIPODEMANDA faz parte do snapshot da agenda
+        invalidar_snapshots_agenda()
+        invalidar_dados_referencia('tipos_demanda')
+        
         return jsonify({'message': 'Tipo de demanda atualizado com sucesso'})
         
     except Exception as e:
@@ -8672,6 +12080,8 @@ def deletar_tipo_demanda(id):
         if cursor.rowcount == 0:
             return jsonify({'error': 'Tipo de demanda não encontrado'}), 404
         
+        invalidar_dados_referencia('tipos_demanda')
+        
         return jsonify({'message': 'Tipo de demanda deletado com sucesso'})
         
     except Exception as e:
@@ -9427,6 +12837,7 @@ def listar_itens_orcamento(id_opa):
         return jsonify({'success': False, 'error': str(e)}), 500
     
 @app.route('/api/tipos-item-opa', methods=['GET'])
+@dados_referencia('tipos_item_opa')
 def get_tipos_item_opa():
     try:
         cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
@@ -9668,13 +13079,7 @@ def passagens_controle():
 
 
 def obter_proximo_id_of():
-    cursor = mysql.connection.cursor()
-    cursor.execute("SELECT MAX(ID_OF) FROM PASSAGENS_AEREAS_EMITIDAS")
-    resultado = cursor.fetchone()
-    cursor.close()
-    
-    ultimo_id = resultado[0] if resultado[0] else 0
-    return ultimo_id + 1
+    return proximo_id('PASSAGENS_AEREAS_EMITIDAS')
 
 
 # ----- NOVA ROTA: BUSCAR AEROPORTOS (AUTOCOMPLETE) -----
@@ -11468,6 +14873,7 @@ def criar_demanda_v2():
         )
         
         mysql.connection.commit()
+        invalidar_snapshots_agenda((dt_inicio, dt_fim))
         
         # BUSCAR DADOS COMPLETOS DA DEMANDA PARA EMITIR
         cursor.execute("""
@@ -11572,7 +14978,7 @@ def atualizar_demanda_v2(id_ad):
         
         # Buscar dados antigos
         cursor.execute("""
-            SELECT ID_TIPODEMANDA, ID_MOTORISTA
+            SELECT ID_TIPODEMANDA, ID_MOTORISTA, DT_INICIO, DT_FIM
             FROM AGENDA_DEMANDAS
             WHERE ID_AD = %s
         """, (id_ad,))
@@ -11580,6 +14986,7 @@ def atualizar_demanda_v2(id_ad):
         dados_antigos = cursor.fetchone()
         id_tipodemanda_antigo = dados_antigos[0] if dados_antigos else None
         id_motorista_antigo = dados_antigos[1] if dados_antigos else None
+        periodo_antigo = (dados_antigos[2], dados_antigos[3]) if dados_antigos else None
         
         # Converter horário
         horario = data.get('horario')
@@ -11722,6 +15129,8 @@ def atualizar_demanda_v2(id_ad):
         )
         
         mysql.connection.commit()
+        # Semanas antigas e novas (a demanda pode ter mudado de período)
+        invalidar_snapshots_agenda(periodo_antigo, (dt_inicio, dt_fim))
         
         # BUSCAR DADOS ATUALIZADOS PARA EMITIR
         cursor.execute("""
@@ -11791,7 +15200,7 @@ def atualizar_demanda_v2(id_ad):
             }
             
             # EMITIR WEBSOCKET
-            emitir_alteracao_demanda('UPDATE', id_ad, dados_demanda)
+            emitir_alteracao_demanda('UPDATE', id_ad, dados_demanda, periodo_anterior=periodo_antigo)
         
         cursor.close()
         
@@ -11821,6 +15230,8 @@ def excluir_demanda_v2(id_ad):
     try:
         cursor = mysql.connection.cursor()
         
+        periodo_demanda = buscar_periodo_demanda(cursor, id_ad)
+        
         # Log de diárias
         cursor.execute("SELECT COUNT(*) FROM DIARIAS_MOTORISTAS WHERE ID_AD = %s", (id_ad,))
         tem_diaria_motorista = cursor.fetchone()[0] > 0
@@ -11839,10 +15250,11 @@ def excluir_demanda_v2(id_ad):
         cursor.execute("DELETE FROM AGENDA_DEMANDAS WHERE ID_AD = %s", (id_ad,))
         
         mysql.connection.commit()
+        invalidar_snapshots_agenda(periodo_demanda)
         cursor.close()
         
         # EMITIR WEBSOCKET
-        emitir_alteracao_demanda('DELETE', id_ad)
+        emitir_alteracao_demanda('DELETE', id_ad, periodo_anterior=periodo_demanda)
         
         return jsonify({'success': True})
 
@@ -11891,22 +15303,9 @@ def enviar_email_fornecedor_v2():
         nome_usuario = session.get('usuario_nome', 'Administrador')
         
         # Criar versão texto
-        from html.parser import HTMLParser
-        
-        class HTMLToText(HTMLParser):
-            def __init__(self):
-                super().__init__()
-                self.text = []
-            def handle_data(self, data):
-                self.text.append(data)
-            def get_text(self):
-                return ''.join(self.text)
-        
-        parser = HTMLToText()
-        parser.feed(corpo_html)
-        corpo_texto = parser.get_text()
-        
-        # Enviar email
+        corpo_texto = html_para_texto(corpo_html)
+        
+        # Montar email (o envio fica com a fila)
         msg = Message(
             subject=assunto,
             recipients=[email_destinatario],
@@ -11918,15 +15317,9 @@ def enviar_email_fornecedor_v2():
         for anexo in anexos:
             msg.attach(anexo['nome'], anexo['tipo'], anexo['conteudo'])
         
-        mail.send(msg)
-        
-        # Registrar no banco
+        usuario_login = session.get('usuario_login', '')
         cursor = mysql.connection.cursor()
         
-        from pytz import timezone
-        tz_manaus = timezone('America/Manaus')
-        data_hora_atual = datetime.now(tz_manaus).strftime("%d/%m/%Y %H:%M:%S")
-        
         if tipo_email == 'diarias':
             # EMAIL DE DIÁRIAS
             if not id_item_fornecedor or id_item_fornecedor == '0':
@@ -11944,131 +15337,40 @@ def enviar_email_fornecedor_v2():
             else:
                 iditem_diaria = int(id_item_fornecedor)
             
-            # Inserir em EMAIL_DIARIAS
-            cursor.execute("""
-                INSERT INTO EMAIL_DIARIAS 
-                (IDITEM, ID_AD, DESTINATARIO, ASSUNTO, TEXTO, DATA_HORA) 
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (iditem_diaria, id_demanda, email_destinatario, assunto, corpo_texto, data_hora_atual))
-            
-            id_email = cursor.lastrowid
-            
-            # Atualizar FL_EMAIL
-            cursor.execute("""
-                UPDATE DIARIAS_TERCEIRIZADOS 
-                SET FL_EMAIL = 'S' 
-                WHERE IDITEM = %s
-            """, (iditem_diaria,))
-            
-            mysql.connection.commit()
-            
-            # EMITIR WEBSOCKET
-            emitir_alteracao_diaria_terceirizado('UPDATE', iditem_diaria, id_demanda, 'S')
+            # EMAIL_DIARIAS, FL_EMAIL e WebSocket ficam para a entrega
+            id_fila = enfileirar_email(cursor, msg, 'fornecedor_diarias', {
+                'iditem': iditem_diaria,
+                'id_demanda': id_demanda,
+                'destinatario': email_destinatario,
+                'assunto': assunto,
+                'texto': corpo_texto,
+                'usuario': usuario_login
+            })
         
         else:
-            # EMAIL DE LOCAÇÃO
-            cursor.execute("""
-                INSERT INTO EMAIL_OUTRAS_LOCACOES 
-                (ID_AD, ID_ITEM, DESTINATARIO, ASSUNTO, TEXTO, DATA_HORA) 
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (id_demanda, id_item_fornecedor or 0, email_destinatario, assunto, corpo_texto, data_hora_atual))
-            
-            id_email = cursor.lastrowid
-            
-            # Atualizar SOLICITADO
-            cursor.execute("""
-                UPDATE AGENDA_DEMANDAS 
-                SET SOLICITADO = 'S' 
-                WHERE ID_AD = %s
-            """, (id_demanda,))
-            
-            if id_item_fornecedor:
-                cursor.execute("""
-                    UPDATE CONTROLE_LOCACAO_ITENS 
-                    SET FL_EMAIL = 'S' 
-                    WHERE ID_ITEM = %s
-                """, (id_item_fornecedor,))
-            
-            mysql.connection.commit()
-            
-            # BUSCAR DADOS ATUALIZADOS E EMITIR
-            cursor.execute("""
-                SELECT ae.ID_AD, ae.ID_MOTORISTA, 
-                       CASE 
-                           WHEN ae.ID_MOTORISTA = 0 THEN CONCAT(ae.NC_MOTORISTA, ' (Não Cadast.)')
-                           ELSE m.NM_MOTORISTA 
-                       END as NOME_MOTORISTA, 
-                       ae.ID_TIPOVEICULO, td.DE_TIPODEMANDA, ae.ID_TIPODEMANDA, 
-                       tv.DE_TIPOVEICULO, ae.ID_VEICULO, ae.DT_INICIO, ae.DT_FIM,
-                       ae.SETOR, ae.SOLICITANTE, ae.DESTINO, ae.NU_SEI, 
-                       ae.DT_LANCAMENTO, ae.USUARIO, ae.OBS, ae.SOLICITADO, ae.HORARIO,
-                       ae.TODOS_VEICULOS, ae.NC_MOTORISTA
-                FROM AGENDA_DEMANDAS ae
-                LEFT JOIN CAD_MOTORISTA m ON m.ID_MOTORISTA = ae.ID_MOTORISTA
-                LEFT JOIN TIPO_DEMANDA td ON td.ID_TIPODEMANDA = ae.ID_TIPODEMANDA
-                LEFT JOIN TIPO_VEICULO tv ON tv.ID_TIPOVEICULO = ae.ID_TIPOVEICULO
-                WHERE ae.ID_AD = %s
-            """, (id_demanda,))
-            
-            row = cursor.fetchone()
-            
-            if row:
-                dt_lancamento = row[14].strftime('%Y-%m-%d %H:%M:%S') if row[14] else ''
-                
-                horario_formatado = ''
-                if row[17]:
-                    try:
-                        if isinstance(row[17], str):
-                            horario_formatado = row[17][:5]
-                        elif hasattr(row[17], 'total_seconds'):
-                            total_seconds = int(row[17].total_seconds())
-                            hours = total_seconds // 3600
-                            minutes = (total_seconds % 3600) // 60
-                            if hours > 0 or minutes > 0:
-                                horario_formatado = f"{hours:02d}:{minutes:02d}"
-                        elif hasattr(row[17], 'strftime'):
-                            horario_formatted = row[17].strftime('%H:%M')
-                            if horario_formatted != '00:00':
-                                horario_formatado = horario_formatted
-                    except:
-                        horario_formatado = ''
-                
-                dados_demanda = {
-                    'id': row[0], 
-                    'id_motorista': row[1], 
-                    'nm_motorista': row[2],
-                    'id_tipoveiculo': row[3], 
-                    'de_tipodemanda': row[4], 
-                    'id_tipodemanda': row[5],
-                    'de_tipoveiculo': row[6], 
-                    'id_veiculo': row[7], 
-                    'dt_inicio': row[8].strftime('%Y-%m-%d'), 
-                    'dt_fim': row[9].strftime('%Y-%m-%d'),
-                    'setor': row[10] or '', 
-                    'solicitante': row[11] or '', 
-                    'destino': row[12] or '', 
-                    'nu_sei': row[13] or '', 
-                    'dt_lancamento': dt_lancamento,
-                    'usuario': row[15] or '',
-                    'obs': row[16] or '',
-                    'solicitado': row[17] or 'N',
-                    'horario': horario_formatado,
-                    'todos_veiculos': row[19] or 'N',  # ← row[19] não row[18]
-                    'nc_motorista': row[20] or ''      # ← row[20] não row[19]
-                }
-                
-                emitir_alteracao_demanda('UPDATE', id_demanda, dados_demanda)
+            # EMAIL DE LOCAÇÃO: EMAIL_OUTRAS_LOCACOES, SOLICITADO e FL_EMAIL na entrega
+            id_fila = enfileirar_email(cursor, msg, 'fornecedor_locacao', {
+                'id_demanda': id_demanda,
+                'id_item_fornecedor': id_item_fornecedor,
+                'destinatario': email_destinatario,
+                'assunto': assunto,
+                'texto': corpo_texto,
+                'usuario': usuario_login
+            })
         
+        mysql.connection.commit()
         cursor.close()
+        cursor = None
+        acordar_envio_emails()
         
         return jsonify({
             'success': True,
-            'id_email': id_email,
-            'mensagem': 'Email enviado com sucesso!'
+            'id_fila': id_fila,
+            'mensagem': 'Email na fila de envio'
         })
         
     except Exception as e:
-        print(f"❌ Erro ao enviar email: {str(e)}")
+        print(f"❌ Erro ao enfileirar email: {str(e)}")
         import traceback
         traceback.print_exc()
         if cursor:
@@ -12079,6 +15381,143 @@ def enviar_email_fornecedor_v2():
             cursor.close()
 
 
+@callback_email('fornecedor_diarias')
+def registrar_email_fornecedor_diarias(cursor, dados, entregue):
+    """Entrega do email de diárias: EMAIL_DIARIAS, FL_EMAIL e aviso à agenda"""
+    if not entregue:
+        return None
+    
+    from pytz import timezone
+    data_hora_atual = datetime.now(timezone('America/Manaus')).strftime("%d/%m/%Y %H:%M:%S")
+    iditem_diaria = dados['iditem']
+    id_demanda = dados['id_demanda']
+    
+    cursor.execute("""
+        INSERT INTO EMAIL_DIARIAS 
+        (IDITEM, ID_AD, DESTINATARIO, ASSUNTO, TEXTO, DATA_HORA) 
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, (iditem_diaria, id_demanda, dados['destinatario'], dados['assunto'], dados['texto'], data_hora_atual))
+    
+    cursor.execute("""
+        UPDATE DIARIAS_TERCEIRIZADOS 
+        SET FL_EMAIL = 'S' 
+        WHERE IDITEM = %s
+    """, (iditem_diaria,))
+    
+    def pos_commit():
+        periodo_demanda = buscar_periodo_demanda(cursor, id_demanda)
+        invalidar_snapshots_agenda(periodo_demanda)
+        emitir_alteracao_diaria_terceirizado('UPDATE', iditem_diaria, id_demanda, 'S',
+                                             periodo=periodo_demanda, usuario=dados.get('usuario', ''))
+    return pos_commit
+
+
+@callback_email('fornecedor_locacao')
+def registrar_email_fornecedor_locacao(cursor, dados, entregue):
+    """Entrega do email de locação (agenda): EMAIL_OUTRAS_LOCACOES, SOLICITADO e FL_EMAIL"""
+    if not entregue:
+        return None
+    
+    from pytz import timezone
+    data_hora_atual = datetime.now(timezone('America/Manaus')).strftime("%d/%m/%Y %H:%M:%S")
+    id_demanda = dados['id_demanda']
+    id_item_fornecedor = dados.get('id_item_fornecedor')
+    
+    cursor.execute("""
+        INSERT INTO EMAIL_OUTRAS_LOCACOES 
+        (ID_AD, ID_ITEM, DESTINATARIO, ASSUNTO, TEXTO, DATA_HORA) 
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, (id_demanda, id_item_fornecedor or 0, dados['destinatario'], dados['assunto'], dados['texto'], data_hora_atual))
+    
+    cursor.execute("""
+        UPDATE AGENDA_DEMANDAS 
+        SET SOLICITADO = 'S' 
+        WHERE ID_AD = %s
+    """, (id_demanda,))
+    
+    if id_item_fornecedor:
+        cursor.execute("""
+            UPDATE CONTROLE_LOCACAO_ITENS 
+            SET FL_EMAIL = 'S' 
+            WHERE ID_ITEM = %s
+        """, (id_item_fornecedor,))
+    
+    def pos_commit():
+        invalidar_snapshots_agenda(buscar_periodo_demanda(cursor, id_demanda))
+        emitir_demanda_atualizada(cursor, id_demanda, dados.get('usuario', ''))
+    return pos_commit
+
+
+def emitir_demanda_atualizada(cursor, id_demanda, usuario=None):
+    """Relê a demanda e emite o UPDATE completo para a agenda"""
+    cursor.execute("""
+        SELECT ae.ID_AD, ae.ID_MOTORISTA, 
+               CASE 
+                   WHEN ae.ID_MOTORISTA = 0 THEN CONCAT(ae.NC_MOTORISTA, ' (Não Cadast.)')
+                   ELSE m.NM_MOTORISTA 
+               END as NOME_MOTORISTA, 
+               ae.ID_TIPOVEICULO, td.DE_TIPODEMANDA, ae.ID_TIPODEMANDA, 
+               tv.DE_TIPOVEICULO, ae.ID_VEICULO, ae.DT_INICIO, ae.DT_FIM,
+               ae.SETOR, ae.SOLICITANTE, ae.DESTINO, ae.NU_SEI, 
+               ae.DT_LANCAMENTO, ae.USUARIO, ae.OBS, ae.SOLICITADO, ae.HORARIO,
+               ae.TODOS_VEICULOS, ae.NC_MOTORISTA
+        FROM AGENDA_DEMANDAS ae
+        LEFT JOIN CAD_MOTORISTA m ON m.ID_MOTORISTA = ae.ID_MOTORISTA
+        LEFT JOIN TIPO_DEMANDA td ON td.ID_TIPODEMANDA = ae.ID_TIPODEMANDA
+        LEFT JOIN TIPO_VEICULO tv ON tv.ID_TIPOVEICULO = ae.ID_TIPOVEICULO
+        WHERE ae.ID_AD = %s
+    """, (id_demanda,))
+    
+    row = cursor.fetchone()
+    
+    if row:
+        dt_lancamento = row[14].strftime('%Y-%m-%d %H:%M:%S') if row[14] else ''
+        
+        horario_formatado = ''
+        if row[17]:
+            try:
+                if isinstance(row[17], str):
+                    horario_formatado = row[17][:5]
+                elif hasattr(row[17], 'total_seconds'):
+                    total_seconds = int(row[17].total_seconds())
+                    hours = total_seconds // 3600
+                    minutes = (total_seconds % 3600) // 60
+                    if hours > 0 or minutes > 0:
+                        horario_formatado = f"{hours:02d}:{minutes:02d}"
+                elif hasattr(row[17], 'strftime'):
+                    horario_formatted = row[17].strftime('%H:%M')
+                    if horario_formatted != '00:00':
+                        horario_formatado = horario_formatted
+            except:
+                horario_formatado = ''
+        
+        dados_demanda = {
+            'id': row[0], 
+            'id_motorista': row[1], 
+            'nm_motorista': row[2],
+            'id_tipoveiculo': row[3], 
+            'de_tipodemanda': row[4], 
+            'id_tipodemanda': row[5],
+            'de_tipoveiculo': row[6], 
+            'id_veiculo': row[7], 
+            'dt_inicio': row[8].strftime('%Y-%m-%d'), 
+            'dt_fim': row[9].strftime('%Y-%m-%d'),
+            'setor': row[10] or '', 
+            'solicitante': row[11] or '', 
+            'destino': row[12] or '', 
+            'nu_sei': row[13] or '', 
+            'dt_lancamento': dt_lancamento,
+            'usuario': row[15] or '',
+            'obs': row[16] or '',
+            'solicitado': row[17] or 'N',
+            'horario': horario_formatado,
+            'todos_veiculos': row[19] or 'N',  # ← row[19] não row[18]
+            'nc_motorista': row[20] or ''      # ← row[20] não row[19]
+        }
+        
+        emitir_alteracao_demanda('UPDATE', id_demanda, dados_demanda, usuario=usuario)
+
+
 """
 ============================================================
 ROTAS PARA GESTÃO DE CONTRATOS TERCEIRIZADOS
@@ -12260,6 +15699,7 @@ def api_listar_vinculos_terceirizados(id_contrato):
 # API - LISTAR IMPERFEIÇÕES
 # ============================================================
 @app.route('/api/gestao-terceirizados/imperfeicoes', methods=['GET'])
+@dados_referencia('imperfeicoes')
 def api_listar_imperfeicoes():
     """Lista todas as imperfeições cadastradas"""
     # if 'loggedin' not in session:
@@ -14460,6 +17900,38 @@ def api_resumo_mensal_contrato(id_contrato):
         }), 500
 
 
+# ============================================================
+# DIAGNÓSTICO
+# ============================================================
+
+@app.route('/api/diagnostico/pool-mysql', methods=['GET'])
+@login_required
+def diagnostico_pool_mysql():
+    """Estatísticas do pool de conexões MySQL deste processo"""
+    return jsonify({'success': True, 'pid': os.getpid(), 'pool': mysql.estatisticas()})
+
+
+@app.route('/api/diagnostico/fila-email', methods=['GET'])
+@login_required
+def diagnostico_fila_email():
+    """Situação da fila de emails (quantidade por status, últimas falhas e vazão deste processo)"""
+    cursor = mysql.connection.cursor()
+    try:
+        cursor.execute("SELECT STATUS, COUNT(*), MIN(DT_CRIACAO) FROM EMAIL_FILA GROUP BY STATUS")
+        por_status = {status: {'quantidade': qtd, 'mais_antiga': str(dt) if dt else None}
+                      for status, qtd, dt in cursor.fetchall()}
+        cursor.execute("""
+            SELECT ID, TIPO, DESTINATARIOS, TENTATIVAS, ULTIMO_ERRO, DT_CRIACAO
+            FROM EMAIL_FILA WHERE STATUS = 'FALHA'
+            ORDER BY ID DESC LIMIT 20
+        """)
+        falhas = [{'id': r[0], 'tipo': r[1], 'destinatarios': r[2], 'tentativas': r[3],
+                   'erro': r[4], 'dt_criacao': str(r[5])} for r in cursor.fetchall()]
+    finally:
+        cursor.close()
+    return jsonify({'success': True, 'pid': os.getpid(), 'status': por_status, 'falhas': falhas,
+                    'envio': estatisticas_envio_emails()})
+
 
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
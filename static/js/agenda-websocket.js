@@ -12,6 +12,7 @@ const AgendaWebSocket = (() => {
     let pingInterval = null;
     let notificationQueue = [];
     let lastNotificationTime = 0;
+    let semanaAssinada = null; // { inicio, fim } da semana exibida
 
     const CONFIG = {
         PING_INTERVAL: 30000,
@@ -55,6 +56,8 @@ const AgendaWebSocket = (() => {
             log('✅ Conectado ao WebSocket');
             atualizarIndicador(true);
             iniciarPing();
+            // (Re)assinar a semana: o servidor devolve o que foi perdido offline
+            enviarAssinatura();
         });
         
         // Desconectado
@@ -86,6 +89,31 @@ const AgendaWebSocket = (() => {
         });
     }
     
+    /**
+     * Assinar a semana exibida (sala por semana + replay desde a versão local)
+     */
+    function enviarAssinatura() {
+        if (!socket || !socket.connected || !semanaAssinada) return;
+
+        const versao = typeof window.obterVersaoAgenda === 'function'
+            ? window.obterVersaoAgenda()
+            : null;
+
+        socket.emit('assinar_agenda', { ...semanaAssinada, versao }, (resposta) => {
+            if (!resposta || resposta.erro) {
+                console.error('[AgendaWS] ❌ Falha ao assinar semana:', resposta);
+                return;
+            }
+
+            log(`📅 Semana assinada: ${resposta.salas.join(', ')}`);
+
+            if (resposta.full_reload || resposta.alteracoes.length > 0) {
+                log(`🔁 Replay: ${resposta.alteracoes.length} alteração(ões) perdida(s)`);
+                recarregarAgenda();
+            }
+        });
+    }
+
     /**
      * Processar alteração recebida
      */
@@ -164,8 +192,12 @@ const AgendaWebSocket = (() => {
             // Salvar scroll
             const scrollPos = window.pageYOffset;
             
-            // Recarregar dados
-            await window.carregarDadosAgenda();
+            // Recarregar dados (delta quando disponível)
+            if (typeof window.atualizarDadosAgendaIncremental === 'function') {
+                await window.atualizarDadosAgendaIncremental();
+            } else {
+                await window.carregarDadosAgenda();
+            }
             
             // Renderizar
             if (typeof window.renderizarAgenda === 'function') {
@@ -357,6 +389,11 @@ const AgendaWebSocket = (() => {
     // API Pública
     return {
         init(usuario) {
+            // Já inicializado: mantém a mesma conexão (carregarAgenda roda a cada troca de semana)
+            if (socket) {
+                return true;
+            }
+
             log('🚀 Inicializando...');
             usuarioAtual = usuario;
             
@@ -374,6 +411,11 @@ const AgendaWebSocket = (() => {
             return socket && socket.connected;
         },
         
+        assinarSemana(inicio, fim) {
+            semanaAssinada = { inicio, fim };
+            enviarAssinatura();
+        },
+        
         desconectar() {
             pararPing();
             if (socket) {
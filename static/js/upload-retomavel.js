@@ -0,0 +1,130 @@
+/**
+ * ============================================================
+ * UPLOAD RETOMÁVEL - Fotos da vistoria em pedaços
+ * ============================================================
+ * Envia cada arquivo para /api/uploads em pedaços; se a conexão
+ * cair, consulta o offset no servidor e continua de onde parou.
+ * Retorna o midia_id usado em midias[] no salvar da vistoria.
+ * ============================================================
+ */
+
+const UploadRetomavel = (() => {
+    const CONFIG = {
+        TENTATIVAS: 8,          // por pedaço
+        ESPERA_INICIAL: 1000,   // ms, dobra a cada falha
+        ESPERA_MAXIMA: 15000
+    };
+
+    function log(mensagem, dados = null) {
+        console.log(`[Upload] ${mensagem}`, dados || '');
+    }
+
+    function esperar(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    async function requisicao(url, opcoes = {}) {
+        const resposta = await fetch(url, { credentials: 'same-origin', ...opcoes });
+        const dados = await resposta.json().catch(() => ({}));
+        return { status: resposta.status, dados };
+    }
+
+    /**
+     * Consultar quantos bytes o servidor já tem
+     */
+    async function obterOffset(uploadId) {
+        const { status, dados } = await requisicao(`/api/uploads/${uploadId}`);
+        if (status !== 200) throw new Error(dados.error || `HTTP ${status}`);
+        return dados.offset;
+    }
+
+    /**
+     * Enviar um arquivo; onProgresso(enviado, total) é opcional
+     */
+    async function enviar(arquivo, onProgresso = null) {
+        const inicio = await requisicao('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ tamanho: arquivo.size, nome: arquivo.name })
+        });
+        if (inicio.status !== 201) throw new Error(inicio.dados.error || `HTTP ${inicio.status}`);
+
+        const uploadId = inicio.dados.upload_id;
+        const pedacoMax = inicio.dados.pedaco_max;
+        let offset = 0;
+        let falhas = 0;
+
+        while (offset < arquivo.size) {
+            try {
+                const { status, dados } = await requisicao(`/api/uploads/${uploadId}`, {
+                    method: 'PATCH',
+                    headers: {
+                        'Content-Type': 'application/offset+octet-stream',
+                        'Upload-Offset': String(offset)
+                    },
+                    body: arquivo.slice(offset, offset + pedacoMax)
+                });
+
+                if (status === 200 || status === 409) {
+                    offset = dados.offset; // 409: servidor informa de onde continuar
+                    falhas = 0;
+                    if (onProgresso) onProgresso(offset, arquivo.size);
+                    continue;
+                }
+                throw new Error(dados.error || `HTTP ${status}`);
+            } catch (erro) {
+                falhas++;
+                if (falhas > CONFIG.TENTATIVAS) throw erro;
+
+                const espera = Math.min(CONFIG.ESPERA_INICIAL * 2 ** (falhas - 1), CONFIG.ESPERA_MAXIMA);
+                log(`⚠️ Falha no pedaço (${erro.message}), nova tentativa em ${espera}ms`);
+                await esperar(espera);
+
+                // O pedaço pode ter chegado apesar do erro: retomar do offset do servidor
+                try {
+                    offset = await obterOffset(uploadId);
+                } catch (e) {
+                    // Sem conexão ainda: tenta de novo no próximo ciclo
+                }
+            }
+        }
+
+        for (let tentativa = 0; ; tentativa++) {
+            try {
+                const { status, dados } = await requisicao(`/api/uploads/${uploadId}/finalizar`, { method: 'POST' });
+                if (status === 200) return dados.midia_id;
+                throw new Error(dados.error || `HTTP ${status}`);
+            } catch (erro) {
+                if (tentativa >= CONFIG.TENTATIVAS) throw erro;
+                await esperar(Math.min(CONFIG.ESPERA_INICIAL * 2 ** tentativa, CONFIG.ESPERA_MAXIMA));
+            }
+        }
+    }
+
+    /**
+     * Trocar os arquivos de `campo` no FormData por midias[] (ordem preservada)
+     */
+    async function substituirArquivos(formData, campo = 'fotos[]', onProgresso = null) {
+        const arquivos = formData.getAll(campo).filter(a => a instanceof Blob && a.size > 0);
+        const totalBytes = arquivos.reduce((soma, a) => soma + a.size, 0);
+        let bytesConcluidos = 0;
+        const midias = [];
+
+        for (const arquivo of arquivos) {
+            midias.push(await enviar(arquivo, (enviado) => {
+                if (onProgresso) onProgresso(bytesConcluidos + enviado, totalBytes);
+            }));
+            bytesConcluidos += arquivo.size;
+        }
+
+        formData.delete(campo);
+        midias.forEach(id => formData.append('midias[]', id));
+        log(`✅ ${midias.length} foto(s) enviada(s)`);
+        return formData;
+    }
+
+    return {
+        enviar,
+        substituirArquivos
+    };
+})();
@@ -0,0 +1,98 @@
+"""
+Fixtures dos testes
+
+Rodar: pip install -r requirements-dev.txt && python -m pytest -q
+
+Redis e SMTP são substituídos por servidores locais (fakeredis, aiosmtpd).
+Os testes que precisam de MySQL usam um banco descartável indicado por
+TEST_MYSQL_HOST/TEST_MYSQL_PORT/TEST_MYSQL_USER/TEST_MYSQL_PASSWORD e
+TEST_MYSQL_DB (padrão sot_teste); sem TEST_MYSQL_HOST eles são pulados.
+"""
+import os
+import sys
+import socket
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+os.environ.setdefault('SECRET_KEY', 'teste')
+# Os testes de fotos trocam o blob store por um em tmp_path; este só precisa existir
+os.environ.setdefault('BLOB_STORE_DIR', os.path.join(RAIZ, '.pytest_cache', 'blobstore'))
+
+try:
+    import MySQLdb  # noqa: F401
+except ImportError:
+    # Sem mysqlclient (exige libmysqlclient para compilar): o PyMySQL, que o
+    # app já usa nos modos eventlet/gevent, assume o papel do MySQLdb
+    import pymysql
+    pymysql.install_as_MySQLdb()
+    sys.modules['MySQLdb.cursors'] = pymysql.cursors
+
+import MySQLdb
+import pytest
+
+
+def porta_livre():
+    """Porta TCP livre em localhost"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    """Módulo app importado com o ambiente padrão (cache local, threading)"""
+    import app as modulo
+    modulo.app.config['TESTING'] = True
+    return modulo
+
+
+@pytest.fixture
+def blob_store(app_module, tmp_path, monkeypatch):
+    """Blob store local descartável no lugar do configurado"""
+    loja = app_module.BlobStoreLocal(str(tmp_path))
+    monkeypatch.setattr(app_module, 'blob_store', loja)
+    return loja
+
+
+@pytest.fixture
+def banco(app_module, monkeypatch):
+    """
+    Banco MySQL descartável (recriado a cada teste) já configurado no app
+    
+    Começa vazio: cada teste cria as tabelas de que precisa. Retorna uma
+    conexão direta (fora do pool) para preparar os dados.
+    """
+    host = os.getenv('TEST_MYSQL_HOST')
+    if not host:
+        pytest.skip('TEST_MYSQL_HOST não definido')
+    
+    config = {
+        'MYSQL_HOST': host,
+        'MYSQL_PORT': int(os.getenv('TEST_MYSQL_PORT', 3306)),
+        'MYSQL_USER': os.getenv('TEST_MYSQL_USER', 'root'),
+        'MYSQL_PASSWORD': os.getenv('TEST_MYSQL_PASSWORD', ''),
+        'MYSQL_DB': os.getenv('TEST_MYSQL_DB', 'sot_teste'),
+    }
+    conexao = MySQLdb.connect(host=config['MYSQL_HOST'], port=config['MYSQL_PORT'],
+                              user=config['MYSQL_USER'], passwd=config['MYSQL_PASSWORD'],
+                              charset='utf8mb4')
+    cursor = conexao.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{config['MYSQL_DB']}`")
+    cursor.execute(f"CREATE DATABASE `{config['MYSQL_DB']}`")
+    cursor.close()
+    conexao.select_db(config['MYSQL_DB'])
+    
+    for chave, valor in config.items():
+        monkeypatch.setitem(app_module.app.config, chave, valor)
+    monkeypatch.setattr(app_module, '_esquema_pronto', True)  # tabelas criadas pelo teste
+    monkeypatch.setattr(app_module, '_envio_emails_iniciado', True)
+    
+    yield conexao
+    
+    conexao.close()
+    # Conexões livres do pool apontam para o banco deste teste
+    pool = app_module.mysql
+    with pool._cond:
+        while pool._livres:
+            pool._fechar(pool._livres.pop()[0])
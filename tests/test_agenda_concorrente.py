@@ -0,0 +1,65 @@
+"""
+Cargas simultâneas da agenda não podem ser serializadas nos modos cooperativos
+
+Um servidor TCP local faz o papel de um MySQL lento: aceita a conexão e só
+responde (encerrando-a) depois de ATRASO segundos. Cada carga de semana fica
+esse tempo esperando o banco; com o worker cooperativo de verdade as esperas
+se sobrepõem e o total fica perto de um ATRASO, e não de CARGAS × ATRASO.
+É a versão automática do `flask teste-carga-agenda`, sem precisar de banco.
+"""
+import json
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from conftest import porta_livre
+
+ATRASO = 1.0
+CARGAS = 5
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker_agenda_concorrente.py')
+
+
+class MySQLLento(socketserver.BaseRequestHandler):
+    def handle(self):
+        time.sleep(ATRASO)  # nenhum handshake: o cliente recebe a conexão fechada
+
+
+@pytest.fixture(scope='module')
+def mysql_lento():
+    servidor = socketserver.ThreadingTCPServer(('127.0.0.1', porta_livre()), MySQLLento)
+    servidor.daemon_threads = True
+    thread = threading.Thread(target=servidor.serve_forever, daemon=True)
+    thread.start()
+    yield servidor.server_address[1]
+    servidor.shutdown()
+    servidor.server_close()
+
+
+@pytest.mark.parametrize('modo', ['eventlet', 'gevent'])
+def test_cargas_simultaneas_nao_serializam(mysql_lento, modo):
+    pytest.importorskip(modo)
+    env = dict(os.environ,
+               ASYNC_MODE=modo,
+               MYSQL_HOST='127.0.0.1',
+               MYSQL_PORT=str(mysql_lento),
+               CARGAS=str(CARGAS))
+    env.pop('MYSQL_DRIVER', None)
+    saida = subprocess.run([sys.executable, WORKER], env=env, text=True,
+                           capture_output=True, timeout=120).stdout
+    linhas = [l for l in saida.splitlines() if l.startswith('@@ ')]
+    assert linhas, saida[-2000:]
+    resultado = json.loads(linhas[-1][3:])
+    
+    assert resultado['modo'] == modo
+    assert len(resultado['cargas']) == CARGAS
+    # Todas as cargas esperaram o "banco" (e falharam, pois ele não responde)
+    for carga in resultado['cargas']:
+        assert carga['s'] >= ATRASO * 0.9
+        assert carga['status'] == 500
+    # Serializado levaria CARGAS × ATRASO
+    assert resultado['total'] < ATRASO * 2, resultado
@@ -0,0 +1,45 @@
+"""
+Recompressão das assinaturas do canvas (compactar_assinatura) sem perda
+"""
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+
+def canvas_assinatura(cor=(20, 20, 90)):
+    """PNG RGBA como o do canvas: fundo transparente, traço antisserrilhado"""
+    grande = Image.new('RGBA', (1200, 400), (0, 0, 0, 0))
+    desenho = ImageDraw.Draw(grande)
+    desenho.line([(60, 300), (300, 80), (520, 320), (800, 100), (1100, 260)], fill=cor + (255,), width=9)
+    imagem = grande.resize((600, 200), Image.LANCZOS)
+    saida = BytesIO()
+    imagem.save(saida, 'PNG')
+    return saida.getvalue()
+
+
+def pixels(dados):
+    with Image.open(BytesIO(dados)) as imagem:
+        return imagem.convert('RGBA').tobytes()
+
+
+def test_compacta_sem_perder_pixels(app_module):
+    original = canvas_assinatura()
+    compactada = app_module.compactar_assinatura(original)
+    assert len(compactada) < len(original)
+    assert pixels(compactada) == pixels(original)
+
+
+def test_mais_de_256_cores_continua_sem_perda(app_module):
+    imagem = Image.new('RGBA', (64, 64))
+    imagem.putdata([(x * 4, y * 4, (x + y) % 256, 255) for y in range(64) for x in range(64)])
+    saida = BytesIO()
+    imagem.save(saida, 'PNG', compress_level=0)
+    original = saida.getvalue()
+    
+    compactada = app_module.compactar_assinatura(original)
+    assert len(compactada) <= len(original)
+    assert pixels(compactada) == pixels(original)
+
+
+def test_dados_invalidos_mantidos(app_module):
+    assert app_module.compactar_assinatura(b'nao e png') == b'nao e png'
@@ -0,0 +1,31 @@
+"""
+CNH dos motoristas: colunas criadas na subida e motoristas ainda em FILE_PDF
+"""
+PDF = b'%PDF-1.4 cnh de teste'
+
+
+def test_cnh_legada_conta_como_cadastrada_e_e_servida(app_module, banco):
+    cursor = banco.cursor()
+    cursor.execute("""
+        CREATE TABLE CAD_MOTORISTA (
+            ID_MOTORISTA INT PRIMARY KEY, NM_MOTORISTA VARCHAR(50),
+            NOME_ARQUIVO VARCHAR(100) NULL, FILE_PDF MEDIUMBLOB NULL
+        )
+    """)
+    cursor.execute("INSERT INTO CAD_MOTORISTA VALUES (1, 'Com PDF', 'cnh.pdf', %s), (2, 'Sem CNH', NULL, NULL)",
+                   (PDF,))
+    banco.commit()
+    
+    app_module._migracao_cad_motorista_cnh(cursor)
+    app_module._migracao_cad_motorista_cnh(cursor)  # idempotente
+    banco.commit()
+    
+    cursor.execute("SELECT ID_MOTORISTA, HAS_CNH, CNH_HASH FROM CAD_MOTORISTA ORDER BY 1")
+    assert cursor.fetchall() == ((1, 1, None), (2, 0, None))
+    
+    with app_module.app.test_request_context('/'):
+        resposta = app_module.enviar_cnh(1, as_attachment=False)
+        resposta.direct_passthrough = False
+        assert resposta.get_data() == PDF
+        assert resposta.mimetype == 'application/pdf'
+        assert app_module.enviar_cnh(2, as_attachment=False) is None
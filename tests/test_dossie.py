@@ -0,0 +1,63 @@
+"""
+Dossiê em PDF da vistoria: memória das fotos e limpeza das versões antigas
+"""
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+
+def jpeg(largura=1600, altura=1200):
+    saida = BytesIO()
+    Image.new('RGB', (largura, altura), (30, 120, 30)).save(saida, 'JPEG')
+    return saida.getvalue()
+
+
+def test_fotos_lidas_no_worker_com_memoria_limitada(app_module, blob_store, monkeypatch):
+    hashes = {item_id: blob_store.gravar(BytesIO(jpeg(1600 + item_id, 1200)))[0]
+              for item_id in range(app_module.FOTO_WORKERS * 3)}
+    abertas, pico, lock = [0], [0], threading.Lock()
+    abrir = blob_store.abrir
+
+    class Contando:
+        def __init__(self, origem):
+            self.origem = origem
+            with lock:
+                abertas[0] += 1
+                pico[0] = max(pico[0], abertas[0])
+
+        def __getattr__(self, nome):
+            return getattr(self.origem, nome)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *erro):
+            time.sleep(0.02)
+            with lock:
+                abertas[0] -= 1
+            self.origem.close()
+
+    monkeypatch.setattr(blob_store, 'abrir', lambda chave: Contando(abrir(chave)))
+    hashes[99] = 'f' * 64  # ausente no blob store
+
+    reduzidas = app_module.reduzir_fotos_dossie(None, {'fotos': hashes})
+
+    assert pico[0] <= app_module.FOTO_WORKERS
+    assert reduzidas[99] is None
+    assert all(reduzidas[item_id][1] <= app_module.DOSSIE_FOTO_PX for item_id in hashes if item_id != 99)
+
+
+def test_dossie_novo_remove_o_anterior(app_module, blob_store):
+    dossie = {'secoes': [(5,), (6,)]}
+    for versao in ('a' * 64, 'b' * 64):
+        blob_store.gravar_como(f'dossie_{versao}', BytesIO(b'%PDF'))
+        app_module.substituir_dossie_anterior(dossie, f'dossie_{versao}')
+
+    assert not blob_store.existe('dossie_' + 'a' * 64)
+    assert blob_store.existe('dossie_' + 'b' * 64)
+
+    # A mesma versão de novo (ex: dossiê já existente) não se remove
+    app_module.substituir_dossie_anterior(dossie, 'dossie_' + 'b' * 64)
+    assert blob_store.existe('dossie_' + 'b' * 64)
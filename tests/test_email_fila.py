@@ -0,0 +1,217 @@
+"""
+Fila de emails (EMAIL_FILA) com um servidor SMTP local (aiosmtpd)
+
+O caminho SMTP (ConexaoSMTP) roda sempre; enfileirar → entregar → callback,
+reenvio com espera exponencial e FALHA definitiva precisam de MySQL.
+"""
+import smtplib
+import time
+
+import MySQLdb
+import pytest
+
+aiosmtpd_controller = pytest.importorskip('aiosmtpd.controller')
+
+from flask_mail import Message
+
+from conftest import porta_livre
+
+RECUSADO = 'recusado@exemplo.gov.br'
+
+
+class Caixa:
+    """Handler do aiosmtpd: guarda as mensagens e recusa RECUSADO"""
+    
+    def __init__(self):
+        self.mensagens = []
+    
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address == RECUSADO:
+            return '550 5.1.1 Caixa inexistente'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+    
+    async def handle_DATA(self, server, session, envelope):
+        self.mensagens.append((envelope.mail_from, list(envelope.rcpt_tos), envelope.content))
+        return '250 Mensagem aceita'
+
+
+@pytest.fixture
+def servidor_smtp(app_module, monkeypatch):
+    """Sobe o servidor (parâmetros extras vão para o SMTP do aiosmtpd) e aponta o Flask-Mail para ele"""
+    controladores = []
+    
+    def subir(**parametros):
+        caixa = Caixa()
+        controlador = aiosmtpd_controller.Controller(caixa, hostname='127.0.0.1', port=porta_livre(),
+                                                     **parametros)
+        controlador.start()
+        controladores.append(controlador)
+        
+        estado = app_module.app.extensions['mail']
+        for atributo, valor in (('server', '127.0.0.1'), ('port', controlador.port), ('use_tls', False),
+                                ('use_ssl', False), ('username', None), ('password', None),
+                                ('suppress', False)):
+            monkeypatch.setattr(estado, atributo, valor)
+        return caixa
+    
+    yield subir
+    for controlador in controladores:
+        controlador.stop()
+
+
+@pytest.fixture
+def smtp(servidor_smtp):
+    return servidor_smtp()
+
+
+def test_conexao_smtp_reaproveita_e_renova_a_sessao(app_module, smtp):
+    conexoes_antes = app_module.estatisticas_envio_emails()['conexoes']
+    with app_module.app.app_context():
+        conexao = app_module.ConexaoSMTP(maximo=2)
+        for i in range(5):
+            conexao.enviar('sot@exemplo.gov.br', ['a@exemplo.gov.br'], f'Subject: {i}\r\n\r\ncorpo'.encode())
+        conexao.fechar()
+    
+    assert len(smtp.mensagens) == 5
+    # 5 mensagens, renovando a cada 2: 3 sessões
+    assert app_module.estatisticas_envio_emails()['conexoes'] - conexoes_antes == 3
+
+
+def test_sessao_ociosa_derrubada_reenvia_em_sessao_nova(app_module, servidor_smtp):
+    caixa = servidor_smtp(timeout=0.5)  # servidor encerra sessões ociosas por 0,5 s
+    conexoes_antes = app_module.estatisticas_envio_emails()['conexoes']
+    with app_module.app.app_context():
+        conexao = app_module.ConexaoSMTP()
+        conexao.enviar('sot@exemplo.gov.br', ['a@exemplo.gov.br'], b'Subject: 1\r\n\r\ncorpo')
+        time.sleep(1.5)  # fila vazia entre lotes: a sessão fica ociosa e cai
+        conexao.enviar('sot@exemplo.gov.br', ['b@exemplo.gov.br'], b'Subject: 2\r\n\r\ncorpo')
+        conexao.fechar()
+    
+    assert [rcpt for _, rcpt, _ in caixa.mensagens] == [['a@exemplo.gov.br'], ['b@exemplo.gov.br']]
+    assert app_module.estatisticas_envio_emails()['conexoes'] - conexoes_antes == 2
+
+
+def test_sessao_nova_que_falha_nao_e_repetida(app_module, servidor_smtp, monkeypatch):
+    servidor_smtp()
+    tentativas = []
+    
+    def recusar(*args):
+        tentativas.append(1)
+        raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+    
+    with app_module.app.app_context():
+        conexao = app_module.ConexaoSMTP()
+        monkeypatch.setattr(conexao, '_enviar', recusar)
+        with pytest.raises(smtplib.SMTPServerDisconnected):
+            conexao.enviar('sot@exemplo.gov.br', ['a@exemplo.gov.br'], b'corpo')
+    assert len(tentativas) == 1
+
+
+@pytest.fixture
+def fila(app_module, banco, smtp, monkeypatch):
+    """EMAIL_FILA criada pela migração e um tipo de email com callback registrado"""
+    cursor = banco.cursor()
+    app_module._migracao_email_fila(cursor)
+    cursor.close()
+    
+    chamadas = []
+    monkeypatch.setitem(app_module.EMAIL_CALLBACKS, 'teste',
+                        lambda cursor, dados, entregue: chamadas.append((dados, entregue)))
+    return chamadas
+
+
+def enfileirar(app_module, destinatario, dados):
+    with app_module.app.app_context():
+        msg = Message('Teste da fila', sender=('SOT', 'sot@exemplo.gov.br'),
+                      recipients=[destinatario], body='corpo')
+        cursor = app_module.mysql.connection.cursor()
+        id_fila = app_module.enfileirar_email(cursor, msg, 'teste', dados)
+        app_module.mysql.connection.commit()
+        cursor.close()
+    return id_fila
+
+
+def processar(app_module):
+    with app_module.app.app_context():
+        return app_module.processar_fila_emails()
+
+
+def situacao(banco, id_fila):
+    cursor = banco.cursor()
+    banco.commit()  # nova leitura (REPEATABLE READ)
+    cursor.execute("""
+        SELECT STATUS, TENTATIVAS, TIMESTAMPDIFF(SECOND, NOW(), PROXIMA_TENTATIVA), LENGTH(MENSAGEM)
+        FROM EMAIL_FILA WHERE ID = %s
+    """, (id_fila,))
+    resultado = cursor.fetchone()
+    cursor.close()
+    return resultado
+
+
+def test_entrega_chama_o_callback(app_module, banco, smtp, fila):
+    id_fila = enfileirar(app_module, 'destino@exemplo.gov.br', {'id_item': 7})
+    
+    assert processar(app_module) == 1
+    
+    assert [rcpt for _, rcpt, _ in smtp.mensagens] == [['destino@exemplo.gov.br']]
+    assert b'Teste da fila' in smtp.mensagens[0][2]
+    status, tentativas, _, tamanho = situacao(banco, id_fila)
+    assert (status, tentativas, tamanho) == ('ENVIADO', 0, 0)  # conteúdo MIME liberado
+    assert fila == [({'id_item': 7}, True)]
+    
+    assert processar(app_module) == 0  # nada a reenviar
+
+
+def test_recusa_volta_para_fila_com_espera_e_depois_falha(app_module, banco, smtp, fila):
+    id_fila = enfileirar(app_module, RECUSADO, {'id_item': 8})
+    
+    assert processar(app_module) == 1
+    status, tentativas, espera, _ = situacao(banco, id_fila)
+    assert (status, tentativas) == ('PENDENTE', 1)
+    assert app_module.EMAIL_ESPERA_INICIAL - 5 <= espera <= app_module.EMAIL_ESPERA_INICIAL
+    assert processar(app_module) == 0  # ainda esperando
+    
+    # Segunda falha: espera dobra
+    cursor = banco.cursor()
+    cursor.execute("UPDATE EMAIL_FILA SET PROXIMA_TENTATIVA = NOW() WHERE ID = %s", (id_fila,))
+    banco.commit()
+    assert processar(app_module) == 1
+    status, tentativas, espera, _ = situacao(banco, id_fila)
+    assert (status, tentativas) == ('PENDENTE', 2)
+    assert espera >= app_module.EMAIL_ESPERA_INICIAL * 2 - 5
+    assert fila == []
+    
+    # Última tentativa: FALHA definitiva e callback com entregue=False
+    cursor.execute("UPDATE EMAIL_FILA SET PROXIMA_TENTATIVA = NOW(), TENTATIVAS = %s WHERE ID = %s",
+                   (app_module.EMAIL_TENTATIVAS_MAX - 1, id_fila))
+    banco.commit()
+    cursor.close()
+    assert processar(app_module) == 1
+    assert situacao(banco, id_fila)[:2] == ('FALHA', app_module.EMAIL_TENTATIVAS_MAX)
+    assert fila == [({'id_item': 8}, False)]
+    assert smtp.mensagens == []
+
+
+def test_registro_que_falha_apos_o_envio_nao_reenvia(app_module, banco, smtp, fila, monkeypatch):
+    id_fila = enfileirar(app_module, 'destino@exemplo.gov.br', {'id_item': 9})
+    registrar = app_module.registrar_entrega_email
+    
+    def queda_do_banco(*args):
+        raise MySQLdb.OperationalError(2013, 'Lost connection to MySQL server during query')
+    
+    monkeypatch.setattr(app_module, 'registrar_entrega_email', queda_do_banco)
+    assert processar(app_module) == 1
+    assert situacao(banco, id_fila)[0] == 'ENVIANDO'
+    
+    # Reserva vencida: o registro é refeito, o email não sai de novo
+    monkeypatch.setattr(app_module, 'registrar_entrega_email', registrar)
+    cursor = banco.cursor()
+    cursor.execute("UPDATE EMAIL_FILA SET DT_RESERVA = NOW() - INTERVAL 1 DAY WHERE ID = %s", (id_fila,))
+    banco.commit()
+    cursor.close()
+    assert processar(app_module) == 0
+    
+    assert situacao(banco, id_fila)[0] == 'ENVIADO'
+    assert len(smtp.mensagens) == 1
+    assert fila == [({'id_item': 9}, True)]
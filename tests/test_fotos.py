@@ -0,0 +1,143 @@
+"""
+Derivados de foto (/get_foto?size=thumb|medium) com originais problemáticos
+"""
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+
+def jpeg(largura=800, altura=600):
+    saida = BytesIO()
+    Image.new('RGB', (largura, altura), (200, 30, 30)).save(saida, 'JPEG')
+    return saida.getvalue()
+
+
+def test_derivado_gerado(app_module, blob_store):
+    chave = app_module.gerar_derivado_foto('a' * 64, 'thumb', lambda: BytesIO(jpeg()))
+    assert chave == 'a' * 64 + '_thumb'
+    assert blob_store.existe(chave)
+
+
+def test_derivado_gerado_no_pool_e_decodificado_reduzido(app_module, blob_store, monkeypatch):
+    import threading
+    from PIL import JpegImagePlugin
+    
+    threads, drafts = [], []
+    draft = JpegImagePlugin.JpegImageFile.draft
+    
+    def draft_registrando(imagem, mode, size):
+        resultado = draft(imagem, mode, size)
+        drafts.append(imagem.size)
+        return resultado
+    
+    def abrir_original():
+        threads.append(threading.current_thread())
+        return BytesIO(jpeg(3200, 2400))
+    
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, 'draft', draft_registrando)
+    chave = app_module.gerar_derivado_foto('f' * 64, 'thumb', abrir_original)
+    
+    assert threads and threads[0] is not threading.main_thread()
+    assert drafts == [(800, 600)]  # decodificado a 1/4, não em 3200×2400
+    with blob_store.abrir(chave) as derivado:
+        assert Image.open(derivado).size == (400, 300)
+
+
+@pytest.mark.parametrize('hash_, conteudo', [
+    ('b' * 64, b'isto nao e uma imagem'),
+    ('c' * 64, jpeg()[:400]),  # truncado
+])
+def test_original_invalido_nao_gera_derivado(app_module, blob_store, hash_, conteudo):
+    assert app_module.gerar_derivado_foto(hash_, 'thumb', lambda: BytesIO(conteudo)) is None
+    assert not blob_store.existe(f'{hash_}_thumb')
+
+
+def test_decompression_bomb_nao_gera_derivado(app_module, blob_store, monkeypatch):
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)  # 800×600 passa de 2× o limite
+    assert app_module.gerar_derivado_foto('d' * 64, 'thumb', lambda: BytesIO(jpeg())) is None
+
+
+def test_blob_ausente_continua_404(app_module, blob_store):
+    def abrir_original():
+        raise FileNotFoundError('sumiu')
+    
+    with pytest.raises(FileNotFoundError):
+        app_module.gerar_derivado_foto('e' * 64, 'thumb', abrir_original)
+
+
+def upload(conteudo, nome='foto.jpg'):
+    from werkzeug.datastructures import FileStorage
+    return FileStorage(stream=BytesIO(conteudo), filename=nome)
+
+
+def test_gravar_fotos_limita_decodificacoes_simultaneas(app_module, blob_store, monkeypatch):
+    import threading
+    import time
+    
+    ativas, pico, lock = [0], [0], threading.Lock()
+    normalizar = app_module.normalizar_foto
+    
+    def normalizar_contando(origem):
+        with lock:
+            ativas[0] += 1
+            pico[0] = max(pico[0], ativas[0])
+        try:
+            time.sleep(0.05)
+            return normalizar(origem)
+        finally:
+            with lock:
+                ativas[0] -= 1
+    
+    monkeypatch.setattr(app_module, 'normalizar_foto', normalizar_contando)
+    arquivos = [upload(jpeg(640 + i, 480)) for i in range(app_module.FOTO_WORKERS * 3)]
+    arquivos.insert(1, upload(b'', nome=''))  # campo de arquivo vazio
+    
+    fotos = app_module.gravar_fotos_vistoria(arquivos)
+    
+    assert fotos[1] is None
+    gravadas = [f for f in fotos if f]
+    assert len(gravadas) == app_module.FOTO_WORKERS * 3
+    assert pico[0] <= app_module.FOTO_WORKERS
+    assert all(blob_store.existe(f['hash']) and f['mime'] == 'image/jpeg' for f in gravadas)
+    assert gravadas[0]['largura'] == 640
+
+
+def test_formato_nao_reconhecido_mantem_original(app_module, blob_store):
+    conteudo = b'ftypheic' + b'\0' * 100
+    foto = app_module.gravar_fotos_vistoria([upload(conteudo, 'foto.heic')])[0]
+    assert foto['tamanho'] == foto['tamanho_original'] == len(conteudo)
+    assert foto['largura'] is None
+    with blob_store.abrir(foto['hash']) as gravado:
+        assert gravado.read() == conteudo
+
+
+def test_encoder_indisponivel_cai_para_jpeg(app_module, blob_store, monkeypatch, capsys):
+    monkeypatch.setattr(app_module, 'FOTO_FORMATO', 'SEMCODEC')
+    foto = app_module.gravar_fotos_vistoria([upload(jpeg())])[0]
+    assert foto['mime'] == 'image/jpeg'
+    assert 'foto gravada em JPEG' in capsys.readouterr().out
+
+
+def test_falha_do_blob_store_propaga(app_module, blob_store, monkeypatch):
+    def disco_cheio(dados):
+        raise OSError(28, 'No space left on device')
+    
+    monkeypatch.setattr(blob_store, 'gravar', disco_cheio)
+    with pytest.raises(OSError):
+        app_module.gravar_fotos_vistoria([upload(jpeg()), upload(b'', nome='')])
+
+
+def test_blob_store_exige_configuracao_fora_do_debug(app_module, monkeypatch, tmp_path):
+    monkeypatch.delenv('BLOB_STORE_DIR', raising=False)
+    monkeypatch.setattr(app_module.app, 'debug', False)
+    with pytest.raises(RuntimeError, match='BLOB_STORE_DIR'):
+        app_module.criar_blob_store()
+    
+    monkeypatch.setenv('BLOB_STORE_DIR', str(tmp_path / 'blobs'))
+    assert app_module.criar_blob_store().raiz == str(tmp_path / 'blobs')
+    
+    monkeypatch.setattr(app_module, 'BLOB_STORE', 's3')
+    monkeypatch.delenv('BLOB_STORE_BUCKET', raising=False)
+    with pytest.raises(RuntimeError, match='BLOB_STORE_BUCKET'):
+        app_module.criar_blob_store()
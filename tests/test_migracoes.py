@@ -0,0 +1,115 @@
+"""
+Migrações de esquema rodadas na subida (garantir_esquema)
+
+O banco é um cursor falso que só registra os comandos: o que interessa aqui é
+a idempotência (colunas existentes, corrida entre processos) e o controle de
+tentativas, não o SQL em si.
+"""
+import MySQLdb
+import pytest
+
+
+class CursorFalso:
+    def __init__(self, existentes=(), duplicadas=()):
+        self.existentes = existentes
+        self.duplicadas = duplicadas  # criadas por "outro processo" entre a consulta e o ALTER
+        self.comandos = []
+    
+    def execute(self, sql, args=None):
+        self.comandos.append(sql)
+        for coluna in self.duplicadas:
+            if f'ADD COLUMN {coluna} ' in sql:
+                raise MySQLdb.OperationalError(1060, f"Duplicate column name '{coluna}'")
+    
+    def fetchall(self):
+        return [(coluna,) for coluna in self.existentes]
+    
+    def close(self):
+        pass
+
+
+COLUNAS = [
+    ('A', 'ALTER TABLE T ADD COLUMN A INT NULL'),
+    ('B', 'ALTER TABLE T ADD COLUMN B INT NULL'),
+    ('C', 'ALTER TABLE T ADD COLUMN C INT NULL'),
+]
+
+
+def test_adicionar_colunas_so_cria_ausentes(app_module):
+    cursor = CursorFalso(existentes=['a'])
+    assert app_module.adicionar_colunas(cursor, 'T', COLUNAS) == ['B', 'C']
+    assert not any('ADD COLUMN A ' in sql for sql in cursor.comandos)
+
+
+def test_adicionar_colunas_tolera_coluna_criada_por_outro_processo(app_module):
+    cursor = CursorFalso(duplicadas=['B'])
+    assert app_module.adicionar_colunas(cursor, 'T', COLUNAS) == ['A', 'C']
+
+
+def test_adicionar_colunas_propaga_outros_erros(app_module):
+    class CursorSemPermissao(CursorFalso):
+        def execute(self, sql, args=None):
+            if sql.startswith('ALTER'):
+                raise MySQLdb.OperationalError(1142, 'ALTER command denied')
+    
+    with pytest.raises(MySQLdb.OperationalError):
+        app_module.adicionar_colunas(CursorSemPermissao(), 'T', COLUNAS)
+
+
+def test_garantir_esquema_roda_uma_vez_e_espera_apos_falha(app_module, monkeypatch):
+    cursor = CursorFalso()
+    
+    class ConexaoFalsa:
+        commits = 0
+        
+        def cursor(self):
+            return cursor
+        
+        def commit(self):
+            ConexaoFalsa.commits += 1
+    
+    class PoolFalso:
+        connection = ConexaoFalsa()
+    
+    chamadas = []
+    
+    def migracao_instavel(cursor):
+        chamadas.append(1)
+        if len(chamadas) == 1:
+            raise MySQLdb.OperationalError(2003, "Can't connect")
+    
+    monkeypatch.setattr(app_module, 'mysql', PoolFalso())
+    monkeypatch.setattr(app_module, 'MIGRACOES', [migracao_instavel])
+    monkeypatch.setattr(app_module, '_esquema_pronto', False)
+    monkeypatch.setattr(app_module, '_esquema_falha_em', None)
+    
+    with pytest.raises(MySQLdb.OperationalError):
+        app_module.garantir_esquema()
+    # Logo após a falha: erro imediato, sem nova tentativa no banco
+    with pytest.raises(RuntimeError):
+        app_module.garantir_esquema()
+    assert len(chamadas) == 1
+    
+    monkeypatch.setattr(app_module, '_esquema_falha_em',
+                        app_module._esquema_falha_em - app_module.ESQUEMA_RETENTAR_APOS)
+    app_module.garantir_esquema()
+    app_module.garantir_esquema()
+    assert len(chamadas) == 2
+    assert ConexaoFalsa.commits == 1
+
+
+@pytest.mark.parametrize('automatico, caminho, roda', [
+    (False, '/login', False),       # padrão: só `flask migrar-esquema` faz DDL
+    (True, '/login', True),
+    (True, '/static/x.css', False),  # estáticos não dependem do banco
+])
+def test_hook_de_esquema_so_com_esquema_automatico(app_module, monkeypatch, automatico, caminho, roda):
+    chamadas = []
+    monkeypatch.setattr(app_module, 'ESQUEMA_AUTOMATICO', automatico)
+    monkeypatch.setattr(app_module, '_envio_emails_iniciado', True)
+    monkeypatch.setattr(app_module, 'garantir_esquema', lambda: chamadas.append(1))
+    
+    with app_module.app.test_request_context(caminho):
+        app_module.app.preprocess_request()
+    
+    assert bool(chamadas) == roda
@@ -0,0 +1,137 @@
+"""
+Caminho Redis com vários workers (SOCKETIO_MESSAGE_QUEUE + CACHE_TYPE=RedisCache)
+
+Um servidor fakeredis TCP faz o papel do Redis e dois processos
+(tests/worker_redis.py) fazem o papel de dois workers do gunicorn.
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+from pytz import timezone
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from conftest import porta_livre
+
+SEMANA = ('2026-10-11', '2026-10-17')
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker_redis.py')
+
+
+@pytest.fixture(scope='module')
+def redis_url():
+    porta = porta_livre()
+    servidor = fakeredis.TcpFakeServer(('127.0.0.1', porta), server_type='redis')
+    thread = threading.Thread(target=servidor.serve_forever, daemon=True)
+    thread.start()
+    yield f'redis://127.0.0.1:{porta}'
+    servidor.shutdown()
+    servidor.server_close()
+
+
+class Worker:
+    def __init__(self, redis_url):
+        env = dict(os.environ,
+                   SOCKETIO_MESSAGE_QUEUE=f'{redis_url}/0',
+                   CACHE_TYPE='RedisCache',
+                   CACHE_REDIS_URL=f'{redis_url}/1')
+        self.processo = subprocess.Popen(
+            [sys.executable, WORKER], env=env, text=True,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        assert self._ler() == {'pronto': True}
+    
+    def _ler(self):
+        while True:
+            linha = self.processo.stdout.readline()
+            if not linha:
+                raise RuntimeError('worker encerrou')
+            if linha.startswith('@@ '):
+                return json.loads(linha[3:])
+    
+    def __call__(self, acao, **args):
+        self.processo.stdin.write(json.dumps({'acao': acao, **args}) + '\n')
+        self.processo.stdin.flush()
+        resposta = self._ler()
+        assert 'erro' not in resposta, resposta['erro']
+        return resposta['resultado']
+    
+    def encerrar(self):
+        """Encerra sem remover a presença (como um worker que morreu)"""
+        self.processo.kill()
+        self.processo.wait()
+
+
+@pytest.fixture
+def workers(redis_url):
+    # Redis limpo a cada teste
+    import redis
+    for db in (0, 1):
+        redis.Redis.from_url(f'{redis_url}/{db}').flushdb()
+    
+    criados = [Worker(redis_url), Worker(redis_url)]
+    yield criados
+    for worker in criados:
+        worker.encerrar()
+
+
+def test_invalidacao_em_um_worker_descarta_snapshot_do_outro(workers):
+    a, b = workers
+    assert b('salvar_snapshot', inicio=SEMANA[0], fim=SEMANA[1], dados={'v': 1}) is True
+    assert b('obter_snapshot', inicio=SEMANA[0], fim=SEMANA[1]) == {'v': 1}
+    
+    a('invalidar', periodos=[['2026-10-15', '2026-10-15']])
+    
+    assert b('obter_snapshot', inicio=SEMANA[0], fim=SEMANA[1]) is None
+
+
+def test_invalidacao_de_outra_semana_preserva_snapshot(workers):
+    a, b = workers
+    b('salvar_snapshot', inicio=SEMANA[0], fim=SEMANA[1], dados={'v': 1})
+    
+    a('invalidar', periodos=[['2026-11-20', '2026-11-21']])
+    
+    assert b('obter_snapshot', inicio=SEMANA[0], fim=SEMANA[1]) == {'v': 1}
+
+
+def test_invalidacao_total_alcanca_outro_worker(workers):
+    a, b = workers
+    b('salvar_snapshot', inicio=SEMANA[0], fim=SEMANA[1], dados={'v': 1})
+    
+    a('invalidar', periodos=[])
+    
+    assert b('obter_snapshot', inicio=SEMANA[0], fim=SEMANA[1]) is None
+
+
+def test_presenca_compartilhada_e_expiracao_de_worker_morto(workers):
+    a, b = workers
+    a('ttl_presenca', segundos=1)
+    a('registrar_presenca', sid='sid-a', info={'usuario': 'ana', 'nome': 'Ana'})
+    b('registrar_presenca', sid='sid-b', info={'usuario': 'bia', 'nome': 'Bia'})
+    
+    assert a('total_presenca') == 2
+    assert b('total_presenca') == 2
+    
+    a.encerrar()  # sem desconectar: só a expiração remove sid-a
+    time.sleep(1.5)
+    
+    assert b('total_presenca') == 1
+
+
+def test_ultimas_alteracoes_de_workers_simultaneos(workers):
+    a, b = workers
+    desde = datetime.now(timezone('America/Manaus')).strftime('%Y-%m-%d %H:%M:%S')
+    time.sleep(1.1)  # timestamps com resolução de segundos
+    
+    a('anotar', id_ad=1, usuario='ana')
+    b('anotar', id_ad=2, usuario='bia')
+    
+    # Cada worker enxerga a alteração feita no outro
+    assert a('houve_alteracao', desde=desde, usuario='ana') is True
+    assert b('houve_alteracao', desde=desde, usuario='bia') is True
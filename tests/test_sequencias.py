@@ -0,0 +1,217 @@
+"""
+IDs de SEQUENCIAS (proximo_id) sob concorrência
+
+O banco falso trava a linha da sequência do SELECT ... FOR UPDATE até o
+commit/rollback, como o InnoDB, e cada thread só tem a conexão da sua
+"requisição": pedir uma segunda conexão ao pool falha o teste.
+"""
+import threading
+
+import pytest
+
+
+class BancoFalso:
+    def __init__(self, sequencias=None):
+        self.sequencias = dict(sequencias or {})
+        self.travas = {}
+        self.lock = threading.Lock()
+
+    def trava(self, nome):
+        with self.lock:
+            return self.travas.setdefault(nome, threading.Lock())
+
+
+class ConexaoFalsa:
+    def __init__(self, banco):
+        self.banco = banco
+        self.travadas = []
+        self.pendentes = {}
+
+    def cursor(self):
+        return CursorFalso(self)
+
+    def travar(self, nome):
+        if nome not in self.travadas:
+            self.banco.trava(nome).acquire()
+            self.travadas.append(nome)
+
+    def _encerrar(self):
+        for nome in self.travadas:
+            self.banco.trava(nome).release()
+        self.travadas = []
+        self.pendentes = {}
+
+    def commit(self):
+        self.banco.sequencias.update(self.pendentes)
+        self._encerrar()
+
+    def rollback(self):
+        self._encerrar()
+
+
+class CursorFalso:
+    def __init__(self, conexao):
+        self.conexao = conexao
+        self.resultado = None
+
+    def execute(self, sql, args=None):
+        conexao = self.conexao
+        sql = ' '.join(sql.split())
+        if sql.startswith('INSERT INTO SEQUENCIAS'):
+            conexao.travar(args[0])
+            conexao.pendentes.setdefault(args[0], conexao.banco.sequencias.get(args[0], 1))
+        elif sql.startswith('SELECT PROXIMO FROM SEQUENCIAS'):
+            conexao.travar(args[0])
+            if args[0] in conexao.pendentes:
+                self.resultado = (conexao.pendentes[args[0]],)
+            else:
+                self.resultado = (conexao.banco.sequencias[args[0]],)
+        elif sql.startswith('UPDATE SEQUENCIAS SET PROXIMO'):
+            assert args[1] in conexao.travadas
+            conexao.pendentes[args[1]] = args[0]
+        else:
+            raise AssertionError(sql)
+
+    def fetchone(self):
+        return self.resultado
+
+    def close(self):
+        pass
+
+
+class PoolFalso:
+    """Só mysql.connection: uma conexão por thread, como uma por requisição"""
+
+    def __init__(self, banco):
+        self.banco = banco
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        if not hasattr(self._local, 'conexao'):
+            self._local.conexao = ConexaoFalsa(self.banco)
+        return self._local.conexao
+
+
+def alocar_em_paralelo(app_module, nome, threads=8, ids=50):
+    obtidos = []
+    erros = []
+    lock = threading.Lock()
+
+    def alocar():
+        try:
+            meus = []
+            for _ in range(ids):
+                meus.append(app_module.proximo_id(nome))
+                app_module.mysql.connection.commit()
+            with lock:
+                obtidos.extend(meus)
+        except Exception as e:
+            app_module.mysql.connection.rollback()
+            erros.append(e)
+
+    workers = [threading.Thread(target=alocar) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    assert not erros
+    return obtidos
+
+
+@pytest.mark.parametrize('bloco', [1, 5])
+def test_proximo_id_nao_repete_sob_concorrencia(app_module, monkeypatch, bloco):
+    banco = BancoFalso({'CAD_MOTORISTA': 101})
+    monkeypatch.setattr(app_module, 'mysql', PoolFalso(banco))
+    monkeypatch.setattr(app_module, 'SEQUENCIA_BLOCO', bloco)
+    monkeypatch.setattr(app_module, '_sequencia_faixas', {})
+
+    obtidos = alocar_em_paralelo(app_module, 'CAD_MOTORISTA')
+
+    assert len(obtidos) == len(set(obtidos)) == 400
+    assert min(obtidos) == 101
+    if bloco == 1:
+        assert sorted(obtidos) == list(range(101, 501))
+
+
+def test_sequencia_nao_semeada_comeca_em_1(app_module, monkeypatch):
+    banco = BancoFalso()
+    monkeypatch.setattr(app_module, 'mysql', PoolFalso(banco))
+    monkeypatch.setattr(app_module, 'SEQUENCIA_BLOCO', 1)
+
+    obtidos = alocar_em_paralelo(app_module, 'TESTE_CONCORRENCIA', threads=4, ids=10)
+
+    assert sorted(obtidos) == list(range(1, 41))
+    assert banco.sequencias['TESTE_CONCORRENCIA'] == 41
+
+
+def test_rollback_devolve_o_id(app_module, monkeypatch):
+    banco = BancoFalso({'CAD_MOTORISTA': 7})
+    monkeypatch.setattr(app_module, 'mysql', PoolFalso(banco))
+    monkeypatch.setattr(app_module, 'SEQUENCIA_BLOCO', 1)
+
+    assert app_module.proximo_id('CAD_MOTORISTA') == 7
+    app_module.mysql.connection.rollback()
+    assert app_module.proximo_id('CAD_MOTORISTA') == 7
+    app_module.mysql.connection.commit()
+    assert app_module.proximo_id('CAD_MOTORISTA') == 8
+
+
+def test_bloco_reserva_em_transacao_curta(app_module, monkeypatch):
+    banco = BancoFalso({'CAD_MOTORISTA': 1})
+    monkeypatch.setattr(app_module, 'mysql', PoolFalso(banco))
+    monkeypatch.setattr(app_module, 'SEQUENCIA_BLOCO', 5)
+    monkeypatch.setattr(app_module, '_sequencia_faixas', {})
+
+    assert app_module.proximo_id('CAD_MOTORISTA') == 1
+    # Faixa já gravada e linha liberada, mesmo sem o commit do chamador
+    assert banco.sequencias['CAD_MOTORISTA'] == 6
+    assert not app_module.mysql.connection.travadas
+    assert [app_module.proximo_id('CAD_MOTORISTA') for _ in range(5)] == [2, 3, 4, 5, 6]
+    assert banco.sequencias['CAD_MOTORISTA'] == 11
+
+
+@pytest.mark.parametrize('bloco', [1, 5])
+def test_sequencias_semeadas_nao_repetem_no_mysql(app_module, banco, monkeypatch, bloco):
+    monkeypatch.setattr(app_module, 'SEQUENCIA_BLOCO', bloco)
+    monkeypatch.setattr(app_module, '_sequencia_faixas', {})
+    cursor = banco.cursor()
+    for tabela, coluna in app_module.SEQUENCIAS.values():
+        cursor.execute(f"CREATE TABLE {tabela} ({coluna} INT PRIMARY KEY)")
+    cursor.execute("INSERT INTO CAD_MOTORISTA VALUES (1), (2), (40)")
+    banco.commit()
+
+    app_module._migracao_sequencias(cursor)
+    cursor.execute("DELETE FROM CAD_MOTORISTA WHERE ID_MOTORISTA = 40")
+    app_module._migracao_sequencias(cursor)  # nunca volta a sequência
+    banco.commit()
+    cursor.execute("SELECT PROXIMO FROM SEQUENCIAS WHERE NOME = 'CAD_MOTORISTA'")
+    assert cursor.fetchone() == (41,)
+
+    obtidos = []
+    erros = []
+    lock = threading.Lock()
+
+    def cadastrar():
+        try:
+            with app_module.app.app_context():
+                for _ in range(25):
+                    novo_id = app_module.proximo_id('CAD_MOTORISTA')
+                    cursor = app_module.mysql.connection.cursor()
+                    cursor.execute("INSERT INTO CAD_MOTORISTA VALUES (%s)", (novo_id,))
+                    cursor.close()
+                    app_module.mysql.connection.commit()
+                    with lock:
+                        obtidos.append(novo_id)
+        except Exception as e:
+            erros.append(e)
+
+    workers = [threading.Thread(target=cadastrar) for _ in range(4)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    assert not erros
+    assert len(obtidos) == len(set(obtidos)) == 100
+    assert min(obtidos) == 41
@@ -0,0 +1,106 @@
+"""
+Upload retomável (/api/uploads): finalizações concorrentes do mesmo upload
+"""
+import threading
+import time
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def cliente(app_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, '_esquema_pronto', True)
+    monkeypatch.setattr(app_module, '_envio_emails_iniciado', True)
+    monkeypatch.setattr(app_module, 'UPLOAD_RETOMAVEL_DIR', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(app_module, 'blob_store', app_module.BlobStoreLocal(str(tmp_path / 'blobs')))
+    
+    def novo():
+        client = app_module.app.test_client()
+        with client.session_transaction() as sessao:
+            sessao['usuario_login'] = 'teste'
+        return client
+    return novo
+
+
+def enviar(client, conteudo):
+    upload_id = client.post('/api/uploads', json={'tamanho': len(conteudo)}).get_json()['upload_id']
+    resposta = client.patch(f'/api/uploads/{upload_id}', data=conteudo, headers={'Upload-Offset': '0'})
+    assert resposta.get_json()['offset'] == len(conteudo)
+    return upload_id
+
+
+def test_finalizar_concorrente_grava_uma_vez(app_module, cliente, monkeypatch):
+    saida = BytesIO()
+    Image.new('RGB', (300, 200), (10, 120, 40)).save(saida, 'JPEG')
+    upload_id = enviar(cliente(), saida.getvalue())
+    
+    chamadas = []
+    gravar = app_module.gravar_fotos_vistoria
+    
+    def gravar_devagar(arquivos):
+        chamadas.append(1)
+        time.sleep(0.2)  # alarga a janela entre ler o meta e gravar a mídia
+        return gravar(arquivos)
+    
+    monkeypatch.setattr(app_module, 'gravar_fotos_vistoria', gravar_devagar)
+    
+    respostas = []
+    
+    def finalizar():
+        respostas.append(cliente().post(f'/api/uploads/{upload_id}/finalizar'))
+    
+    threads = [threading.Thread(target=finalizar) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    assert [r.status_code for r in respostas] == [200, 200, 200]
+    assert len({r.get_json()['tamanho'] for r in respostas}) == 1
+    assert len(chamadas) == 1
+    
+    # Finalizado: pedaços novos são recusados
+    resposta = cliente().patch(f'/api/uploads/{upload_id}', data=b'x', headers={'Upload-Offset': '0'})
+    assert resposta.status_code == 404
+
+
+def test_upload_de_outro_usuario(app_module, cliente):
+    upload_id = enviar(cliente(), b'abc')
+    outro = app_module.app.test_client()
+    with outro.session_transaction() as sessao:
+        sessao['usuario_login'] = 'outro'
+    assert outro.post(f'/api/uploads/{upload_id}/finalizar').status_code == 404
+
+
+def test_id_inexistente_nao_cria_trava(app_module, cliente):
+    upload_id = 'f' * 32
+    assert cliente().post(f'/api/uploads/{upload_id}/finalizar').status_code == 404
+    assert upload_id not in app_module.uploads_locks
+
+
+def test_upload_expirado_sai_inteiro_e_o_em_andamento_fica(app_module, cliente):
+    import os
+    
+    client = cliente()
+    abandonado = enviar(client, b'abc')
+    assert abandonado in app_module.uploads_locks  # criada pelo PATCH
+    
+    em_andamento = client.post('/api/uploads', json={'tamanho': 6}).get_json()['upload_id']
+    antigo = time.time() - app_module.UPLOAD_VALIDADE - 60
+    for upload_id in (abandonado, em_andamento):
+        for caminho in app_module._caminhos_upload(upload_id):
+            os.utime(caminho, (antigo, antigo))
+    
+    # Um PATCH renova a validade do upload em andamento
+    resposta = client.patch(f'/api/uploads/{em_andamento}', data=b'abc', headers={'Upload-Offset': '0'})
+    assert resposta.get_json()['offset'] == 3
+    
+    app_module.limpar_uploads_expirados()
+    
+    assert abandonado not in app_module.uploads_locks
+    assert not any(os.path.exists(c) for c in app_module._caminhos_upload(abandonado))
+    assert all(os.path.exists(c) for c in app_module._caminhos_upload(em_andamento))
+    resposta = client.patch(f'/api/uploads/{em_andamento}', data=b'def', headers={'Upload-Offset': '3'})
+    assert resposta.get_json()['offset'] == 6
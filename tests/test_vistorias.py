@@ -0,0 +1,73 @@
+"""
+Lista paginada de vistorias (buscar_pagina_vistorias, paginação por chave)
+"""
+from datetime import datetime, timedelta
+
+from flask import render_template
+
+
+def test_cursor_de_vistoria_sem_data(app_module):
+    assert app_module.cursor_lista_vistorias(None, 42) == '_42'
+    assert app_module.cursor_lista_vistorias(datetime(2026, 10, 1, 8, 30), 7) == '2026-10-01T08:30:00_7'
+
+
+def test_paginas_incluem_vistorias_sem_data(app_module, banco):
+    cursor = banco.cursor()
+    cursor.execute("""
+        CREATE TABLE VISTORIAS (
+            IDVISTORIA INT PRIMARY KEY, IDMOTORISTA VARCHAR(10), NC_MOTORISTA VARCHAR(50),
+            IDVEICULO INT, DATA DATETIME NULL, TIPO VARCHAR(20), STATUS VARCHAR(20),
+            OBS TEXT, VISTORIA_SAIDA_ID INT NULL
+        )
+    """)
+    cursor.execute("CREATE TABLE CAD_MOTORISTA (ID_MOTORISTA INT PRIMARY KEY, NM_MOTORISTA VARCHAR(50))")
+    cursor.execute("CREATE TABLE CAD_VEICULOS (ID_VEICULO INT PRIMARY KEY, DS_MODELO VARCHAR(50), NU_PLACA VARCHAR(10))")
+    cursor.execute("INSERT INTO CAD_MOTORISTA VALUES (1, 'Fulano')")
+    cursor.execute("INSERT INTO CAD_VEICULOS VALUES (1, 'Gol', 'ABC1D23')")
+    
+    base = datetime(2026, 10, 1, 8, 0)
+    datas = {1: base, 2: base, 3: None, 4: base + timedelta(days=1), 5: None,
+             6: base - timedelta(days=3), 7: None, 8: base + timedelta(days=1)}
+    for id_vistoria, data in datas.items():
+        cursor.execute("""
+            INSERT INTO VISTORIAS VALUES (%s, '1', NULL, 1, %s, 'SAIDA', 'FINALIZADA', '', NULL)
+        """, (id_vistoria, data))
+    banco.commit()
+    
+    vistos = []
+    apos = None
+    while True:
+        linhas, apos = app_module.buscar_pagina_vistorias(cursor, 'finalizadas', {}, apos, limite=2)
+        vistos.extend(linha[0] for linha in linhas)
+        if not apos:
+            break
+    
+    # Datadas (DATA DESC, ID DESC) e depois as sem data (ID DESC), cada uma uma vez
+    assert vistos == [8, 4, 2, 1, 6, 7, 5, 3]
+    
+    # A API percorre as mesmas páginas; vistorias sem data saem com data vazia
+    cliente = app_module.app.test_client()
+    vistos = []
+    apos = None
+    while True:
+        resposta = cliente.get('/api/vistorias', query_string={'limite': 2, **({'apos': apos} if apos else {})})
+        assert resposta.status_code == 200
+        corpo = resposta.get_json()
+        vistos.extend((v['id'], v['data']) for v in corpo['vistorias'])
+        apos = corpo['proximo']
+        if not apos:
+            break
+    
+    assert [id_vistoria for id_vistoria, _ in vistos] == [8, 4, 2, 1, 6, 7, 5, 3]
+    assert dict(vistos)[3] == '' and dict(vistos)[1] == '01/10/2026 08:00'
+
+
+def test_lista_renderiza_vistorias_sem_data(app_module):
+    vistoria = (3, 'Fulano', 'Gol - ABC1D23', None, 'SAIDA', 'FINALIZADA', '', None)
+    with app_module.app.test_request_context('/vistorias'):
+        html = render_template(
+            'vistorias.html',
+            vistorias_em_transito=[vistoria], vistorias_pendentes=[vistoria], vistorias_finalizadas=[vistoria],
+            proximos={}, filtros={}, veiculos=[]
+        )
+    assert 'Fulano' in html
@@ -0,0 +1,54 @@
+"""
+Worker para tests/test_agenda_concorrente.py
+
+Importa o app no ASYNC_MODE do ambiente (o monkey patch vem antes de tudo,
+como no gunicorn), dispara CARGAS requisições simultâneas a /api/agenda/dados,
+uma semana por requisição, e devolve os tempos numa linha "@@ {json}".
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as modulo  # aplica o monkey patch de ASYNC_MODE
+
+modulo._esquema_pronto = True  # como após `flask migrar-esquema`: só a agenda vai ao banco
+
+import json
+import threading
+import time
+from datetime import date, timedelta
+
+
+def carregar(inicio, fim, tempos):
+    with modulo.app.test_client() as client:
+        with client.session_transaction() as sessao:
+            sessao['usuario_login'] = 'teste'
+            sessao['usuario_nome'] = 'teste'
+        t0 = time.time()
+        resposta = client.get(f'/api/agenda/dados?inicio={inicio}&fim={fim}')
+        tempos.append({'s': time.time() - t0, 'status': resposta.status_code})
+
+
+def main():
+    cargas = int(os.environ['CARGAS'])
+    domingo = date(2026, 10, 11)
+    semanas = [(domingo - timedelta(weeks=i), domingo - timedelta(weeks=i) + timedelta(days=6))
+               for i in range(cargas)]
+    
+    tempos = []
+    threads = [threading.Thread(target=carregar, args=(inicio, fim, tempos))
+               for inicio, fim in semanas]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.time() - t0
+    
+    print('@@ ' + json.dumps({'modo': modulo.ASYNC_MODE, 'total': total, 'cargas': tempos}),
+          flush=True)
+
+
+if __name__ == '__main__':
+    main()
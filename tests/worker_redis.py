@@ -0,0 +1,58 @@
+"""
+Worker de teste: importa o app com Redis compartilhado e executa comandos
+JSON lidos da entrada padrão (um por linha). Cada resposta é um JSON numa
+linha com o prefixo '@@ ' (o app também escreve logs na saída padrão).
+
+Cada processo tem seus próprios snapshots em memória, como um worker do
+gunicorn; só o Redis é comum entre eles.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import MySQLdb  # noqa: F401
+except ImportError:
+    import pymysql
+    pymysql.install_as_MySQLdb()
+    sys.modules['MySQLdb.cursors'] = pymysql.cursors
+
+import app as modulo
+
+
+def executar(comando):
+    acao = comando['acao']
+    if acao == 'salvar_snapshot':
+        _, geracao = modulo.obter_snapshot_agenda(comando['inicio'], comando['fim'])
+        return modulo.salvar_snapshot_agenda(comando['inicio'], comando['fim'], comando['dados'], geracao)
+    if acao == 'obter_snapshot':
+        dados, _ = modulo.obter_snapshot_agenda(comando['inicio'], comando['fim'])
+        return dados
+    if acao == 'invalidar':
+        modulo.invalidar_snapshots_agenda(*[tuple(p) for p in comando['periodos']])
+        return True
+    if acao == 'registrar_presenca':
+        modulo.registrar_presenca(comando['sid'], comando['info'])
+        return True
+    if acao == 'total_presenca':
+        return modulo.total_presenca()
+    if acao == 'ttl_presenca':
+        modulo.PRESENCA_TTL = comando['segundos']
+        return True
+    if acao == 'anotar':
+        return modulo.anotar_alteracao_agenda('DEMANDA', 'UPDATE', comando['id_ad'], usuario=comando['usuario'])
+    if acao == 'houve_alteracao':
+        return modulo.houve_alteracao_de_outros(comando['desde'], comando['usuario'])
+    raise ValueError(acao)
+
+
+print('@@ ' + json.dumps({'pronto': True}), flush=True)
+for linha in sys.stdin:
+    comando = json.loads(linha)
+    try:
+        resposta = {'resultado': executar(comando)}
+    except Exception as e:
+        resposta = {'erro': f"{type(e).__name__}: {e}"}
+    print('@@ ' + json.dumps(resposta, default=str), flush=True)